@@ -10,8 +10,11 @@ from fastapi.staticfiles import StaticFiles
 from loguru import logger
 
 from app.config import config
+from app.controllers.v1.video import task_manager
 from app.models.exception import HttpException
 from app.router import root_api_router
+from app.services import webhook
+from app.services.runtime import runtime
 from app.utils import utils
 
 
@@ -19,6 +22,7 @@ def exception_handler(request: Request, e: HttpException):
     return JSONResponse(
         status_code=e.status_code,
         content=utils.get_response(e.status_code, e.data, e.message),
+        headers=e.headers,
     )
 
 
@@ -75,8 +79,12 @@ app.mount("/", StaticFiles(directory=public_dir, html=True), name="")
 @app.on_event("shutdown")
 def shutdown_event():
     logger.info("shutdown event")
+    task_manager.shutdown()
+    runtime.shutdown()
 
 
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    task_manager.start()
+    webhook.dispatcher.start()
@@ -1,10 +1,18 @@
+import hashlib
 from uuid import uuid4
 
 from fastapi import Request
 
 from app.config import config
+from app.models import const
 from app.models.exception import HttpException
 
+TASK_PRIORITIES = {
+    "high": const.TASK_PRIORITY_HIGH,
+    "normal": const.TASK_PRIORITY_NORMAL,
+    "low": const.TASK_PRIORITY_LOW,
+}
+
 
 def get_task_id(request: Request):
     task_id = request.headers.get("x-task-id")
@@ -18,6 +26,48 @@ def get_api_key(request: Request):
     return api_key
 
 
+def get_idempotency_key(request: Request):
+    key = request.headers.get("idempotency-key", "").strip()
+    return key or None
+
+
+def is_trusted(request: Request) -> bool:
+    """
+    Whether the caller may choose its tenant and raise its priority: its api
+    key is one of trusted_api_keys, e.g. a gateway scheduling its own users.
+    """
+    api_key = get_api_key(request)
+    return bool(api_key) and api_key in config.app.get("trusted_api_keys", [])
+
+
+def get_tenant(request: Request):
+    """
+    The tenant the tasks are scheduled fairly by: a hash of the api key, so
+    the key itself is not stored in the queue, or the x-tenant-id header of
+    a trusted caller.
+    """
+    tenant = request.headers.get("x-tenant-id")
+    if tenant and is_trusted(request):
+        return tenant
+    api_key = get_api_key(request)
+    if api_key:
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return "default"
+
+
+def get_task_priority(request: Request, default: int = const.TASK_PRIORITY_NORMAL):
+    """
+    The priority of the x-task-priority header, any caller may lower the
+    priority of its tasks but only a trusted one may raise it.
+    """
+    priority = request.headers.get("x-task-priority", "").strip().lower()
+    if priority not in TASK_PRIORITIES:
+        return default
+    if is_trusted(request):
+        return TASK_PRIORITIES[priority]
+    return max(TASK_PRIORITIES[priority], default)
+
+
 def verify_token(request: Request):
     token = get_api_key(request)
     if token != config.app.get("api_key", ""):
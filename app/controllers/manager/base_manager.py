@@ -1,18 +1,98 @@
+import math
+import multiprocessing
 import threading
-from typing import Any, Callable, Dict
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from app.models import const
+from app.services import admission, cancellation, webhook
+from app.services import state as sm
+
+WORKER_BACKEND_THREAD = "thread"
+WORKER_BACKEND_PROCESS = "process"
+
+# assumed duration of a task until some tasks have completed
+DEFAULT_TASK_DURATION = 120
+# weight of the last task in the average duration
+DURATION_SMOOTHING = 0.2
+
+
+def _init_worker(queue, controller):
+    # the state of the worker process is forwarded to the api process
+    sm.state = sm.QueueState(queue)
+    # and the stage budgets are shared by all the workers
+    admission.use(controller)
 
 
 class TaskManager:
-    def __init__(self, max_concurrent_tasks: int):
+    def __init__(
+        self,
+        max_concurrent_tasks: int,
+        worker_backend: str = WORKER_BACKEND_THREAD,
+        max_tasks_per_child: int = 0,
+        max_queued_tasks: int = 0,
+        max_time_to_start: float = 0,
+    ):
         self.max_concurrent_tasks = max_concurrent_tasks
         self.current_tasks = 0
         self.lock = threading.Lock()
         self.queue = self.create_queue()
+        self.worker_backend = worker_backend
+        self.max_tasks_per_child = max_tasks_per_child
+        self.worker_pool = None
+        # shared by the successive pools, created with the first one
+        self.pool_context = None
+        self.state_queue = None
+        self.shared_admission = None
+        self.max_queued_tasks = max_queued_tasks
+        self.max_time_to_start = max_time_to_start
+        # average duration of the tasks, by stop_at
+        self.durations: Dict[str, float] = {}
+
+    def get_worker_pool(self) -> ProcessPoolExecutor:
+        """
+        The pool of worker processes running the tasks, created on first use.
+        Workers are spawned rather than forked, as the api process runs threads,
+        and are replaced after max_tasks_per_child tasks to release their memory.
+
+        A pool broken by a crashed worker is replaced, but the state queue, its
+        listener and the shared admission controller are created only once, so
+        the stages still running keep their budgets.
+        """
+        with self.lock:
+            if self.pool_context is None:
+                self.pool_context = multiprocessing.get_context("spawn")
+                self.state_queue = self.pool_context.Queue()
+                threading.Thread(
+                    target=sm.apply_updates,
+                    args=(self.state_queue, sm.state),
+                    name="worker-state",
+                    daemon=True,
+                ).start()
+                self.shared_admission = admission.share(self.pool_context)
+            if self.worker_pool is None:
+                self.worker_pool = ProcessPoolExecutor(
+                    max_workers=self.max_concurrent_tasks,
+                    mp_context=self.pool_context,
+                    initializer=_init_worker,
+                    initargs=(self.state_queue, self.shared_admission),
+                    max_tasks_per_child=self.max_tasks_per_child or None,
+                )
+            return self.worker_pool
 
     def create_queue(self):
         raise NotImplementedError()
 
-    def add_task(self, func: Callable, *args: Any, **kwargs: Any):
+    def add_task(
+        self,
+        func: Callable,
+        *args: Any,
+        priority: int = const.TASK_PRIORITY_NORMAL,
+        tenant: str = "",
+        **kwargs: Any,
+    ):
         with self.lock:
             if self.current_tasks < self.max_concurrent_tasks:
                 print(f"add task: {func.__name__}, current_tasks: {self.current_tasks}")
@@ -21,22 +101,72 @@ class TaskManager:
                 print(
                     f"enqueue task: {func.__name__}, current_tasks: {self.current_tasks}"
                 )
-                self.enqueue({"func": func, "args": args, "kwargs": kwargs})
+                self.enqueue(
+                    {
+                        "func": func,
+                        "args": args,
+                        "kwargs": kwargs,
+                        "priority": priority,
+                        "tenant": tenant,
+                    }
+                )
 
     def execute_task(self, func: Callable, *args: Any, **kwargs: Any):
+        # called with the lock held, the slot is taken before the thread starts
+        # so concurrent add_task calls can't exceed max_concurrent_tasks
+        self.current_tasks += 1
         thread = threading.Thread(
             target=self.run_task, args=(func, *args), kwargs=kwargs
         )
         thread.start()
 
     def run_task(self, func: Callable, *args: Any, **kwargs: Any):
+        started = time.time()
         try:
-            with self.lock:
-                self.current_tasks += 1
-            func(*args, **kwargs)  # call the function here, passing *args and **kwargs.
+            self.call(func, *args, **kwargs)
+            # a cancelled task would make the estimates too short
+            if not cancellation.is_cancelled(kwargs.get("task_id")):
+                self.record_duration(kwargs.get("stop_at", "video"), time.time() - started)
+        except BrokenProcessPool as e:
+            print(f"worker process of task {kwargs.get('task_id')} died: {str(e)}")
+            if "task_id" in kwargs:
+                sm.state.update_task(kwargs["task_id"], state=const.TASK_STATE_FAILED)
+                webhook.notify(
+                    getattr(kwargs.get("params"), "callback_url", ""),
+                    kwargs["task_id"],
+                    const.TASK_STATE_FAILED,
+                    {"error": "the worker process died"},
+                )
         finally:
             self.task_done()
 
+    def call(self, func: Callable, *args: Any, **kwargs: Any):
+        """
+        Run the task with the configured backend. Raises BrokenProcessPool if
+        the worker process running it died.
+        """
+        if self.worker_backend != WORKER_BACKEND_PROCESS:
+            func(*args, **kwargs)  # call the function here, passing *args and **kwargs.
+            return
+
+        # the thread only waits for the worker process, so the slot is
+        # released when the task is done
+        pool = self.get_worker_pool()
+        try:
+            pool.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            # a worker crashed (e.g. killed for memory), the next task gets a new pool
+            with self.lock:
+                if self.worker_pool is pool:
+                    self.worker_pool = None
+            raise
+
+    def start(self):
+        """
+        Called on startup, the in-memory queue starts empty.
+        """
+        pass
+
     def check_queue(self):
         with self.lock:
             if (
@@ -54,6 +184,81 @@ class TaskManager:
             self.current_tasks -= 1
         self.check_queue()
 
+    def shutdown(self):
+        with self.lock:
+            pool, self.worker_pool = self.worker_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if self.state_queue is not None:
+            self.state_queue.put(None)
+
+    def record_duration(self, kind: str, seconds: float):
+        with self.lock:
+            average = self.durations.get(kind, seconds)
+            self.durations[kind] = average + (seconds - average) * DURATION_SMOOTHING
+
+    def average_duration(self) -> float:
+        """
+        Average duration of the tasks, over the kinds of tasks that completed.
+        """
+        durations = self.get_durations()
+        if not durations:
+            return DEFAULT_TASK_DURATION
+        return sum(durations.values()) / len(durations)
+
+    def get_durations(self) -> Dict[str, float]:
+        with self.lock:
+            return dict(self.durations)
+
+    def running(self) -> int:
+        return self.current_tasks
+
+    def capacity(self) -> int:
+        return self.max_concurrent_tasks
+
+    def queued(self) -> int:
+        return self.queue.qsize()
+
+    def estimate_time_to_start(self, queued: Optional[int] = None) -> float:
+        """
+        Seconds until a task queued now starts: the tasks ahead of it run
+        capacity at a time, each for the average duration.
+        """
+        queued = self.queued() if queued is None else queued
+        capacity = max(1, self.capacity())
+        busy = self.running() + queued
+        if busy < capacity:
+            return 0.0
+        waves = (busy - capacity + 1) / capacity
+        return round(waves * self.average_duration(), 1)
+
+    def check_saturation(self, incoming: int = 1) -> Optional[int]:
+        """
+        None if incoming new tasks can be accepted, otherwise the seconds
+        after which the client should try again.
+        """
+        queued = self.queued()
+        time_to_start = self.estimate_time_to_start(queued)
+        saturated = self.max_queued_tasks > 0 and queued + incoming > self.max_queued_tasks
+        if self.max_time_to_start > 0 and time_to_start > self.max_time_to_start:
+            saturated = True
+        if not saturated:
+            return None
+        # about when the next slot frees up
+        return max(1, math.ceil(self.average_duration() / max(1, self.capacity())))
+
+    def metrics(self) -> Dict:
+        queued = self.queued()
+        return {
+            "running": self.current_tasks,
+            "max_concurrent_tasks": self.max_concurrent_tasks,
+            "queued": queued,
+            "max_queued_tasks": self.max_queued_tasks,
+            "time_to_start": self.estimate_time_to_start(queued),
+            "durations": {k: round(v, 1) for k, v in self.get_durations().items()},
+            "admission": admission.controller.stats(),
+        }
+
     def enqueue(self, task: Dict):
         raise NotImplementedError()
 
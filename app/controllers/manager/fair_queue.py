@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from app.models import const
+
+PRIORITIES = [
+    const.TASK_PRIORITY_HIGH,
+    const.TASK_PRIORITY_NORMAL,
+    const.TASK_PRIORITY_LOW,
+]
+
+
+def clamp_priority(priority: int) -> int:
+    return min(max(int(priority), PRIORITIES[0]), PRIORITIES[-1])
+
+
+def is_aged(task: Dict, priority: int, aging: float, now: float) -> bool:
+    """
+    Whether the task has waited long enough to leave the priority, one
+    priority above the one it was queued with per aging seconds.
+    """
+    levels = task.get("priority", priority) - priority + 1
+    return now - task.get("queued_at", now) > aging * levels
+
+
+class FairQueue:
+    """
+    Queue of tasks by priority and tenant.
+
+    Higher priorities are always served first. Within a priority, the tenants
+    take turns with deficit round robin: on its turn a tenant gets weight
+    tasks (1 by default), so a bulk submission of one tenant doesn't delay
+    the tasks of the others. A task waiting longer than aging seconds is
+    promoted to the next priority, so low priority tasks still run under
+    a constant stream of higher priority ones.
+
+    Not thread safe, the task manager calls it with its lock held.
+    """
+
+    def __init__(self, weights: Optional[Dict[str, int]] = None, aging: float = 0):
+        self.weights = weights or {}
+        self.aging = aging
+        # priority => tenant => tasks, in the order the tenants take turns
+        self.queues: Dict[int, Dict[str, deque]] = {p: {} for p in PRIORITIES}
+        # priority => tasks the tenant at the head can still take on its turn
+        self.deficits: Dict[int, int] = {p: 0 for p in PRIORITIES}
+        self.size = 0
+
+    def put(self, task: Dict, priority: int = const.TASK_PRIORITY_NORMAL, tenant: str = ""):
+        priority = clamp_priority(priority)
+        task.setdefault("queued_at", time.time())
+        task.setdefault("priority", priority)
+        self.queues[priority].setdefault(tenant, deque()).append(task)
+        self.size += 1
+
+    def _promote(self):
+        now = time.time()
+        # from the lowest priority, so a task can move up several priorities at once
+        for priority in reversed(PRIORITIES[1:]):
+            for tenant, tasks in list(self.queues[priority].items()):
+                while tasks and is_aged(tasks[0], priority, self.aging, now):
+                    task = tasks.popleft()
+                    self.queues[priority - 1].setdefault(tenant, deque()).append(task)
+                if not tasks:
+                    self._remove(priority, tenant)
+
+    def _remove(self, priority: int, tenant: str):
+        tenants = self.queues[priority]
+        if next(iter(tenants), None) == tenant:
+            self.deficits[priority] = 0
+        del tenants[tenant]
+
+    def get(self) -> Optional[Dict]:
+        if self.aging > 0:
+            self._promote()
+        for priority in PRIORITIES:
+            tenants = self.queues[priority]
+            if not tenants:
+                continue
+            tenant = next(iter(tenants))
+            if self.deficits[priority] <= 0:
+                self.deficits[priority] = max(1, int(self.weights.get(tenant, 1)))
+            task = tenants[tenant].popleft()
+            self.deficits[priority] -= 1
+            self.size -= 1
+            if not tenants[tenant]:
+                self._remove(priority, tenant)
+            elif self.deficits[priority] <= 0:
+                # end of the turn, the tenant goes to the back
+                tenants[tenant] = tenants.pop(tenant)
+            return task
+        return None
+
+    def empty(self) -> bool:
+        return self.size == 0
+
+    def qsize(self) -> int:
+        return self.size
@@ -1,15 +1,24 @@
-from queue import Queue
 from typing import Dict
 
+from app.config import config
 from app.controllers.manager.base_manager import TaskManager
+from app.controllers.manager.fair_queue import FairQueue
+from app.models import const
 
 
 class InMemoryTaskManager(TaskManager):
     def create_queue(self):
-        return Queue()
+        return FairQueue(
+            weights=config.app.get("tenant_weights", {}),
+            aging=config.app.get("task_aging_seconds", 300),
+        )
 
     def enqueue(self, task: Dict):
-        self.queue.put(task)
+        self.queue.put(
+            task,
+            priority=task.get("priority", const.TASK_PRIORITY_NORMAL),
+            tenant=task.get("tenant", ""),
+        )
 
     def dequeue(self):
         return self.queue.get()
@@ -1,10 +1,21 @@
 import json
-from typing import Dict
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
 
 import redis
+from loguru import logger
+from pydantic import BaseModel
 
-from app.controllers.manager.base_manager import TaskManager
-from app.models.schema import VideoParams
+from app.controllers.manager.base_manager import DURATION_SMOOTHING, TaskManager
+from app.controllers.manager.fair_queue import PRIORITIES, clamp_priority
+from app.models import const, schema
+from app.services import cancellation, webhook
+from app.services import state as sm
 from app.services import task as tm
 
 FUNC_MAP = {
@@ -12,45 +23,506 @@ FUNC_MAP = {
     # 'start_test': tm.start_test
 }
 
+# KEYS: tenant queue, tenants of the priority, wake up signal
+# ARGV: task, tenant, push to the front
+_ENQUEUE_SCRIPT = """
+if ARGV[3] == "1" then
+    redis.call("LPUSH", KEYS[1], ARGV[1])
+else
+    redis.call("RPUSH", KEYS[1], ARGV[1])
+end
+if not redis.call("LPOS", KEYS[2], ARGV[2]) then
+    redis.call("RPUSH", KEYS[2], ARGV[2])
+end
+redis.call("RPUSH", KEYS[3], 1)
+redis.call("LTRIM", KEYS[3], -1000, -1)
+"""
+
+# deficit round robin over the tenants of the highest non empty priority,
+# the tenant at the head of the tenants list has the turn
+# KEYS: processing list, deficits hash
+# ARGV: queue name, tenant weights as json, priorities...
+_POP_SCRIPT = """
+local weights = cjson.decode(ARGV[2])
+for i = 3, #ARGV do
+    local p = ARGV[i]
+    local tenants_key = ARGV[1] .. ":tenants:p" .. p
+    for _ = 1, redis.call("LLEN", tenants_key) do
+        local tenant = redis.call("LINDEX", tenants_key, 0)
+        local queue_key = ARGV[1] .. ":p" .. p .. ":" .. tenant
+        local task = redis.call("LMOVE", queue_key, KEYS[1], "LEFT", "RIGHT")
+        if task then
+            local deficit = tonumber(redis.call("HGET", KEYS[2], p) or "0")
+            if deficit <= 0 then
+                deficit = tonumber(weights[tenant] or 1)
+            end
+            deficit = deficit - 1
+            if redis.call("LLEN", queue_key) == 0 then
+                redis.call("LPOP", tenants_key)
+                deficit = 0
+            elseif deficit <= 0 then
+                redis.call("LMOVE", tenants_key, tenants_key, "LEFT", "RIGHT")
+                deficit = 0
+            end
+            redis.call("HSET", KEYS[2], p, deficit)
+            return task
+        end
+        redis.call("LPOP", tenants_key)
+        redis.call("HSET", KEYS[2], p, 0)
+    end
+end
+return redis.call("LMOVE", ARGV[1], KEYS[1], "LEFT", "RIGHT")
+"""
+
+# move the head of a tenant queue one priority up if it waited long enough
+# KEYS: tenant queue, tenant queue of the higher priority, tenants of the higher priority
+# ARGV: tenant, priority, aging seconds, now
+_PROMOTE_SCRIPT = """
+local head = redis.call("LINDEX", KEYS[1], 0)
+if not head then
+    return 0
+end
+local task = cjson.decode(head)
+local levels = (task.priority or tonumber(ARGV[2])) - tonumber(ARGV[2]) + 1
+local queued_at = task.queued_at or tonumber(ARGV[4])
+if tonumber(ARGV[4]) - queued_at <= tonumber(ARGV[3]) * levels then
+    return 0
+end
+redis.call("LMOVE", KEYS[1], KEYS[2], "LEFT", "RIGHT")
+if not redis.call("LPOS", KEYS[3], ARGV[1]) then
+    redis.call("RPUSH", KEYS[3], ARGV[1])
+end
+return 1
+"""
+
 
 class RedisTaskManager(TaskManager):
-    def __init__(self, max_concurrent_tasks: int, redis_url: str):
+    """
+    With standalone_workers, the api nodes only push the tasks to redis, and
+    they are run by any number of worker processes (see worker.py) popping
+    them from the queue, so the tasks survive a restart of the api and every
+    node takes its share of the work.
+
+    A popped task is moved atomically to a processing list and stays there,
+    with a heartbeat refreshed by the worker running it, until it is done. A
+    task whose heartbeat is older than visibility_timeout, because its worker
+    or worker process died, is put back to the queue, or to the dead letter
+    list after max_attempts.
+
+    The queue is split by priority and tenant, and served like FairQueue,
+    with the scheduling done by lua scripts so all the nodes share it.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_tasks: int,
+        redis_url: str,
+        standalone_workers: bool = False,
+        visibility_timeout: int = 300,
+        max_attempts: int = 3,
+        tenant_weights: Optional[Dict[str, int]] = None,
+        aging: float = 300,
+        **kwargs,
+    ):
         self.redis_client = redis.Redis.from_url(redis_url)
-        super().__init__(max_concurrent_tasks)
+        self.standalone_workers = standalone_workers
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.tenant_weights = tenant_weights or {}
+        self.aging = aging
+        self._enqueue_script = self.redis_client.register_script(_ENQUEUE_SCRIPT)
+        self._pop_script = self.redis_client.register_script(_POP_SCRIPT)
+        self._promote_script = self.redis_client.register_script(_PROMOTE_SCRIPT)
+        # tasks of this node being run, by id
+        self.in_flight: Dict[str, bytes] = {}
+        self._heartbeat_thread = None
+        # when a task without heartbeat was first seen in the processing list
+        self._unclaimed: Dict[str, float] = {}
+        super().__init__(max_concurrent_tasks, **kwargs)
 
     def create_queue(self):
         return "task_queue"
 
+    @property
+    def processing_key(self):
+        return f"{self.queue}:processing"
+
+    @property
+    def heartbeats_key(self):
+        return f"{self.queue}:heartbeats"
+
+    @property
+    def dead_key(self):
+        return f"{self.queue}:dead"
+
+    @property
+    def metrics_key(self):
+        return f"{self.queue}:metrics"
+
+    @property
+    def durations_key(self):
+        return f"{self.queue}:durations"
+
+    @property
+    def workers_key(self):
+        return f"{self.queue}:workers"
+
+    @property
+    def signal_key(self):
+        return f"{self.queue}:signal"
+
+    def tenant_queue_key(self, priority: int, tenant: str):
+        return f"{self.queue}:p{priority}:{tenant}"
+
+    def tenants_key(self, priority: int):
+        return f"{self.queue}:tenants:p{priority}"
+
+    def add_task(
+        self,
+        func: Callable,
+        *args: Any,
+        priority: int = const.TASK_PRIORITY_NORMAL,
+        tenant: str = "",
+        **kwargs: Any,
+    ):
+        # every task goes through the queue, so it is redelivered if the
+        # process running it dies
+        print(f"enqueue task: {func.__name__}, current_tasks: {self.current_tasks}")
+        self.enqueue(
+            {
+                "func": func,
+                "args": args,
+                "kwargs": kwargs,
+                "priority": priority,
+                "tenant": tenant,
+            }
+        )
+        self.check_queue()
+
+    def start(self):
+        """
+        Start the heartbeat, which redelivers the tasks of crashed nodes, and
+        run the tasks queued while the api was down.
+        """
+        # the workers do it themselves
+        if self.standalone_workers:
+            return
+        self._start_heartbeat()
+        self.check_queue()
+
+    def check_queue(self):
+        # the workers pop the tasks themselves
+        if self.standalone_workers:
+            return
+        with self.lock:
+            # fill all the free slots, several tasks may have been queued at once
+            while self.current_tasks < self.max_concurrent_tasks:
+                raw = self.pop()
+                if not raw:
+                    break
+                self.execute_queued(raw)
+
     def enqueue(self, task: Dict):
         task_with_serializable_params = task.copy()
+        task_with_serializable_params["kwargs"] = task["kwargs"].copy()
 
-        if "params" in task["kwargs"] and isinstance(
-            task["kwargs"]["params"], VideoParams
-        ):
-            task_with_serializable_params["kwargs"]["params"] = task["kwargs"][
-                "params"
-            ].dict()
+        params = task["kwargs"].get("params")
+        if isinstance(params, BaseModel):
+            task_with_serializable_params["kwargs"]["params"] = params.model_dump(
+                mode="json", warnings=False
+            )
+            # audio and subtitle requests are not VideoParams
+            task_with_serializable_params["params_type"] = type(params).__name__
 
         # 将函数对象转换为其名称
         task_with_serializable_params["func"] = task["func"].__name__
-        self.redis_client.rpush(self.queue, json.dumps(task_with_serializable_params))
+        task_with_serializable_params.setdefault("id", uuid.uuid4().hex)
+        task_with_serializable_params.setdefault("attempts", 0)
+        self.push(task_with_serializable_params)
+
+    def push(self, task: Dict, front: bool = False):
+        priority = clamp_priority(task.get("priority", const.TASK_PRIORITY_NORMAL))
+        tenant = task.get("tenant", "")
+        task["priority"] = priority
+        task.setdefault("queued_at", time.time())
+        self._enqueue_script(
+            keys=[
+                self.tenant_queue_key(priority, tenant),
+                self.tenants_key(priority),
+                self.signal_key,
+            ],
+            args=[json.dumps(task), tenant, "1" if front else "0"],
+        )
+
+    def pop(self) -> Optional[bytes]:
+        """
+        Move the next task to the processing list and return it, tasks queued
+        by older versions in the plain queue list come last.
+        """
+        return self._pop_script(
+            keys=[self.processing_key, f"{self.queue}:deficits"],
+            args=[self.queue, json.dumps(self.tenant_weights), *PRIORITIES],
+        )
+
+    def promote_aged(self):
+        if self.aging <= 0:
+            return
+        now = time.time()
+        # from the lowest priority, so a task can move up several priorities at once
+        for priority in reversed(PRIORITIES[1:]):
+            for tenant in self.redis_client.lrange(self.tenants_key(priority), 0, -1):
+                tenant = tenant.decode("utf-8")
+                while self._promote_script(
+                    keys=[
+                        self.tenant_queue_key(priority, tenant),
+                        self.tenant_queue_key(priority - 1, tenant),
+                        self.tenants_key(priority - 1),
+                    ],
+                    args=[tenant, priority, self.aging, now],
+                ):
+                    pass
+
+    @staticmethod
+    def decode(task_json) -> Dict:
+        task_info = json.loads(task_json)
+        # 将函数名称转换回函数对象
+        task_info["func"] = FUNC_MAP[task_info["func"]]
+
+        if "params" in task_info["kwargs"] and isinstance(
+            task_info["kwargs"]["params"], dict
+        ):
+            params_type = getattr(
+                schema, task_info.pop("params_type", ""), schema.VideoParams
+            )
+            task_info["kwargs"]["params"] = params_type(**task_info["kwargs"]["params"])
+
+        return task_info
 
     def dequeue(self):
-        task_json = self.redis_client.lpop(self.queue)
+        task_json = self.pop()
         if task_json:
-            task_info = json.loads(task_json)
-            # 将函数名称转换回函数对象
-            task_info["func"] = FUNC_MAP[task_info["func"]]
-
-            if "params" in task_info["kwargs"] and isinstance(
-                task_info["kwargs"]["params"], dict
-            ):
-                task_info["kwargs"]["params"] = VideoParams(
-                    **task_info["kwargs"]["params"]
-                )
-
-            return task_info
+            return self.decode(task_json)
         return None
 
+    def queued(self) -> int:
+        pipe = self.redis_client.pipeline()
+        for priority in PRIORITIES:
+            for tenant in self.redis_client.lrange(self.tenants_key(priority), 0, -1):
+                pipe.llen(self.tenant_queue_key(priority, tenant.decode("utf-8")))
+        pipe.llen(self.queue)
+        return sum(pipe.execute())
+
     def is_queue_empty(self):
-        return self.redis_client.llen(self.queue) == 0
+        return self.queued() == 0
+
+    def execute_queued(self, raw: bytes):
+        """
+        Run a task moved to the processing list, must be called with the lock held.
+        """
+        item_id = json.loads(raw).get("id", "")
+        self.redis_client.hset(self.heartbeats_key, item_id, time.time())
+        self.in_flight[item_id] = raw
+        self.current_tasks += 1
+        self._start_heartbeat()
+        thread = threading.Thread(target=self.run_queued, args=(item_id, raw))
+        thread.start()
+
+    def run_queued(self, item_id: str, raw: bytes):
+        started = time.time()
+        try:
+            task_info = self.decode(raw)
+            logger.info(f"run task: {task_info['kwargs'].get('task_id')}, id: {item_id}")
+            self.call(
+                task_info["func"],
+                *task_info.get("args", ()),
+                **task_info.get("kwargs", {}),
+            )
+            task_id = task_info["kwargs"].get("task_id")
+            if cancellation.is_cancelled(task_id):
+                self.ack(item_id, raw, outcome="cancelled")
+            else:
+                self.ack(item_id, raw)
+                self.record_duration(
+                    task_info["kwargs"].get("stop_at", "video"), time.time() - started
+                )
+        except BrokenProcessPool as e:
+            # the worker process died, most likely killed for memory, try again
+            logger.error(f"worker process of task {item_id} died: {str(e)}")
+            self.retry(raw)
+        except Exception as e:
+            # the task failed by itself, running it again wouldn't help
+            logger.exception(f"task {item_id} failed: {str(e)}")
+            self.ack(item_id, raw, outcome="failed")
+        finally:
+            with self.lock:
+                self.in_flight.pop(item_id, None)
+            self.task_done()
+
+    def ack(self, item_id: str, raw: bytes, outcome: str = "completed"):
+        pipe = self.redis_client.pipeline()
+        pipe.lrem(self.processing_key, 1, raw)
+        pipe.hdel(self.heartbeats_key, item_id)
+        pipe.hincrby(self.metrics_key, outcome, 1)
+        pipe.execute()
+
+    def retry(self, raw: bytes):
+        """
+        Put the task back to the queue, or to the dead letter list once it
+        reached max_attempts. Only the caller that removes it from the
+        processing list requeues it.
+        """
+        if not self.redis_client.lrem(self.processing_key, 1, raw):
+            return
+        task = json.loads(raw)
+        self.redis_client.hdel(self.heartbeats_key, task.get("id", ""))
+        task["attempts"] = task.get("attempts", 0) + 1
+        task_id = task.get("kwargs", {}).get("task_id")
+        if task["attempts"] >= self.max_attempts:
+            logger.error(f"task {task_id} failed {task['attempts']} times, moved to {self.dead_key}")
+            self.redis_client.rpush(self.dead_key, json.dumps(task))
+            self.redis_client.hincrby(self.metrics_key, "dead_lettered", 1)
+            if task_id:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+                params = task["kwargs"].get("params") or {}
+                webhook.notify(
+                    params.get("callback_url", ""),
+                    task_id,
+                    const.TASK_STATE_FAILED,
+                    {"error": "the worker process died"},
+                )
+            return
+
+        logger.warning(f"task {task_id} redelivered, attempt {task['attempts'] + 1}")
+        # retried tasks go first, they have waited already
+        self.push(task, front=True)
+        self.redis_client.hincrby(self.metrics_key, "redelivered", 1)
+        self.check_queue()
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat, name="queue-heartbeat", daemon=True
+            )
+            self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        interval = max(1.0, self.visibility_timeout / 3)
+        while True:
+            try:
+                with self.lock:
+                    item_ids = list(self.in_flight)
+                now = time.time()
+                if item_ids:
+                    self.redis_client.hset(
+                        self.heartbeats_key, mapping={i: now for i in item_ids}
+                    )
+                # the capacity of the node, to estimate the time to start
+                self.redis_client.hset(
+                    self.workers_key,
+                    self.worker_id,
+                    json.dumps({"capacity": self.max_concurrent_tasks, "seen": now}),
+                )
+                self.requeue_expired()
+                self.promote_aged()
+            except redis.RedisError as e:
+                logger.warning(f"failed to refresh the queue heartbeat: {str(e)}")
+            time.sleep(interval)
+
+    def requeue_expired(self):
+        """
+        Redeliver the tasks of the processing list whose worker stopped
+        sending heartbeats, the tasks of any node are checked.
+        """
+        now = time.time()
+        heartbeats = self.redis_client.hgetall(self.heartbeats_key)
+        seen = set()
+        for raw in self.redis_client.lrange(self.processing_key, 0, -1):
+            item_id = json.loads(raw).get("id", "")
+            seen.add(item_id)
+            if item_id in self.in_flight:
+                continue
+            heartbeat = heartbeats.get(item_id.encode("utf-8"))
+            if heartbeat is None:
+                # just popped, the heartbeat follows the move
+                heartbeat = self._unclaimed.setdefault(item_id, now)
+            if now - float(heartbeat) > self.visibility_timeout:
+                self.retry(raw)
+        self._unclaimed = {k: v for k, v in self._unclaimed.items() if k in seen}
+
+    def record_duration(self, kind: str, seconds: float):
+        # shared by all the nodes, a concurrent update may be lost, which
+        # doesn't matter for an average
+        average = self.redis_client.hget(self.durations_key, kind)
+        average = float(average) if average else seconds
+        average += (seconds - average) * DURATION_SMOOTHING
+        self.redis_client.hset(self.durations_key, kind, average)
+
+    def get_durations(self) -> Dict[str, float]:
+        return {
+            k.decode("utf-8"): float(v)
+            for k, v in self.redis_client.hgetall(self.durations_key).items()
+        }
+
+    def running(self) -> int:
+        return self.redis_client.llen(self.processing_key)
+
+    def capacity(self) -> int:
+        """
+        Sum of the capacity of the nodes running tasks, seen recently.
+        """
+        now = time.time()
+        capacity = 0
+        for worker_id, value in self.redis_client.hgetall(self.workers_key).items():
+            worker = json.loads(value)
+            if now - worker["seen"] > self.visibility_timeout:
+                self.redis_client.hdel(self.workers_key, worker_id)
+                continue
+            capacity += worker["capacity"]
+        return capacity or self.max_concurrent_tasks
+
+    def metrics(self) -> Dict:
+        pipe = self.redis_client.pipeline()
+        pipe.llen(self.processing_key)
+        pipe.llen(self.dead_key)
+        pipe.hgetall(self.metrics_key)
+        in_flight, dead, counters = pipe.execute()
+        return {
+            **super().metrics(),
+            "capacity": self.capacity(),
+            "in_flight": in_flight,
+            "dead": dead,
+            **{k.decode("utf-8"): int(v) for k, v in counters.items()},
+        }
+
+    def serve(self, poll_timeout: int = 5):
+        """
+        Run the queued tasks forever, max_concurrent_tasks at a time. A task is
+        only popped when a slot is free, so a busy worker leaves it to the others.
+        """
+        logger.info(
+            f"worker started, queue: {self.queue}, max concurrent tasks: {self.max_concurrent_tasks}"
+        )
+        self._start_heartbeat()
+        while True:
+            with self.lock:
+                busy = self.current_tasks >= self.max_concurrent_tasks
+            if busy:
+                time.sleep(0.5)
+                continue
+
+            raw = self.pop()
+            if not raw:
+                # wait for a task to be queued
+                self.redis_client.blpop([self.signal_key], timeout=poll_timeout)
+                continue
+            try:
+                self.decode(raw)
+            except Exception as e:
+                logger.error(f"invalid task in queue: {raw}, error: {str(e)}")
+                self.redis_client.lrem(self.processing_key, 1, raw)
+                self.redis_client.rpush(self.dead_key, raw)
+                continue
+
+            with self.lock:
+                self.execute_queued(raw)
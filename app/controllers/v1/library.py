@@ -0,0 +1,71 @@
+from fastapi import Query, Request
+
+from app.config import config
+from app.controllers import base
+from app.controllers.v1.base import new_router
+from app.models.exception import HttpException
+from app.models.schema import (
+    BaseResponse,
+    LibraryMaterialsResponse,
+    LibraryScanRequest,
+    LibraryTagRequest,
+)
+from app.services.library import library
+from app.utils import utils
+
+# authentication dependency
+# router = new_router(dependencies=[Depends(base.verify_token)])
+router = new_router()
+
+
+@router.post(
+    "/library/scan",
+    response_model=BaseResponse,
+    summary="Index the local material library in the background",
+)
+def scan_library(request: Request, body: LibraryScanRequest):
+    request_id = base.get_task_id(request)
+    directory = body.directory or config.app.get("material_library_dir", "")
+    if not directory:
+        raise HttpException(
+            task_id="",
+            status_code=400,
+            message=f"{request_id}: directory is required, or set material_library_dir in config.toml",
+        )
+
+    utils.run_in_background(library.scan, directory, thumbnails=body.thumbnails)
+    return utils.get_response(200, {"directory": directory})
+
+
+@router.get(
+    "/library/materials",
+    response_model=LibraryMaterialsResponse,
+    summary="Search the local material library by tag or file name",
+)
+def search_library(
+    request: Request,
+    tag: list[str] = Query(None),
+    q: str = Query(""),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=1000),
+):
+    materials = library.search(
+        tags=tag, query=q, limit=page_size, offset=(page - 1) * page_size
+    )
+    response = {"materials": materials, "page": page, "page_size": page_size}
+    return utils.get_response(200, response)
+
+
+@router.put(
+    "/library/tags",
+    response_model=BaseResponse,
+    summary="Replace the tags of a material",
+)
+def set_library_tags(request: Request, body: LibraryTagRequest):
+    request_id = base.get_task_id(request)
+    if not library.get(body.path):
+        raise HttpException(
+            task_id="", status_code=404, message=f"{request_id}: material not found"
+        )
+    library.set_tags(body.path, body.tags)
+    return utils.get_response(200)
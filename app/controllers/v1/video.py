@@ -1,19 +1,23 @@
+import asyncio
 import glob
+import json
 import os
 import pathlib
 import shutil
-from typing import Union
+from typing import List, Optional, Union
 
 from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
 from fastapi.params import File
 from fastapi.responses import FileResponse, StreamingResponse
 from loguru import logger
+from starlette.concurrency import run_in_threadpool
 
 from app.config import config
 from app.controllers import base
 from app.controllers.manager.memory_manager import InMemoryTaskManager
 from app.controllers.manager.redis_manager import RedisTaskManager
 from app.controllers.v1.base import new_router
+from app.models import const
 from app.models.exception import HttpException
 from app.models.schema import (
     AudioRequest,
@@ -23,9 +27,14 @@ from app.models.schema import (
     TaskDeletionResponse,
     TaskQueryRequest,
     TaskQueryResponse,
+    TaskQueueResponse,
     TaskResponse,
     TaskVideoRequest,
+    VideoBatchQueryResponse,
+    VideoBatchRequest,
+    VideoBatchResponse,
 )
+from app.services import batch, cancellation, events, idempotency
 from app.services import state as sm
 from app.services import task as tm
 from app.utils import utils
@@ -40,15 +49,35 @@ _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
 _max_concurrent_tasks = config.app.get("max_concurrent_tasks", 5)
+_task_worker_backend = config.app.get("task_worker_backend", "thread")
+_task_worker_max_tasks = config.app.get("task_worker_max_tasks_per_child", 10)
+_max_queued_tasks = config.app.get("max_queued_tasks", 100)
+_max_time_to_start = config.app.get("max_time_to_start", 0)
 
 redis_url = f"redis://:{_redis_password}@{_redis_host}:{_redis_port}/{_redis_db}"
 # 根据配置选择合适的任务管理器
 if _enable_redis:
     task_manager = RedisTaskManager(
-        max_concurrent_tasks=_max_concurrent_tasks, redis_url=redis_url
+        max_concurrent_tasks=_max_concurrent_tasks,
+        redis_url=redis_url,
+        standalone_workers=config.app.get("redis_standalone_workers", False),
+        visibility_timeout=config.app.get("redis_visibility_timeout", 300),
+        max_attempts=config.app.get("redis_max_attempts", 3),
+        tenant_weights=config.app.get("tenant_weights", {}),
+        aging=config.app.get("task_aging_seconds", 300),
+        max_queued_tasks=_max_queued_tasks,
+        max_time_to_start=_max_time_to_start,
+        worker_backend=_task_worker_backend,
+        max_tasks_per_child=_task_worker_max_tasks,
     )
 else:
-    task_manager = InMemoryTaskManager(max_concurrent_tasks=_max_concurrent_tasks)
+    task_manager = InMemoryTaskManager(
+        max_concurrent_tasks=_max_concurrent_tasks,
+        worker_backend=_task_worker_backend,
+        max_tasks_per_child=_task_worker_max_tasks,
+        max_queued_tasks=_max_queued_tasks,
+        max_time_to_start=_max_time_to_start,
+    )
 
 
 @router.post("/videos", response_model=TaskResponse, summary="Generate a short video")
@@ -62,34 +91,157 @@ def create_video(
 def create_subtitle(
     background_tasks: BackgroundTasks, request: Request, body: SubtitleRequest
 ):
-    return create_task(request, body, stop_at="subtitle")
+    # previews are waited for in the webui, they go before the videos
+    return create_task(
+        request, body, stop_at="subtitle", priority=const.TASK_PRIORITY_HIGH
+    )
 
 
 @router.post("/audio", response_model=TaskResponse, summary="Generate audio only")
 def create_audio(
     background_tasks: BackgroundTasks, request: Request, body: AudioRequest
 ):
-    return create_task(request, body, stop_at="audio")
+    return create_task(
+        request, body, stop_at="audio", priority=const.TASK_PRIORITY_HIGH
+    )
+
+
+@router.post(
+    "/videos/batch",
+    response_model=VideoBatchResponse,
+    summary="Generate several short videos at once",
+)
+def create_video_batch(request: Request, body: VideoBatchRequest):
+    request_id = base.get_task_id(request)
+    if body.items:
+        items = body.items
+    elif body.template and body.subjects:
+        items = [
+            body.template.model_copy(update={"video_subject": subject})
+            for subject in body.subjects
+        ]
+    else:
+        raise HttpException(
+            task_id="",
+            status_code=400,
+            message=f"{request_id}: items, or template and subjects, are required",
+        )
+    max_batch_size = config.app.get("max_batch_size", 100)
+    if len(items) > max_batch_size:
+        raise HttpException(
+            task_id="",
+            status_code=400,
+            message=f"{request_id}: at most {max_batch_size} videos per batch",
+        )
+    check_saturation(request_id, incoming=len(items))
+
+    # the items are queued one after the other with the same tenant, so they
+    # run together and share the search results and downloads, and low
+    # priority by default, so they don't delay the single videos
+    batch_id = utils.get_uuid()
+    tenant = base.get_tenant(request)
+    priority = base.get_task_priority(request, const.TASK_PRIORITY_LOW)
+    task_ids = [utils.get_uuid() for _ in items]
+    batch.create(batch_id, task_ids)
+    for task_id, item in zip(task_ids, items):
+        sm.state.update_task(task_id)
+        task_manager.add_task(
+            tm.start,
+            task_id=task_id,
+            params=item,
+            stop_at="video",
+            priority=priority,
+            tenant=tenant,
+        )
+    logger.success(f"Batch created: {batch_id}, {len(task_ids)} videos")
+    return utils.get_response(200, {"batch_id": batch_id, "task_ids": task_ids})
+
+
+@router.get(
+    "/videos/batch/{batch_id}",
+    response_model=VideoBatchQueryResponse,
+    summary="Query the progress of a batch of videos",
+)
+def get_video_batch(request: Request, batch_id: str = Path(..., description="Batch ID")):
+    request_id = base.get_task_id(request)
+    status = batch.status(batch_id)
+    if not status:
+        raise HttpException(
+            task_id=batch_id, status_code=404, message=f"{request_id}: batch not found"
+        )
+    return utils.get_response(200, status)
+
+
+def check_saturation(request_id: str, incoming: int = 1):
+    """
+    Refuse new tasks when the queue is full, or they would wait too long to
+    start, so the clients can retry later or go elsewhere.
+    """
+    retry_after = task_manager.check_saturation(incoming)
+    if retry_after is None:
+        return
+    raise HttpException(
+        task_id="",
+        status_code=429,
+        message=f"{request_id}: too many tasks queued, retry after {retry_after}s",
+        data={"retry_after": retry_after, "queued": task_manager.queued()},
+        headers={"Retry-After": str(retry_after)},
+    )
 
 
 def create_task(
     request: Request,
     body: Union[TaskVideoRequest, SubtitleRequest, AudioRequest],
     stop_at: str,
+    priority: int = const.TASK_PRIORITY_NORMAL,
 ):
     task_id = utils.get_uuid()
     request_id = base.get_task_id(request)
+    tenant = base.get_tenant(request)
+    # the state exists before the key is claimed, so a repeated submission
+    # arriving meanwhile sees the task alive
+    sm.state.update_task(task_id)
+    try:
+        existing_id, existing = idempotency.claim(
+            task_id, body, stop_at, tenant, base.get_idempotency_key(request)
+        )
+    except idempotency.IdempotencyConflict as e:
+        sm.state.delete_task(task_id)
+        raise HttpException(
+            task_id="", status_code=422, message=f"{request_id}: {str(e)}"
+        )
+    if existing:
+        sm.state.delete_task(task_id)
+        # a repeated submission gets the task already running or completed
+        task = {"task_id": existing_id, "request_id": request_id, "deduplicated": True}
+        logger.info(f"Task reused: {utils.to_json(task)}")
+        return utils.get_response(200, task)
+
+    try:
+        check_saturation(request_id)
+    except HttpException:
+        # never started, a retry with the same idempotency key takes the key over
+        sm.state.delete_task(task_id)
+        raise
     try:
         task = {
             "task_id": task_id,
             "request_id": request_id,
             "params": body.model_dump(),
         }
-        sm.state.update_task(task_id)
-        task_manager.add_task(tm.start, task_id=task_id, params=body, stop_at=stop_at)
+        task_manager.add_task(
+            tm.start,
+            task_id=task_id,
+            params=body,
+            stop_at=stop_at,
+            priority=base.get_task_priority(request, priority),
+            tenant=tenant,
+        )
         logger.success(f"Task created: {utils.to_json(task)}")
         return utils.get_response(200, task)
     except ValueError as e:
+        # so a retry with the same idempotency key doesn't attach to it
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         raise HttpException(
             task_id=task_id, status_code=400, message=f"{request_id}: {str(e)}"
         )
@@ -97,9 +249,18 @@ def create_task(
 from fastapi import Query
 
 @router.get("/tasks", response_model=TaskQueryResponse, summary="Get all tasks")
-def get_all_tasks(request: Request, page: int = Query(1, ge=1), page_size: int = Query(10, ge=1)):
+def get_all_tasks(
+    request: Request,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1),
+    state: Optional[int] = Query(None, description="Only the tasks in this state"),
+    since: Optional[float] = Query(None, description="Only the tasks created after this timestamp"),
+    until: Optional[float] = Query(None, description="Only the tasks created before this timestamp"),
+):
     request_id = base.get_task_id(request)
-    tasks, total = sm.state.get_all_tasks(page, page_size)
+    tasks, total = sm.state.get_all_tasks(
+        page, page_size, state=state, since=since, until=until
+    )
 
     response = {
         "tasks": tasks,
@@ -119,41 +280,193 @@ def get_task(
     task_id: str = Path(..., description="Task ID"),
     query: TaskQueryRequest = Depends(),
 ):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if task:
+        return utils.get_response(200, task_to_response(request, task))
+
+    raise HttpException(
+        task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+    )
+
+
+def task_to_response(request: Request, task: dict) -> dict:
+    """
+    A copy of the task with the urls of its videos instead of their paths.
+    """
     endpoint = config.app.get("endpoint", "")
     if not endpoint:
         endpoint = str(request.base_url)
     endpoint = endpoint.rstrip("/")
+    task_dir = utils.task_dir()
+
+    def file_to_uri(file):
+        if not file.startswith(endpoint):
+            _uri_path = file.replace(task_dir, "tasks").replace("\\", "/")
+            _uri_path = f"{endpoint}/{_uri_path}"
+        else:
+            _uri_path = file
+        return _uri_path
+
+    task = dict(task)
+    for key in ("videos", "combined_videos"):
+        if isinstance(task.get(key), list):
+            task[key] = [file_to_uri(v) for v in task[key]]
+    return task
+
+
+# seconds between two comments sent to keep idle connections open
+EVENTS_KEEPALIVE = 15
+
+
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+
+async def stream_events(request: Request, task_ids: List[str]):
+    """
+    Send the current state of the tasks, then every update, until all of
+    them are finished or deleted, or the client disconnects.
+    """
+    pending = set(task_ids)
+    # subscribed before reading the current state, so no update is missed
+    async with events.bus.subscribe(task_ids) as updates:
+        for task_id in task_ids:
+            task = await run_in_threadpool(sm.state.get_task, task_id)
+            if not task:
+                pending.discard(task_id)
+                yield format_event("deleted", {"task_id": task_id})
+                continue
+            yield format_event("task", task_to_response(request, task))
+            if task.get("state") in sm.FINISHED_STATES:
+                pending.discard(task_id)
+
+        while pending:
+            if await request.is_disconnected():
+                break
+            try:
+                update = await asyncio.wait_for(updates.get(), timeout=EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            task_id = update.get("task_id")
+            if update.get("deleted"):
+                pending.discard(task_id)
+                yield format_event("deleted", {"task_id": task_id})
+                continue
+            yield format_event("task", task_to_response(request, update))
+            if update.get("state") in sm.FINISHED_STATES:
+                pending.discard(task_id)
+
+
+def events_response(request: Request, task_ids: List[str]) -> StreamingResponse:
+    return StreamingResponse(
+        stream_events(request, task_ids),
+        media_type="text/event-stream",
+        # no caching or buffering by the proxies, the events are sent as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/tasks/{task_id}/events", summary="Stream the state and progress of a task"
+)
+def get_task_events(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    if not sm.state.get_task(task_id):
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    return events_response(request, [task_id])
+
+
+@router.get("/events", summary="Stream the state and progress of several tasks")
+def get_events(
+    request: Request,
+    task_ids: str = Query("", description="Comma separated task IDs"),
+    batch_id: str = Query("", description="Batch ID, for all the tasks of the batch"),
+):
+    request_id = base.get_task_id(request)
+    ids = [task_id.strip() for task_id in task_ids.split(",") if task_id.strip()]
+    if batch_id:
+        status = batch.status(batch_id)
+        if not status:
+            raise HttpException(
+                task_id=batch_id, status_code=404, message=f"{request_id}: batch not found"
+            )
+        ids.extend(task["task_id"] for task in status["tasks"])
+    if not ids:
+        raise HttpException(
+            task_id="", status_code=400, message=f"{request_id}: task_ids or batch_id is required"
+        )
+    return events_response(request, list(dict.fromkeys(ids)))
 
+
+@router.get(
+    "/queue", response_model=TaskQueueResponse, summary="Get the task queue metrics"
+)
+def get_queue_metrics(request: Request):
+    return utils.get_response(200, task_manager.metrics())
+
+
+@router.post(
+    "/tasks/{task_id}/resume",
+    response_model=TaskResponse,
+    summary="Resume a failed task from its last valid stage",
+)
+def resume_task(request: Request, task_id: str = Path(..., description="Task ID")):
     request_id = base.get_task_id(request)
     task = sm.state.get_task(task_id)
-    if task:
-        task_dir = utils.task_dir()
-
-        def file_to_uri(file):
-            if not file.startswith(endpoint):
-                _uri_path = v.replace(task_dir, "tasks").replace("\\", "/")
-                _uri_path = f"{endpoint}/{_uri_path}"
-            else:
-                _uri_path = file
-            return _uri_path
-
-        if "videos" in task:
-            videos = task["videos"]
-            urls = []
-            for v in videos:
-                urls.append(file_to_uri(v))
-            task["videos"] = urls
-        if "combined_videos" in task:
-            combined_videos = task["combined_videos"]
-            urls = []
-            for v in combined_videos:
-                urls.append(file_to_uri(v))
-            task["combined_videos"] = urls
-        return utils.get_response(200, task)
+    params, stop_at = tm.load_checkpoint(task_id)
+    if not task or params is None:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    if task.get("state") == const.TASK_STATE_PROCESSING:
+        raise HttpException(
+            task_id=task_id,
+            status_code=409,
+            message=f"{request_id}: task is still processing",
+        )
 
-    raise HttpException(
-        task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+    cancellation.clear(task_id)
+    sm.state.update_task(task_id)
+    task_manager.add_task(
+        tm.start,
+        task_id=task_id,
+        params=params,
+        stop_at=stop_at,
+        priority=base.get_task_priority(request),
+        tenant=base.get_tenant(request),
     )
+    logger.success(f"Task resumed: {task_id}, stop_at: {stop_at}")
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
+
+
+@router.post(
+    "/tasks/{task_id}/cancel",
+    response_model=TaskResponse,
+    summary="Cancel a queued or running task",
+)
+def cancel_task(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if not task:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    if task.get("state") in (const.TASK_STATE_COMPLETE, const.TASK_STATE_FAILED):
+        raise HttpException(
+            task_id=task_id,
+            status_code=409,
+            message=f"{request_id}: task is already finished",
+        )
+
+    # a queued task stops when it is dequeued, a running one at the next
+    # check of its stages, its slot is released right away
+    cancellation.cancel(task_id)
+    sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED)
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
 
 
 @router.delete(
@@ -165,6 +478,9 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     request_id = base.get_task_id(request)
     task = sm.state.get_task(task_id)
     if task:
+        if task.get("state") == const.TASK_STATE_PROCESSING:
+            # stop the task before removing its files
+            cancellation.cancel(task_id)
         tasks_dir = utils.task_dir()
         current_task_dir = os.path.join(tasks_dir, task_id)
         if os.path.exists(current_task_dir):
@@ -20,6 +20,11 @@ PUNCTUATIONS = [
 TASK_STATE_FAILED = -1
 TASK_STATE_COMPLETE = 1
 TASK_STATE_PROCESSING = 4
+TASK_STATE_CANCELLED = -2
+
+TASK_PRIORITY_HIGH = 0
+TASK_PRIORITY_NORMAL = 1
+TASK_PRIORITY_LOW = 2
 
 FILE_TYPE_VIDEOS = ["mp4", "mov", "mkv", "webm"]
 FILE_TYPE_IMAGES = ["jpg", "jpeg", "png", "bmp"]
@@ -51,6 +51,7 @@ class MaterialInfo:
     provider: str = "pexels"
     url: str = ""
     duration: int = 0
+    video_id: str = ""  # id of the video at the provider, shared by all its renditions
 
 
 class VideoParams(BaseModel):
@@ -104,6 +105,8 @@ class VideoParams(BaseModel):
     stroke_width: float = 1.5
     n_threads: Optional[int] = 8
     paragraph_number: Optional[int] = 1
+    # POSTed a json payload when the task completes or fails
+    callback_url: Optional[str] = ""
 
 
 class SubtitleRequest(BaseModel):
@@ -138,6 +141,16 @@ class AudioRequest(BaseModel):
     video_source: Optional[str] = "local"
 
 
+class LibraryScanRequest(BaseModel):
+    directory: Optional[str] = ""  # defaults to material_library_dir in config.toml
+    thumbnails: Optional[bool] = True
+
+
+class LibraryTagRequest(BaseModel):
+    path: str
+    tags: List[str] = []
+
+
 class VideoScriptParams:
     """
     {
@@ -178,6 +191,17 @@ class TaskVideoRequest(VideoParams, BaseModel):
     pass
 
 
+class VideoBatchRequest(BaseModel):
+    """
+    Either the requests of the videos, or one template request and the
+    subjects of the videos made from it.
+    """
+
+    items: Optional[List[TaskVideoRequest]] = None
+    template: Optional[TaskVideoRequest] = None
+    subjects: Optional[List[str]] = None
+
+
 class TaskQueryRequest(BaseModel):
     pass
 
@@ -197,6 +221,8 @@ class VideoTermsRequest(VideoTermsParams, BaseModel):
 class TaskResponse(BaseResponse):
     class TaskResponseData(BaseModel):
         task_id: str
+        # the task of an earlier submission with the same idempotency key
+        deduplicated: bool = False
 
     data: TaskResponseData
 
@@ -230,6 +256,26 @@ class TaskQueryResponse(BaseResponse):
         }
 
 
+class TaskQueueResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "running": 2,
+                    "max_concurrent_tasks": 5,
+                    "queued": 3,
+                    "in_flight": 4,
+                    "dead": 0,
+                    "completed": 120,
+                    "failed": 2,
+                    "redelivered": 1,
+                },
+            },
+        }
+
+
 class TaskDeletionResponse(BaseResponse):
     class Config:
         json_schema_extra = {
@@ -293,6 +339,30 @@ class BgmRetrieveResponse(BaseResponse):
         }
 
 
+class LibraryMaterialsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "materials": [
+                        {
+                            "path": "/data/materials/city/night-street.mp4",
+                            "name": "night-street.mp4",
+                            "duration": 12.5,
+                            "width": 1920,
+                            "height": 1080,
+                            "fps": 29.97,
+                            "thumbnail": "/MoneyPrinterTurbo/storage/library/thumbnails/5d41402abc4b2a76b9719d911017c592.jpg",
+                            "tags": ["city"],
+                        }
+                    ]
+                },
+            },
+        }
+
+
 class BgmUploadResponse(BaseResponse):
     class Config:
         json_schema_extra = {
@@ -302,3 +372,48 @@ class BgmUploadResponse(BaseResponse):
                 "data": {"file": "/MoneyPrinterTurbo/resource/songs/example.mp3"},
             },
         }
+
+
+class VideoBatchResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "batch_id": "0b2e3cbe-5d2a-4a35-8c1a-8c5e5e1c1f32",
+                    "task_ids": [
+                        "6c85c8cc-a77a-42b9-bc30-947815aa0558",
+                        "b1f0b7a4-5a8e-4c57-9d0d-3f54c5f1c2a9",
+                    ],
+                },
+            },
+        }
+
+
+class VideoBatchQueryResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "batch_id": "0b2e3cbe-5d2a-4a35-8c1a-8c5e5e1c1f32",
+                    "total": 2,
+                    "progress": 50,
+                    "states": {"complete": 1, "processing": 1},
+                    "tasks": [
+                        {
+                            "task_id": "6c85c8cc-a77a-42b9-bc30-947815aa0558",
+                            "state": 1,
+                            "progress": 100,
+                        },
+                        {
+                            "task_id": "b1f0b7a4-5a8e-4c57-9d0d-3f54c5f1c2a9",
+                            "state": 4,
+                            "progress": 0,
+                        },
+                    ],
+                },
+            },
+        }
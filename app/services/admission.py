@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from typing import Dict, Optional
+
+from loguru import logger
+
+from app.config import config
+
+RESOURCE_LLM = "llm"
+RESOURCE_TTS = "tts"
+RESOURCE_DOWNLOAD = "download"
+RESOURCE_WHISPER = "whisper"
+RESOURCE_RENDER = "render"
+RESOURCE_CPU_THREADS = "cpu_threads"
+RESOURCE_MEMORY_MB = "memory_mb"
+
+DEFAULT_BUDGETS = {
+    RESOURCE_LLM: 8,
+    RESOURCE_TTS: 4,
+    RESOURCE_DOWNLOAD: 4,
+    RESOURCE_WHISPER: 1,
+    RESOURCE_RENDER: 2,
+    RESOURCE_CPU_THREADS: os.cpu_count() or 4,
+    # 0 means unlimited
+    RESOURCE_MEMORY_MB: 0,
+}
+
+
+class AdmissionController:
+    """
+    Budgets of the resources used by the stages of all the tasks of the node.
+
+    A stage asks for all the resources it needs at once, e.g. a render asks
+    for one render slot, its threads and its memory, and waits until all of
+    them are available, so it never holds a part of them while waiting. A
+    demand larger than a budget is reduced to the budget, so it still runs,
+    alone.
+    """
+
+    def __init__(self, budgets: Dict[str, int]):
+        self.budgets = {k: int(v) for k, v in budgets.items()}
+        self.in_use = {k: 0 for k in self.budgets}
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _normalize(self, demand: Dict[str, int]) -> Dict[str, int]:
+        result = {}
+        for resource, amount in demand.items():
+            budget = self.budgets.get(resource, 0)
+            # resources without budget are not limited
+            if budget > 0 and amount > 0:
+                result[resource] = min(int(amount), budget)
+        return result
+
+    def _available(self, demand: Dict[str, int]) -> bool:
+        return all(self.in_use[r] + a <= self.budgets[r] for r, a in demand.items())
+
+    def acquire(self, demand: Dict[str, int], timeout: Optional[float] = None) -> bool:
+        demand = self._normalize(demand)
+        if not demand:
+            return True
+        with self._condition:
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self._available(demand), timeout):
+                    return False
+            finally:
+                self.waiting -= 1
+            for resource, amount in demand.items():
+                self.in_use[resource] += amount
+        return True
+
+    def release(self, demand: Dict[str, int]):
+        demand = self._normalize(demand)
+        if not demand:
+            return
+        with self._condition:
+            for resource, amount in demand.items():
+                self.in_use[resource] = max(0, self.in_use[resource] - amount)
+            self._condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {
+                "budgets": dict(self.budgets),
+                "in_use": dict(self.in_use),
+                "waiting": self.waiting,
+            }
+
+
+def budgets_from_config() -> Dict[str, int]:
+    return {**DEFAULT_BUDGETS, **config.app.get("stage_budgets", {})}
+
+
+controller = AdmissionController(budgets_from_config())
+
+
+@contextmanager
+def admit(demand: Dict[str, int]):
+    """
+    Wait until the demand fits in the budgets and hold it for the block.
+    """
+    started = time.time()
+    controller.acquire(demand)
+    waited = time.time() - started
+    if waited > 1:
+        logger.info(f"admitted after {waited:.1f}s: {demand}")
+    try:
+        yield waited
+    finally:
+        controller.release(demand)
+
+
+class _AdmissionManager(BaseManager):
+    pass
+
+
+def _get_controller():
+    return controller
+
+
+_AdmissionManager.register("controller", callable=_get_controller)
+_manager = None
+
+
+def share(mp_context) -> AdmissionController:
+    """
+    Serve the controller from a manager process, so the budgets are shared by
+    all the worker processes of the node. Returns a proxy of the controller,
+    which is also used by this process from now on.
+    """
+    global controller, _manager
+    # the manager process stops when the manager object is collected
+    _manager = _AdmissionManager(ctx=mp_context)
+    _manager.start()
+    controller = _manager.controller()
+    return controller
+
+
+def use(shared_controller):
+    """
+    Use the controller shared by the parent process, called in worker processes.
+    """
+    global controller
+    controller = shared_controller
@@ -0,0 +1,102 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from app.config import config
+from app.models import const
+from app.services import state as sm
+from app.utils import utils
+
+STATE_NAMES = {
+    const.TASK_STATE_FAILED: "failed",
+    const.TASK_STATE_CANCELLED: "cancelled",
+    const.TASK_STATE_COMPLETE: "complete",
+    const.TASK_STATE_PROCESSING: "processing",
+}
+
+
+# Batches stored as json files, for a single node
+class FileBatches:
+    def __init__(self, batch_dir: str):
+        self.batch_dir = batch_dir
+
+    def _path(self, batch_id: str) -> str:
+        return os.path.join(self.batch_dir, f"{os.path.basename(batch_id)}.json")
+
+    def save(self, batch_id: str, batch: Dict):
+        with open(self._path(batch_id), "w", encoding="utf-8") as f:
+            json.dump(batch, f)
+
+    def load(self, batch_id: str) -> Optional[Dict]:
+        try:
+            with open(self._path(batch_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+# Batches stored in redis, seen by all the api processes
+class RedisBatches:
+    def __init__(self, host="localhost", port=6379, db=0, password=None, ttl=7 * 86400):
+        import redis
+
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self.ttl = ttl
+
+    def save(self, batch_id: str, batch: Dict):
+        self._redis.set(f"task_batch:{batch_id}", json.dumps(batch), ex=self.ttl)
+
+    def load(self, batch_id: str) -> Optional[Dict]:
+        value = self._redis.get(f"task_batch:{batch_id}")
+        return json.loads(value) if value else None
+
+
+if config.app.get("enable_redis", False):
+    batches = RedisBatches(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+else:
+    batches = FileBatches(utils.storage_dir("batches", create=True))
+
+
+def create(batch_id: str, task_ids: List[str], stop_at: str = "video"):
+    batches.save(batch_id, {"batch_id": batch_id, "task_ids": task_ids, "stop_at": stop_at})
+
+
+def status(batch_id: str) -> Optional[Dict]:
+    """
+    The progress of the batch: the state of every task, the number of tasks
+    in each state, and the overall progress. The tasks that no longer exist
+    are counted as finished, in the "unknown" state.
+    """
+    batch = batches.load(batch_id)
+    if not batch:
+        return None
+
+    tasks = []
+    states: Dict[str, int] = {}
+    progress = 0
+    for task_id in batch["task_ids"]:
+        task = sm.state.get_task(task_id)
+        if task is None:
+            # deleted, or evicted once finished, it won't make progress anymore
+            state, task_progress, name = None, 100, "unknown"
+        else:
+            state = task.get("state", const.TASK_STATE_PROCESSING)
+            # a finished task counts as done, whatever its outcome
+            task_progress = 100 if state != const.TASK_STATE_PROCESSING else task.get("progress", 0)
+            name = STATE_NAMES.get(state, str(state))
+        states[name] = states.get(name, 0) + 1
+        progress += task_progress
+        tasks.append({"task_id": task_id, "state": state, "progress": task_progress})
+    total = len(tasks)
+    return {
+        "batch_id": batch_id,
+        "total": total,
+        "progress": int(progress / total) if total else 100,
+        "states": states,
+        "tasks": tasks,
+    }
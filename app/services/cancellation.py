@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Coroutine, Dict, Optional
+
+from loguru import logger
+from proglog import ProgressBarLogger
+
+from app.config import config
+from app.services.runtime import runtime
+from app.utils import utils
+
+# how often a long running loop checks the flag
+CHECK_INTERVAL = 0.5
+
+
+class TaskCancelled(Exception):
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        super().__init__(f"task {task_id} cancelled")
+
+
+# Cancel flags stored as files, seen by all the processes of the node
+class FileFlags:
+    def __init__(self, flag_dir: str):
+        self.flag_dir = flag_dir
+
+    def _path(self, task_id: str) -> str:
+        return os.path.join(self.flag_dir, os.path.basename(task_id))
+
+    def set(self, task_id: str):
+        with open(self._path(task_id), "w") as f:
+            f.write(str(time.time()))
+
+    def is_set(self, task_id: str) -> bool:
+        return os.path.exists(self._path(task_id))
+
+    def clear(self, task_id: str):
+        try:
+            os.remove(self._path(task_id))
+        except OSError:
+            pass
+
+
+# Cancel flags stored in redis, seen by the workers of all the nodes
+class RedisFlags:
+    def __init__(self, host="localhost", port=6379, db=0, password=None, ttl=86400):
+        import redis
+
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self.ttl = ttl
+
+    def set(self, task_id: str):
+        self._redis.set(f"task_cancel:{task_id}", 1, ex=self.ttl)
+
+    def is_set(self, task_id: str) -> bool:
+        return bool(self._redis.exists(f"task_cancel:{task_id}"))
+
+    def clear(self, task_id: str):
+        self._redis.delete(f"task_cancel:{task_id}")
+
+
+if config.app.get("enable_redis", False):
+    flags = RedisFlags(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+else:
+    flags = FileFlags(utils.storage_dir("cancel", create=True))
+
+_local = threading.local()
+_lock = threading.Lock()
+# task id => (checked at, cancelled), so frame loops don't hit the flags every frame
+_checks: Dict[str, tuple] = {}
+
+
+def cancel(task_id: str):
+    flags.set(task_id)
+    logger.info(f"task cancelled: {task_id}")
+
+
+def clear(task_id: str):
+    flags.clear(task_id)
+    forget(task_id)
+
+
+def forget(task_id: str):
+    """
+    Drop the last check of the task in this process, so the next check reads
+    the flag.
+    """
+    with _lock:
+        _checks.pop(task_id, None)
+
+
+def current() -> Optional[str]:
+    """
+    The task the current thread works for, see bind.
+    """
+    return getattr(_local, "task_id", None)
+
+
+@contextmanager
+def bind(task_id: str):
+    """
+    Mark the current thread as working for the task, so the code it runs can
+    check the cancellation without knowing the task.
+    """
+    previous = current()
+    _local.task_id = task_id
+    try:
+        yield
+    finally:
+        _local.task_id = previous
+
+
+def is_cancelled(task_id: Optional[str] = None) -> bool:
+    task_id = task_id or current()
+    if not task_id:
+        return False
+    now = time.time()
+    with _lock:
+        checked_at, cancelled = _checks.get(task_id, (0, False))
+        # the flag is read again after the interval, it may have been cleared
+        # by another process to resume the task
+        if now - checked_at < CHECK_INTERVAL:
+            return cancelled
+    cancelled = flags.is_set(task_id)
+    with _lock:
+        _checks[task_id] = (now, cancelled)
+    return cancelled
+
+
+def check(task_id: Optional[str] = None):
+    """
+    Raise TaskCancelled if the task, by default the one of the current
+    thread, was cancelled.
+    """
+    task_id = task_id or current()
+    if is_cancelled(task_id):
+        raise TaskCancelled(task_id)
+
+
+class CancellableLogger(ProgressBarLogger):
+    """
+    A moviepy progress logger stopping the rendering of a cancelled task,
+    it is called for every frame written.
+    """
+
+    def __init__(self, task_id: str):
+        # don't keep a log of every frame
+        super().__init__(logged_bars=None)
+        self.task_id = task_id
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        check(self.task_id)
+
+
+def progress_logger() -> Optional[CancellableLogger]:
+    """
+    The logger to pass to write_videofile, None when not running for a task.
+    """
+    task_id = current()
+    if not task_id:
+        return None
+    return CancellableLogger(task_id)
+
+
+def run(coro: Coroutine, task_id: Optional[str] = None) -> Any:
+    """
+    Like runtime.run, but the coroutine, e.g. the downloads of the task, is
+    cancelled as soon as the task is cancelled.
+    """
+    task_id = task_id or current()
+    future = runtime.submit(coro)
+    while True:
+        try:
+            return future.result(timeout=CHECK_INTERVAL)
+        except TimeoutError:
+            pass
+        if is_cancelled(task_id):
+            future.cancel()
+            raise TaskCancelled(task_id)
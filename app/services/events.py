@@ -0,0 +1,112 @@
+import asyncio
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Set, Tuple
+
+from loguru import logger
+
+from app.config import config
+
+
+# Delivers the updates of the tasks to the subscribers of this process
+class MemoryBus:
+    def __init__(self):
+        # task id => (loop, queue) of the subscribers
+        self._subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, task_id: str, event: Dict):
+        self._deliver(task_id, event)
+
+    def _deliver(self, task_id: str, event: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(task_id, ()))
+        # called from the threads of the tasks, the queues belong to the loop of the server
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+    @asynccontextmanager
+    async def subscribe(self, task_ids: Iterable[str]):
+        """
+        Queue receiving the updates of the tasks until the block exits.
+        """
+        task_ids = list(task_ids)
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            for task_id in task_ids:
+                self._subscribers.setdefault(task_id, set()).add(subscriber)
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                for task_id in task_ids:
+                    subscribers = self._subscribers.get(task_id)
+                    if subscribers is None:
+                        continue
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[task_id]
+
+
+# Publishes the updates to redis, so the subscribers of every api process
+# receive the updates of the tasks run by any worker
+class RedisBus(MemoryBus):
+    CHANNEL_PREFIX = "task_events:"
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None):
+        import redis
+
+        super().__init__()
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._listener = None
+
+    def publish(self, task_id: str, event: Dict):
+        try:
+            self._redis.publish(
+                f"{self.CHANNEL_PREFIX}{task_id}", json.dumps(event, default=str)
+            )
+        except Exception as e:
+            # the update itself is saved, only the live clients miss it
+            logger.warning(f"failed to publish the update of task {task_id}: {str(e)}")
+
+    def _listen(self):
+        # one connection for all the subscribers of the process
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{self.CHANNEL_PREFIX}*")
+                for message in pubsub.listen():
+                    channel = message["channel"].decode("utf-8")
+                    task_id = channel[len(self.CHANNEL_PREFIX):]
+                    self._deliver(task_id, json.loads(message["data"]))
+            except Exception as e:
+                logger.error(f"task events listener failed, reconnecting: {str(e)}")
+                time.sleep(1)
+
+    @asynccontextmanager
+    async def subscribe(self, task_ids: Iterable[str]):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, name="task-events", daemon=True
+                )
+                self._listener.start()
+        async with super().subscribe(task_ids) as queue:
+            yield queue
+
+
+if config.app.get("enable_redis", False):
+    bus = RedisBus(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+else:
+    bus = MemoryBus()
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from app.config import config
+from app.models import const
+from app.services import state as sm
+
+# the tasks a repeated submission can't attach to, it starts a new one
+_DEAD_STATES = (const.TASK_STATE_FAILED, const.TASK_STATE_CANCELLED)
+
+
+class IdempotencyConflict(Exception):
+    """
+    The idempotency key was already used for a request with other parameters.
+    """
+
+
+# Keys kept in memory, for a single api process
+class MemoryKeys:
+    def __init__(self):
+        # all the keys have the same ttl, so the insertion order is the expiry order
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._keys:
+            key, (_, expires_at) = next(iter(self._keys.items()))
+            if expires_at > now:
+                break
+            del self._keys[key]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            self._expire(time.time())
+            item = self._keys.get(key)
+            return item[0] if item else None
+
+    def set(self, key: str, value: str, ttl: int) -> bool:
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            if key in self._keys:
+                return False
+            self._keys[key] = (value, now + ttl)
+            return True
+
+    def replace(self, key: str, old: str, value: str, ttl: int) -> bool:
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            item = self._keys.get(key)
+            if item is None or item[0] != old:
+                return False
+            del self._keys[key]
+            self._keys[key] = (value, now + ttl)
+            return True
+
+
+# Sets the key only if it still has the old value
+_REPLACE_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
+
+# Keys stored in redis, shared by all the api processes
+class RedisKeys:
+    def __init__(self, host="localhost", port=6379, db=0, password=None):
+        import redis
+
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._replace = self._redis.register_script(_REPLACE_SCRIPT)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._redis.get(f"task_idempotency:{key}")
+        return value.decode("utf-8") if value else None
+
+    def set(self, key: str, value: str, ttl: int) -> bool:
+        return bool(self._redis.set(f"task_idempotency:{key}", value, ex=ttl, nx=True))
+
+    def replace(self, key: str, old: str, value: str, ttl: int) -> bool:
+        return bool(
+            self._replace(keys=[f"task_idempotency:{key}"], args=[old, value, ttl])
+        )
+
+
+if config.app.get("enable_redis", False):
+    keys = RedisKeys(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+else:
+    keys = MemoryKeys()
+
+
+def params_hash(params: BaseModel, stop_at: str) -> str:
+    """
+    Canonical hash of the request: the same parameters in any order, or with
+    their default values omitted, give the same hash.
+    """
+    data = {
+        "type": type(params).__name__,
+        "stop_at": stop_at,
+        "params": params.model_dump(mode="json", warnings=False),
+    }
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _is_alive(task_id: str) -> bool:
+    task = sm.state.get_task(task_id)
+    return bool(task) and task.get("state") not in _DEAD_STATES
+
+
+def claim(
+    task_id: str,
+    params: BaseModel,
+    stop_at: str,
+    tenant: str,
+    idempotency_key: Optional[str] = None,
+) -> Tuple[str, bool]:
+    """
+    Find the task a submission is a repeat of, or record the new task_id for
+    the next ones. Returns the task id to answer with, and whether it's an
+    existing task. The state of the new task must exist before, a task
+    without state is taken as deleted.
+
+    A submission repeats a task with the same idempotency key, or without
+    key, the same parameters when task_dedup_params is enabled, in the last
+    task_dedup_window seconds. A failed, cancelled or deleted task is not
+    reused. Raises IdempotencyConflict when the key was used with other
+    parameters.
+    """
+    window = int(config.app.get("task_dedup_window", 3600))
+    if window <= 0:
+        return task_id, False
+
+    digest = params_hash(params, stop_at)
+    if idempotency_key:
+        key = f"{tenant}:key:{idempotency_key}"
+    elif config.app.get("task_dedup_params", False):
+        key = f"{tenant}:params:{digest}"
+    else:
+        return task_id, False
+
+    value = f"{task_id} {digest}"
+    while not keys.set(key, value, window):
+        existing = keys.get(key)
+        if existing is None:
+            # expired meanwhile
+            continue
+        existing_id, existing_digest = existing.split(" ", 1)
+        if existing_digest != digest:
+            raise IdempotencyConflict(
+                f"idempotency key {idempotency_key} already used with other parameters"
+            )
+        if _is_alive(existing_id):
+            logger.info(f"repeated submission of task {existing_id}")
+            return existing_id, True
+        # the previous task can't be reused, this one takes the key over,
+        # unless a concurrent submission took it first
+        if keys.replace(key, existing, value, window):
+            break
+    return task_id, False
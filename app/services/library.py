@@ -0,0 +1,522 @@
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import ffmpeg
+from loguru import logger
+
+from app.config import config
+from app.models import const
+from app.models.schema import MaterialInfo
+from app.services.utils import video_analysis
+from app.utils import utils
+
+# the materials of the library, scanned or added by the users
+SOURCE_LOCAL = "local"
+# the clips downloaded from the providers, indexed for their analysis only
+SOURCE_DOWNLOAD = "download"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS materials (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL DEFAULT 0,
+    width INTEGER DEFAULT 0,
+    height INTEGER DEFAULT 0,
+    fps REAL DEFAULT 0,
+    thumbnail TEXT DEFAULT '',
+    clip_path TEXT DEFAULT '',
+    clip_duration REAL DEFAULT 0,
+    phash TEXT DEFAULT '',
+    scene_cuts TEXT,
+    sharpness REAL,
+    brightness REAL,
+    motion REAL,
+    letterbox REAL,
+    source TEXT DEFAULT 'local',
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_materials_name ON materials(name);
+CREATE TABLE IF NOT EXISTS material_tags (
+    path TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (path, tag)
+);
+CREATE INDEX IF NOT EXISTS idx_material_tags_tag ON material_tags(tag);
+"""
+
+# columns added after the first release of the index, added to existing databases
+_MIGRATIONS = {
+    "phash": "TEXT DEFAULT ''",
+    "scene_cuts": "TEXT",
+    "sharpness": "REAL",
+    "brightness": "REAL",
+    "motion": "REAL",
+    "letterbox": "REAL",
+    "source": "TEXT DEFAULT 'local'",
+}
+# run once the column is added, so the existing records get their value
+_BACKFILLS = {
+    # the clips downloaded from the providers, named by get_video_path
+    "source": f"UPDATE materials SET source = '{SOURCE_DOWNLOAD}' WHERE name GLOB 'vid-[0-9a-f]*.mp4'",
+}
+# columns stored as JSON
+_JSON_COLUMNS = ["scene_cuts"]
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def probe(file_path: str) -> Dict:
+    """
+    Probe duration, resolution and fps of a video or image file with ffprobe.
+    """
+    info = ffmpeg.probe(file_path)
+    stream = next(
+        (s for s in info.get("streams", []) if s.get("codec_type") == "video"), None
+    )
+    if not stream:
+        raise ValueError(f"no video stream found: {file_path}")
+
+    fps = 0.0
+    rate = stream.get("avg_frame_rate") or stream.get("r_frame_rate") or "0/0"
+    num, _, den = rate.partition("/")
+    if den and float(den) != 0:
+        fps = float(num) / float(den)
+
+    duration = stream.get("duration") or info.get("format", {}).get("duration") or 0
+    if utils.parse_extension(file_path) in const.FILE_TYPE_IMAGES:
+        duration, fps = 0, 0
+    return {
+        "duration": float(duration),
+        "width": int(stream.get("width") or 0),
+        "height": int(stream.get("height") or 0),
+        "fps": round(fps, 3),
+    }
+
+
+def create_thumbnail(file_path: str, duration: float = 0, width: int = 320) -> str:
+    thumbnail_dir = utils.storage_dir("library/thumbnails", create=True)
+    thumbnail = os.path.join(thumbnail_dir, f"{utils.md5(file_path)}.jpg")
+    process = (
+        ffmpeg.input(file_path, ss=min(1.0, duration / 2))
+        .output(thumbnail, vframes=1, vf=f"scale={width}:-2")
+        .global_args("-v", "error")
+        .overwrite_output()
+    )
+    result = subprocess.run(process.compile(), stderr=subprocess.PIPE)
+    if result.returncode != 0 or not os.path.exists(thumbnail):
+        logger.warning(f"failed to create thumbnail: {file_path}")
+        return ""
+    return thumbnail
+
+
+def _scene_detection() -> bool:
+    return config.app.get("material_scene_detection", True)
+
+
+def _quality_check() -> bool:
+    return config.app.get("material_quality_check", True)
+
+
+def _analyze_frames(file_path: str) -> Dict:
+    """
+    Decode the video once at low resolution and run the enabled analyses on
+    the same frames, the sharpness is measured on larger frames.
+    """
+    if not _scene_detection() and not _quality_check():
+        return {}
+    frames = video_analysis.read_frames(file_path)
+    fields = {}
+    if _scene_detection():
+        fields["scene_cuts"] = video_analysis.detect_scene_cuts(frames)
+    if _quality_check():
+        detail_frames = video_analysis.read_detail_frames(file_path)
+        fields.update(video_analysis.quality_scores(frames, detail_frames=detail_frames))
+    return fields
+
+
+def low_quality_reason(record: Optional[Dict]) -> str:
+    """
+    Why the material should not be used, or an empty string if it's fine or
+    hasn't been scored. The thresholds are configurable in config.toml.
+    """
+    if not record or record.get("sharpness") is None or not _quality_check():
+        return ""
+    checks = [
+        ("blurry", record["sharpness"] < config.app.get("material_min_sharpness", 10)),
+        ("too dark", record["brightness"] < config.app.get("material_min_brightness", 20)),
+        ("static", record["motion"] < config.app.get("material_min_motion", 0.3)),
+        ("letterboxed", record["letterbox"] > config.app.get("material_max_letterbox", 0.3)),
+    ]
+    return ", ".join(reason for reason, failed in checks if failed)
+
+
+class MaterialLibrary:
+    """
+    Index of local video materials stored in SQLite.
+
+    Every material is probed once and re-probed only when its mtime or size
+    changes, so tasks with video_source="local" can look up duration,
+    resolution and the converted clip instead of opening every file again.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(_SCHEMA)
+                    columns = {
+                        row["name"] for row in conn.execute("PRAGMA table_info(materials)")
+                    }
+                    for column, definition in _MIGRATIONS.items():
+                        if column not in columns:
+                            conn.execute(f"ALTER TABLE materials ADD COLUMN {column} {definition}")
+                            if column in _BACKFILLS:
+                                conn.execute(_BACKFILLS[column])
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    def _query(self, sql: str, args=()) -> List[Dict]:
+        conn = self._connect()
+        try:
+            records = [dict(row) for row in conn.execute(sql, args).fetchall()]
+        finally:
+            conn.close()
+        for record in records:
+            for column in _JSON_COLUMNS:
+                if record.get(column) is not None:
+                    record[column] = json.loads(record[column])
+        return records
+
+    def _execute(self, sql: str, args=()):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(sql, args)
+        finally:
+            conn.close()
+
+    def _with_tags(self, records: List[Dict]) -> List[Dict]:
+        if not records:
+            return records
+        paths = [r["path"] for r in records]
+        placeholders = ",".join("?" * len(paths))
+        tags = {}
+        for row in self._query(
+            f"SELECT path, tag FROM material_tags WHERE path IN ({placeholders})", paths
+        ):
+            tags.setdefault(row["path"], []).append(row["tag"])
+        for r in records:
+            r["tags"] = sorted(tags.get(r["path"], []))
+        return records
+
+    def get(self, file_path: str) -> Optional[Dict]:
+        """
+        Return the indexed record of the file, or None if the file is not
+        indexed or has changed since it was indexed.
+        """
+        file_path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        rows = self._query("SELECT * FROM materials WHERE path = ?", (file_path,))
+        if not rows:
+            return None
+        record = rows[0]
+        if record["mtime"] != stat.st_mtime or record["size"] != stat.st_size:
+            return None
+        return self._with_tags([record])[0]
+
+    def index_file(
+        self,
+        file_path: str,
+        tags: List[str] = None,
+        thumbnail: bool = False,
+        source: str = SOURCE_LOCAL,
+    ) -> Optional[Dict]:
+        """
+        Probe and analyze the file and upsert its record. Returns None if it
+        can't be probed. Only the materials of the local source are searched
+        and selected for the tasks.
+        """
+        file_path = os.path.abspath(file_path)
+        record = self._probe_record(file_path, thumbnail=thumbnail)
+        if not record:
+            return None
+        record["source"] = source
+        self._save([record], tags={file_path: tags or []})
+        return self.get(file_path)
+
+    def analyze(self, record: Dict, phash: bool = False) -> Dict:
+        """
+        Run the frame analysis that is still missing for the record, store the
+        results in the index and return the updated record.
+        """
+        fields = {}
+        if record["duration"] > 0:
+            if phash and not record.get("phash"):
+                fields["phash"] = video_analysis.perceptual_hash(
+                    record["path"], record["duration"]
+                )
+            if (_scene_detection() and record.get("scene_cuts") is None) or (
+                _quality_check() and record.get("sharpness") is None
+            ):
+                fields.update(_analyze_frames(record["path"]))
+        if fields:
+            self.update(record["path"], **fields)
+            record.update(fields)
+        return record
+
+    def _probe_record(self, file_path: str, thumbnail: bool = False) -> Optional[Dict]:
+        try:
+            stat = os.stat(file_path)
+            info = probe(file_path)
+        except Exception as e:
+            logger.warning(f"failed to probe material: {file_path}, error: {str(e)}")
+            return None
+
+        record = {
+            "path": file_path,
+            "name": os.path.basename(file_path),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "thumbnail": "",
+            "clip_path": "",
+            "clip_duration": 0,
+            "phash": "",
+            "scene_cuts": None,
+            "sharpness": None,
+            "brightness": None,
+            "motion": None,
+            "letterbox": None,
+            "source": SOURCE_LOCAL,
+            "indexed_at": time.time(),
+            **info,
+        }
+        if thumbnail:
+            record["thumbnail"] = create_thumbnail(file_path, info["duration"])
+        if record["duration"] > 0:
+            record.update(_analyze_frames(file_path))
+        return record
+
+    @staticmethod
+    def _encode(record: Dict) -> Dict:
+        return {
+            k: json.dumps(v) if k in _JSON_COLUMNS and v is not None else v
+            for k, v in record.items()
+        }
+
+    def _save(self, records: List[Dict], tags: Dict[str, List[str]] = None):
+        if not records:
+            return
+        columns = list(records[0].keys())
+        sql = (
+            f"INSERT OR REPLACE INTO materials ({','.join(columns)}) "
+            f"VALUES ({','.join('?' * len(columns))})"
+        )
+        conn = self._connect()
+        try:
+            with conn:
+                records = [self._encode(r) for r in records]
+                conn.executemany(sql, [[r[c] for c in columns] for r in records])
+                for path, path_tags in (tags or {}).items():
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO material_tags (path, tag) VALUES (?, ?)",
+                        [(path, t.strip().lower()) for t in path_tags if t.strip()],
+                    )
+        finally:
+            conn.close()
+
+    def scan(self, directory: str, thumbnails: bool = True, workers: int = 4) -> Dict:
+        """
+        Incrementally index all videos and images under the directory.
+
+        Only new files and files whose mtime or size changed are probed, and
+        records of files that no longer exist are removed. The names of the
+        sub directories a file lives in are added as its tags.
+        """
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            raise ValueError(f"directory not found: {directory}")
+
+        prefix = os.path.join(directory, "")
+        indexed = {
+            r["path"]: (r["mtime"], r["size"])
+            for r in self._query(
+                "SELECT path, mtime, size FROM materials WHERE path LIKE ? ESCAPE '\\'",
+                (_escape_like(prefix) + "%",),
+            )
+        }
+
+        file_types = const.FILE_TYPE_VIDEOS + const.FILE_TYPE_IMAGES
+        found = set()
+        changed = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if utils.parse_extension(name) not in file_types:
+                    continue
+                file_path = os.path.join(root, name)
+                # skip the clips converted from images by preprocess_video
+                if name.endswith(".mp4") and utils.parse_extension(name[:-4]) in const.FILE_TYPE_IMAGES:
+                    continue
+                found.add(file_path)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                if indexed.get(file_path) != (stat.st_mtime, stat.st_size):
+                    changed.append(file_path)
+
+        logger.info(
+            f"scanning material library: {directory}, files: {len(found)}, changed: {len(changed)}"
+        )
+
+        batch_size = 200
+        updated = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(changed), batch_size):
+                batch = changed[i : i + batch_size]
+                records = [
+                    r
+                    for r in executor.map(
+                        lambda p: self._probe_record(p, thumbnail=thumbnails), batch
+                    )
+                    if r
+                ]
+                tags = {
+                    r["path"]: os.path.relpath(os.path.dirname(r["path"]), directory).split(os.sep)
+                    for r in records
+                }
+                tags = {p: [t for t in ts if t and t != "."] for p, ts in tags.items()}
+                self._save(records, tags=tags)
+                updated += len(records)
+
+        removed = [p for p in indexed if p not in found]
+        if removed:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("DELETE FROM materials WHERE path = ?", [(p,) for p in removed])
+                    conn.executemany("DELETE FROM material_tags WHERE path = ?", [(p,) for p in removed])
+            finally:
+                conn.close()
+
+        result = {
+            "directory": directory,
+            "total": len(found),
+            "updated": updated,
+            "failed": len(changed) - updated,
+            "removed": len(removed),
+        }
+        logger.success(f"material library scanned: {result}")
+        return result
+
+    def search(
+        self, tags: List[str] = None, query: str = "", limit: int = 100, offset: int = 0
+    ) -> List[Dict]:
+        """
+        Find materials that have any of the tags or whose file name contains
+        the query. Without any condition, all materials are returned. The
+        downloaded clips are not materials of the library.
+        """
+        conditions = []
+        args = []
+        tags = [t.strip().lower() for t in (tags or []) if t and t.strip()]
+        if tags:
+            conditions.append(
+                f"path IN (SELECT path FROM material_tags WHERE tag IN ({','.join('?' * len(tags))}))"
+            )
+            args.extend(tags)
+        if query and query.strip():
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            args.append(f"%{_escape_like(query.strip())}%")
+
+        sql = "SELECT * FROM materials WHERE source = ?"
+        args.insert(0, SOURCE_LOCAL)
+        if conditions:
+            sql += " AND (" + " OR ".join(conditions) + ")"
+        sql += " ORDER BY path LIMIT ? OFFSET ?"
+        args.extend([limit, offset])
+        return self._with_tags(self._query(sql, args))
+
+    def select(self, terms: List[str], limit: int = 100) -> List[MaterialInfo]:
+        """
+        Select materials for a task by search terms, each term is matched
+        against the tags and the file names. The materials scored as low
+        quality are skipped.
+        """
+        records = {}
+        for term in terms or []:
+            for r in self.search(tags=[term], query=term, limit=limit):
+                if r["path"] in records:
+                    continue
+                reason = low_quality_reason(r)
+                if reason:
+                    logger.info(f"skip low quality material ({reason}): {r['path']}")
+                    continue
+                records[r["path"]] = r
+        return [to_material_info(r) for r in list(records.values())[:limit]]
+
+    def set_tags(self, file_path: str, tags: List[str]):
+        file_path = os.path.abspath(file_path)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM material_tags WHERE path = ?", (file_path,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO material_tags (path, tag) VALUES (?, ?)",
+                    [(file_path, t.strip().lower()) for t in tags if t.strip()],
+                )
+        finally:
+            conn.close()
+
+    def update(self, file_path: str, **fields):
+        """
+        Update columns of an indexed material, e.g. analysis results.
+        """
+        if not fields:
+            return
+        fields = self._encode(fields)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self._execute(
+            f"UPDATE materials SET {assignments} WHERE path = ?",
+            (*fields.values(), os.path.abspath(file_path)),
+        )
+
+    def set_clip(self, file_path: str, clip_path: str, clip_duration: float):
+        """
+        Remember the clip converted from an image, so it can be reused.
+        """
+        self.update(file_path, clip_path=clip_path, clip_duration=clip_duration)
+
+
+def to_material_info(record: Dict) -> MaterialInfo:
+    item = MaterialInfo()
+    item.provider = "local"
+    item.url = record["path"]
+    item.duration = int(record.get("duration") or 0)
+    return item
+
+
+library = MaterialLibrary(
+    db_file=os.path.join(utils.storage_dir("library", create=True), "materials.db")
+)
@@ -1,6 +1,8 @@
 import os
 import random
-from typing import List
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 import aiohttp
 import asyncio
 from urllib.parse import urlencode
@@ -13,10 +15,21 @@ from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services import admission
+from app.services.library import SOURCE_DOWNLOAD, library, low_quality_reason
+from app.services.runtime import runtime
+from app.services.utils import video_analysis
 from app.utils import utils
 
 requested_count = 0
 
+# scale of the target resolution for each material profile, e.g. draft renders
+# only need half of the final resolution
+RENDITION_PROFILE_SCALES = {
+    "draft": 0.5,
+    "hd": 1.0,
+}
+
 
 def get_api_key(cfg_key: str):
     api_keys = config.app.get(cfg_key)
@@ -35,6 +48,52 @@ def get_api_key(cfg_key: str):
     return api_keys[requested_count % len(api_keys)]
 
 
+def get_target_resolution(video_aspect: VideoAspect) -> Tuple[int, int]:
+    """
+    Resolution the downloaded materials have to cover. Draft renders only need
+    a fraction of the final resolution, so smaller renditions are accepted.
+    """
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    profile = config.app.get("material_profile", "").strip().lower()
+    scale = RENDITION_PROFILE_SCALES.get(profile, 1.0)
+    return int(video_width * scale), int(video_height * scale)
+
+
+def select_rendition(
+        renditions: List[dict], target_width: int, target_height: int
+) -> Optional[dict]:
+    """
+    Pick the cheapest rendition that still covers the target resolution.
+
+    combine_videos scales every clip to fit inside the target frame and pads the
+    rest, so a rendition covers the target when fitting it never upscales, i.e.
+    min(target_width / width, target_height / height) <= 1.
+    Among covering renditions the smallest one (by pixels, then by file size) is
+    chosen. When nothing covers the target, the largest rendition is returned so
+    that the upscale is as small as possible.
+    """
+    candidates = []
+    for rendition in renditions:
+        try:
+            w = int(rendition.get("width") or 0)
+            h = int(rendition.get("height") or 0)
+        except (TypeError, ValueError):
+            continue
+        if w <= 0 or h <= 0 or not rendition.get("url"):
+            continue
+        candidates.append((w, h, int(rendition.get("size") or 0), rendition))
+
+    if not candidates:
+        return None
+
+    covering = [
+        c for c in candidates if min(target_width / c[0], target_height / c[1]) <= 1
+    ]
+    if covering:
+        return min(covering, key=lambda c: (c[0] * c[1], c[2]))[3]
+    return max(candidates, key=lambda c: (c[0] * c[1], -c[2]))[3]
+
+
 def search_videos_pexels(
         search_term: str,
         minimum_duration: int,
@@ -42,7 +101,7 @@ def search_videos_pexels(
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height = get_target_resolution(aspect)
     api_key = get_api_key("pexels_api_keys")
     headers = {
         "Authorization": api_key,
@@ -73,18 +132,24 @@ def search_videos_pexels(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["video_files"]
-            # loop through each url to determine the best quality
-            for video in video_files:
-                w = int(video["width"])
-                h = int(video["height"])
-                if w == video_width and h == video_height:
-                    item = MaterialInfo()
-                    item.provider = "pexels"
-                    item.url = video["link"]
-                    item.duration = duration
-                    video_items.append(item)
-                    break
+            renditions = [
+                {
+                    "url": video["link"],
+                    "width": video.get("width"),
+                    "height": video.get("height"),
+                    "size": video.get("size"),
+                }
+                for video in v["video_files"]
+                if video.get("file_type", "video/mp4") == "video/mp4"
+            ]
+            rendition = select_rendition(renditions, video_width, video_height)
+            if rendition:
+                item = MaterialInfo()
+                item.provider = "pexels"
+                item.url = rendition["url"]
+                item.duration = duration
+                item.video_id = str(v.get("id", ""))
+                video_items.append(item)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -98,8 +163,7 @@ def search_videos_pixabay(
         video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
-
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height = get_target_resolution(aspect)
 
     api_key = get_api_key("pixabay_api_keys")
     # Build URL
@@ -128,19 +192,23 @@ def search_videos_pixabay(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["videos"]
-            # loop through each url to determine the best quality
-            for video_type in dict(reversed(video_files.items())):
-                video = video_files[video_type]
-                w = int(video["width"])
-                # h = int(video["height"])
-                if w >= video_width:
-                    item = MaterialInfo()
-                    item.provider = "pixabay"
-                    item.url = video["url"]
-                    item.duration = duration
-                    video_items.append(item)
-                    break
+            renditions = [
+                {
+                    "url": video.get("url"),
+                    "width": video.get("width"),
+                    "height": video.get("height"),
+                    "size": video.get("size"),
+                }
+                for video in v["videos"].values()
+            ]
+            rendition = select_rendition(renditions, video_width, video_height)
+            if rendition:
+                item = MaterialInfo()
+                item.provider = "pixabay"
+                item.url = rendition["url"]
+                item.duration = duration
+                item.video_id = str(v.get("id", ""))
+                video_items.append(item)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -148,6 +216,62 @@ def search_videos_pixabay(
     return []
 
 
+# (source, term, minimum duration, aspect) => (expires at, videos found)
+_search_results: Dict[tuple, Tuple[float, List[MaterialInfo]]] = {}
+_search_locks: Dict[tuple, threading.Lock] = {}
+_search_lock = threading.Lock()
+
+
+def search_videos_cached(
+        source: str,
+        search_term: str,
+        minimum_duration: int,
+        video_aspect: VideoAspect = VideoAspect.portrait,
+) -> List[MaterialInfo]:
+    """
+    Search the videos of the source, sharing the results between the tasks,
+    e.g. the items of a batch searching the same terms, for
+    material_search_cache_seconds. A search running for another task is
+    waited for instead of being sent again.
+    """
+    search_videos = search_videos_pexels if source == "pexels" else search_videos_pixabay
+    ttl = config.app.get("material_search_cache_seconds", 3600)
+    if ttl <= 0:
+        return search_videos(search_term, minimum_duration, video_aspect)
+
+    key = (source, search_term.strip().lower(), minimum_duration, VideoAspect(video_aspect).name)
+    with _search_lock:
+        lock = _search_locks.setdefault(key, threading.Lock())
+    with lock:
+        now = time.time()
+        expires_at, items = _search_results.get(key, (0, []))
+        if expires_at > now:
+            logger.info(f"search results reused for '{search_term}'")
+            return list(items)
+        items = search_videos(search_term, minimum_duration, video_aspect)
+        with _search_lock:
+            for k in [k for k, v in _search_results.items() if v[0] <= now]:
+                del _search_results[k]
+                _search_locks.pop(k, None)
+            # failed searches are not kept
+            if items:
+                _search_results[key] = (now + ttl, items)
+        return list(items)
+
+
+def get_video_path(video_url: str, save_dir: str = "") -> str:
+    if not save_dir:
+        save_dir = utils.storage_dir("cache_videos")
+    url_without_query = video_url.split("?")[0]
+    url_hash = utils.md5(url_without_query)
+    return f"{save_dir}/vid-{url_hash}.mp4"
+
+
+# video path => download running on the runtime loop, and the number of
+# tasks waiting for it
+_downloads: Dict[str, dict] = {}
+
+
 async def save_video(video_url: str, save_dir: str = "", retries: int = 3) -> str:
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
@@ -155,68 +279,159 @@ async def save_video(video_url: str, save_dir: str = "", retries: int = 3) -> st
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    url_without_query = video_url.split("?")[0]
-    url_hash = utils.md5(url_without_query)
-    video_id = f"vid-{url_hash}"
-    video_path = f"{save_dir}/{video_id}.mp4"
+    video_path = get_video_path(video_url, save_dir)
+    video_id = os.path.basename(video_path).replace(".mp4", "")
+
+    # tasks downloading the same video at once share the download
+    download = _downloads.get(video_path)
+    if download is None:
+        # if video already exists, return the path
+        if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+            logger.info(f"video already exists: {video_path}")
+            return video_path
+        future = asyncio.ensure_future(_download_video(video_url, video_path, video_id, retries))
+        download = {"future": future, "waiters": 0}
+        _downloads[video_path] = download
+        future.add_done_callback(
+            lambda _: _downloads.pop(video_path, None)
+            if _downloads.get(video_path) is download
+            else None
+        )
 
-    # if video already exists, return the path
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        logger.info(f"video already exists: {video_path}")
-        return video_path
-    # Download the video asynchronously
-    download_concurreny_num = asyncio.Semaphore(15)
-    async with download_concurreny_num:
+    download["waiters"] += 1
+    try:
+        # shielded, so a cancelled task doesn't stop the download of the others
+        return await asyncio.shield(download["future"])
+    finally:
+        download["waiters"] -= 1
+        if download["waiters"] == 0 and not download["future"].done():
+            # nobody waits for it anymore, e.g. all its tasks were cancelled
+            download["future"].cancel()
+
+
+async def _download_video(video_url: str, video_path: str, video_id: str, retries: int) -> str:
+    # written next to the video and renamed when complete, so the other tasks
+    # never take a partial video
+    part_path = video_path.replace(".mp4", ".part.mp4")
+    try:
+        return await _fetch_video(video_url, video_path, part_path, video_id, retries)
+    except asyncio.CancelledError:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+
+async def _fetch_video(
+        video_url: str, video_path: str, part_path: str, video_id: str, retries: int
+) -> str:
+    # Download the video asynchronously, sharing the connection pool of the runtime
+    session = await runtime.http_session()
+    async with runtime.semaphore("download", 15):
         for attempt in range(retries):
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                            video_url,
-                            headers={"User-Agent": "Mozilla/5.0"},
-                            proxy=config.proxy['http'],
-                            ssl=False,
-                            timeout=aiohttp.ClientTimeout(total=10*60)
-                    ) as response:
-                        if response.status == 200:
-                            video_size = response.content_length
-                            logger.info(f"videoId: {video_id}, url: {video_url}")
-                            with open(video_path, 'wb') as f:
-                                while True:
-                                    chunk = await response.content.read(1024)
-                                    if not chunk:
-                                        break
-                                    f.write(chunk)
-                        else:
-                            logger.error(f"Failed to download videoId: {video_id}, url: {video_url}，error code: {response.status}")
-                            return ""
+                async with session.get(
+                        video_url,
+                        headers={"User-Agent": "Mozilla/5.0"},
+                        proxy=config.proxy.get("http"),
+                        ssl=False,
+                        timeout=aiohttp.ClientTimeout(total=10*60)
+                ) as response:
+                    if response.status == 200:
+                        video_size = response.content_length
+                        logger.info(f"videoId: {video_id}, url: {video_url}")
+                        with open(part_path, 'wb') as f:
+                            while True:
+                                chunk = await response.content.read(64 * 1024)
+                                if not chunk:
+                                    break
+                                f.write(chunk)
+                    else:
+                        logger.error(f"Failed to download videoId: {video_id}, url: {video_url}，error code: {response.status}")
+                        return ""
             except aiohttp.ClientPayloadError as e:
                 logger.warning(f"Download interrupt，retry {attempt + 1}/{retries} times: {str(e)}")
                 await asyncio.sleep(0.2)  # Wait 1 second and try again
                 continue
             except Exception as e:
                 logger.error(f"Failed to download videoId: {video_id}, url: {video_url}: {str(e)}")
-                if os.path.exists(video_path):
-                    os.remove(video_path)
+                if os.path.exists(part_path):
+                    os.remove(part_path)
                 return ""
             else:
                 break
         else:
             logger.error("Failed to download videoId: {video_id}, url: {video_url} : Download failed after multiple retries")
-            if os.path.exists(video_path):
-                os.remove(video_path)
+            if os.path.exists(part_path):
+                os.remove(part_path)
             return ""
 
-    # Verify video integrity
-    if check_video_integrity(video_path, video_size):
+    # Verify video integrity, off the event loop as it runs ffmpeg
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, check_video_integrity, part_path, video_size):
+        # only complete videos appear at their path
+        os.replace(part_path, video_path)
         return video_path
     else:
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        logger.warning(f"Invalid video file: {video_path}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        logger.warning(f"Invalid video file: {part_path}")
 
     return ""
 
 
+def unique_materials(items: List[MaterialInfo]) -> List[MaterialInfo]:
+    """
+    Collapse the same provider video found by several search terms, even when
+    the search results point at different renditions of it.
+    """
+    seen = set()
+    result = []
+    for item in items:
+        key = (item.provider, item.video_id) if item.video_id else item.url.split("?")[0]
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(item)
+    return result
+
+
+def get_material_record(video_path: str, tags: List[str] = None) -> Optional[dict]:
+    record = library.get(video_path) or library.index_file(
+        video_path, tags=tags, source=SOURCE_DOWNLOAD
+    )
+    if record:
+        record = library.analyze(
+            record, phash=config.app.get("material_phash_dedup", False)
+        )
+    return record
+
+
+def analyze_material(video_path: str, tags: List[str] = None) -> Optional[dict]:
+    """
+    get_material_record within the cpu budget of the stages, decoding the
+    downloaded clips competes with the renders of the other tasks.
+    """
+    with admission.admit({admission.RESOURCE_CPU_THREADS: 1}):
+        return get_material_record(video_path, tags)
+
+
+def unique_videos(video_paths: List[str], records: List[Optional[dict]]) -> List[int]:
+    """
+    Indexes of the downloaded videos to keep after dropping visually identical
+    clips, which is only done if material_phash_dedup is enabled.
+    """
+    if not config.app.get("material_phash_dedup", False):
+        return list(range(len(video_paths)))
+
+    max_distance = config.app.get("material_phash_distance", 6)
+    hashes = [r["phash"] if r else "" for r in records]
+    kept = video_analysis.unique_by_hash(hashes, max_distance)
+    for i in range(len(video_paths)):
+        if i not in kept:
+            logger.info(f"skip near-duplicate video: {video_paths[i]}")
+    return kept
+
+
 async def download_videos(
         task_id: str,
         search_terms: List[str],
@@ -226,20 +441,28 @@ async def download_videos(
         audio_duration: float = 0.0,
         max_clip_duration: int = 5,
 ) -> List[str]:
-    valid_video_urls = []
-    search_videos = search_videos_pexels if source == "pexels" else search_videos_pixabay
+    video_items = []
 
+    loop = asyncio.get_running_loop()
     for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
+        items = await loop.run_in_executor(
+            None,
+            lambda: search_videos_cached(
+                source=source,
+                search_term=search_term,
+                minimum_duration=max_clip_duration,
+                video_aspect=video_aspect,
+            ),
         )
-        logger.info(f"Found {len(video_items)} videos for '{search_term}'")
-        valid_video_urls.extend([item.url for item in video_items])
+        logger.info(f"Found {len(items)} videos for '{search_term}'")
+        video_items.extend(items)
+
+    found = len(video_items)
+    video_items = unique_materials(video_items)
+    logger.info(f"{len(video_items)} unique videos of {found} found")
 
     if video_contact_mode == "random":
-        random.shuffle(valid_video_urls)
+        random.shuffle(video_items)
 
     material_directory = config.app.get("material_directory", "").strip()
     if material_directory == "task":
@@ -247,21 +470,47 @@ async def download_videos(
     elif material_directory and not os.path.isdir(material_directory):
         material_directory = ""
 
+    # skip the videos that were downloaded and scored as low quality before
+    candidates = []
+    for item in video_items:
+        record = library.get(get_video_path(item.url, material_directory))
+        reason = low_quality_reason(record)
+        if reason:
+            logger.info(f"skip low quality video ({reason}): {item.url}")
+            continue
+        candidates.append(item)
+
     total_duration = 0.0
     result = []
 
     # create tasks
-    tasks = [save_video(url, save_dir=material_directory) for url in valid_video_urls]
+    tasks = [save_video(item.url, save_dir=material_directory) for item in candidates]
     video_paths = await asyncio.gather(*tasks)  # Run all tasks concurrently
-    for video_path in video_paths:
-        if video_path:
-            result.append(video_path)
+    video_paths = [video_path for video_path in video_paths if video_path]
+    # probing and analysing the videos is blocking, keep it off the event loop
+    records = await asyncio.gather(
+        *[
+            loop.run_in_executor(None, analyze_material, video_path, [source])
+            for video_path in video_paths
+        ]
+    )
+    for i in unique_videos(video_paths, records):
+        video_path, record = video_paths[i], records[i]
+        reason = low_quality_reason(record)
+        if reason:
+            logger.info(f"skip low quality video ({reason}): {video_path}")
+            continue
+        result.append(video_path)
+        if record:
+            clip_duration = record["duration"]
+        else:
             with VideoFileClip(video_path) as clip:
-                if clip.duration < max_clip_duration:
-                    continue
-                total_duration += min(max_clip_duration, clip.duration)
-            if total_duration >= audio_duration:
-                break
+                clip_duration = clip.duration
+        if clip_duration < max_clip_duration:
+            continue
+        total_duration += min(max_clip_duration, clip_duration)
+        if total_duration >= audio_duration:
+            break
 
     logger.success(f"Downloaded {len(result)} videos")
     return result
@@ -298,8 +547,8 @@ def check_video_integrity(file_path: str, video_size: int) -> bool:
 
 
 if __name__ == "__main__":
-    # asyncio.run(save_video("https://videos.pexels.com/video-files/13433115/13433115-hd_1080_1920_24fps.mp4"))
-    asyncio.run(download_videos(
+    # runtime.run(save_video("https://videos.pexels.com/video-files/13433115/13433115-hd_1080_1920_24fps.mp4"))
+    runtime.run(download_videos(
         "test123", ["loan risks", "stock market borrowing", "legal promissory note",
                     "financial responsibility", "investment caution"], audio_duration=10, source="pixabay"
     ))
@@ -0,0 +1,363 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from app.models import const
+from app.services import admission, cancellation
+from app.services import state as sm
+
+STAGE_KIND_IO = "io"
+STAGE_KIND_CPU = "cpu"
+# the error returned by a stage stopped because the task was cancelled
+STAGE_CANCELLED = object()
+
+
+def update_progress(task_id: str, **kwargs):
+    """
+    Record the progress of a running task, unless it was cancelled: a stage
+    finishing after the cancellation must not mark the task running again.
+    """
+    # the flag itself, the last check may be older than the cancellation
+    cancellation.forget(task_id)
+    if cancellation.is_cancelled(task_id):
+        return
+    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, **kwargs)
+
+
+@dataclass
+class Stage:
+    """
+    A node of the pipeline. func is called with the values of the inputs as
+    keyword arguments and returns a dict with the outputs, or None if the
+    stage failed.
+    """
+
+    name: str
+    func: Callable[..., Optional[Dict[str, Any]]]
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    kind: str = STAGE_KIND_IO
+    # task progress once the stage is completed
+    progress: int = 0
+    # resources the stage needs to run, computed from its inputs, e.g.
+    # {"render": 1, "cpu_threads": 4}, see admission
+    demand: Optional[Callable[..., Dict[str, int]]] = None
+
+
+class StageFailed(Exception):
+    def __init__(self, stage: str, message: str = ""):
+        self.stage = stage
+        super().__init__(f"stage {stage} failed: {message}")
+
+
+class Checkpoint:
+    """
+    A manifest of the completed stages of a task, saved as json next to its
+    files. For every stage it keeps a hash of the inputs, the outputs and the
+    size and mtime of the files they refer to, so a rerun of the task reuses
+    the outputs of the stages whose inputs didn't change and whose files are
+    still there.
+
+    codecs maps the names of values that can't be stored as json to a pair of
+    (encode, decode) functions.
+    """
+
+    def __init__(self, manifest_file: str, codecs: Dict[str, Tuple[Callable, Callable]] = None):
+        self.manifest_file = manifest_file
+        self.codecs = codecs or {}
+        self.data = self.load(manifest_file)
+
+    @staticmethod
+    def load(manifest_file: str) -> Dict[str, Any]:
+        try:
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {"stages": {}}
+        data.setdefault("stages", {})
+        return data
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+    def update(self, **kwargs):
+        self.data.update(kwargs)
+        self.save()
+
+    def encode(self, name: str, value: Any) -> Any:
+        if name in self.codecs:
+            return self.codecs[name][0](value)
+        if isinstance(value, BaseModel):
+            return value.model_dump(mode="json", warnings=False)
+        return value
+
+    def decode(self, name: str, value: Any) -> Any:
+        if name in self.codecs:
+            return self.codecs[name][1](value)
+        return value
+
+    @staticmethod
+    def _files(value: Any) -> Dict[str, List[int]]:
+        """
+        size and mtime of the existing files referred to by the value.
+        """
+        files = {}
+        if isinstance(value, str):
+            if value and os.path.isfile(value):
+                stat = os.stat(value)
+                files[value] = [stat.st_size, stat.st_mtime_ns]
+        elif isinstance(value, dict):
+            for v in value.values():
+                files.update(Checkpoint._files(v))
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                files.update(Checkpoint._files(v))
+        return files
+
+    def input_hash(self, inputs: Dict[str, Any]) -> str:
+        encoded = {name: self.encode(name, value) for name, value in inputs.items()}
+        # files are identified by their content, so a regenerated upstream
+        # file invalidates the stages reading it
+        raw = json.dumps([encoded, self._files(encoded)], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, stage: str, input_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        The outputs of the stage if they were produced from the same inputs
+        and their files are unchanged, otherwise None.
+        """
+        entry = self.data["stages"].get(stage)
+        if not entry or entry.get("input_hash") != input_hash:
+            return None
+        for file, fingerprint in entry.get("files", {}).items():
+            if self._files(file).get(file) != fingerprint:
+                logger.info(f"checkpoint of stage {stage} is invalid, file changed: {file}")
+                return None
+        return {name: self.decode(name, value) for name, value in entry["outputs"].items()}
+
+    def put(self, stage: str, input_hash: str, outputs: Dict[str, Any]):
+        encoded = {name: self.encode(name, value) for name, value in outputs.items()}
+        self.data["stages"][stage] = {
+            "input_hash": input_hash,
+            "outputs": encoded,
+            "files": self._files(encoded),
+            "completed_at": time.time(),
+        }
+        self.save()
+
+
+class Pipeline:
+    """
+    Runs a graph of stages, every stage starts as soon as the stages producing
+    its inputs are completed, so independent stages run in parallel. I/O bound
+    and CPU bound stages run on separate executors.
+    """
+
+    def __init__(self, stages: List[Stage], executors: Dict[str, Executor]):
+        self.stages = {stage.name: stage for stage in stages}
+        self.executors = executors
+        self.producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                self.producers[output] = stage.name
+
+    def dependencies(self, name: str) -> List[str]:
+        stage = self.stages[name]
+        return sorted({self.producers[i] for i in stage.inputs if i in self.producers})
+
+    def required(self, target: str) -> List[str]:
+        """
+        The target and all the stages it depends on, in declaration order.
+        """
+        if target not in self.stages:
+            raise ValueError(f"unknown stage: {target}")
+        result = set()
+        pending = [target]
+        while pending:
+            name = pending.pop()
+            if name in result:
+                continue
+            result.add(name)
+            pending.extend(self.dependencies(name))
+        return [name for name in self.stages if name in result]
+
+    def run(
+        self,
+        task_id: str,
+        context: Dict[str, Any],
+        target: str,
+        checkpoint: Optional[Checkpoint] = None,
+    ) -> Dict[str, Any]:
+        """
+        Run the stages needed for the target and return the context with all
+        the produced outputs. Timings and failures of all stages are recorded in
+        the task state and in the returned context as "stages". Raises
+        StageFailed when a stage fails, and TaskCancelled as soon as the task
+        is cancelled.
+
+        With a checkpoint, the stages whose outputs are still valid are not run
+        again, and the outputs of every completed stage are saved to it.
+        """
+        required = self.required(target)
+        for name in required:
+            for i in self.stages[name].inputs:
+                if i not in self.producers and i not in context:
+                    raise ValueError(f"missing input of stage {name}: {i}")
+
+        context = dict(context)
+        records = {name: {"status": "pending"} for name in required}
+        done = set()
+        running = {}
+        hashes = {}
+        progress = 0
+        failure = None
+
+        def _update():
+            update_progress(task_id, progress=progress, stages=records)
+
+        def _call(stage: Stage, kwargs: Dict[str, Any]):
+            started = time.time()
+            try:
+                demand = stage.demand(**kwargs) if stage.demand else {}
+                with cancellation.bind(task_id), admission.admit(demand):
+                    # the task may have been cancelled while waiting for the resources
+                    cancellation.check(task_id)
+                    started = time.time()
+                    return stage.func(**kwargs), None, time.time() - started
+            except cancellation.TaskCancelled:
+                logger.info(f"stage {stage.name} stopped, task cancelled")
+                return None, STAGE_CANCELLED, time.time() - started
+            except Exception as e:
+                logger.exception(f"stage {stage.name} failed")
+                return None, str(e), time.time() - started
+
+        cancelled = False
+        while len(done) < len(required) and failure is None and not cancelled:
+            if cancellation.is_cancelled(task_id):
+                cancelled = True
+                break
+
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name in required:
+                    if name in done or name in running:
+                        continue
+                    if not all(d in done for d in self.dependencies(name)):
+                        continue
+                    stage = self.stages[name]
+                    kwargs = {i: context[i] for i in stage.inputs}
+                    if checkpoint is not None:
+                        hashes[name] = checkpoint.input_hash(kwargs)
+                        outputs = checkpoint.get(name, hashes[name])
+                        if outputs is not None:
+                            # a reused stage may unblock the next ones right away
+                            context.update(outputs)
+                            done.add(name)
+                            progress = max(progress, stage.progress)
+                            records[name] = {"status": "cached", "kind": stage.kind, "elapsed": 0}
+                            logger.info(f"stage reused from checkpoint: {name}")
+                            scheduled = True
+                            continue
+                    executor = self.executors[stage.kind]
+                    running[name] = executor.submit(_call, stage, kwargs)
+                    records[name] = {"status": "running", "kind": stage.kind}
+                    logger.info(f"stage started: {name}")
+
+            if not running:
+                _update()
+                continue
+
+            # wake up regularly to notice a cancellation
+            completed, _ = wait(
+                list(running.values()),
+                timeout=cancellation.CHECK_INTERVAL,
+                return_when=FIRST_COMPLETED,
+            )
+            if not completed:
+                continue
+            for name in [n for n, f in running.items() if f in completed]:
+                result, error, elapsed = running.pop(name).result()
+                stage = self.stages[name]
+                records[name] = {"status": "completed", "kind": stage.kind, "elapsed": round(elapsed, 3)}
+                if error is STAGE_CANCELLED:
+                    # the stage noticed the cancellation before the loop
+                    records[name]["status"] = "cancelled"
+                    cancelled = True
+                    continue
+                if result is None:
+                    records[name]["status"] = "failed"
+                    records[name]["error"] = error or "no result"
+                    failure = failure or name
+                    continue
+                missing = [o for o in stage.outputs if o not in result]
+                if missing:
+                    records[name]["status"] = "failed"
+                    records[name]["error"] = f"missing outputs: {missing}"
+                    failure = failure or name
+                    continue
+                outputs = {o: result[o] for o in stage.outputs}
+                context.update(outputs)
+                if checkpoint is not None:
+                    checkpoint.put(name, hashes[name], outputs)
+                done.add(name)
+                progress = max(progress, stage.progress)
+                logger.info(f"stage completed: {name}, elapsed: {elapsed:.2f}s")
+            _update()
+
+        if failure and not cancelled:
+            # a stage may have failed because the task was cancelled meanwhile
+            cancellation.forget(task_id)
+            cancelled = cancellation.is_cancelled(task_id)
+
+        if cancelled:
+            # the running stages stop by themselves at their next check, the
+            # task doesn't wait for them
+            for name, future in running.items():
+                future.cancel()
+                records[name] = {"status": "cancelled", "kind": self.stages[name].kind}
+            for name in required:
+                if records[name]["status"] == "pending":
+                    records[name] = {"status": "cancelled"}
+            sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED, stages=records)
+            raise cancellation.TaskCancelled(task_id)
+
+        if failure:
+            # let the stages already running finish, but don't start new ones
+            for name, future in running.items():
+                if future.cancel():
+                    records[name] = {"status": "cancelled"}
+                else:
+                    result, error, elapsed = future.result()
+                    status = "completed" if result else "failed"
+                    if error is STAGE_CANCELLED:
+                        status = "cancelled"
+                    records[name] = {
+                        "status": status,
+                        "kind": self.stages[name].kind,
+                        "elapsed": round(elapsed, 3),
+                    }
+            for name in required:
+                if records[name]["status"] == "pending":
+                    records[name] = {"status": "skipped"}
+            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED, stages=records)
+            raise StageFailed(failure, records[failure].get("error", ""))
+
+        context["stages"] = records
+        return context
+
+
+io_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="stage-io")
+cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="stage-cpu")
+executors = {STAGE_KIND_IO: io_executor, STAGE_KIND_CPU: cpu_executor}
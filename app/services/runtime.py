@@ -0,0 +1,102 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from loguru import logger
+
+
+class AsyncRuntime:
+    """
+    A long-lived event loop running in a daemon thread, hosting all async I/O
+    of the process (tts, downloads, webhooks...).
+
+    Worker threads submit coroutines to it instead of calling asyncio.run, so
+    the loop, the pooled http connections and the dns cache survive between
+    calls and tasks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            # a forked worker process doesn't inherit the loop thread
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._sessions = {}
+                self._semaphores = {}
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="async-runtime", daemon=True
+                )
+                self._thread.start()
+                logger.info("async runtime started")
+            return self._loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """
+        Run the coroutine on the runtime loop and wait for its result.
+        """
+        loop = self.loop()
+        if self._thread is threading.current_thread():
+            coro.close()
+            raise RuntimeError("runtime.run can't be called from the runtime loop, await instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    async def http_session(
+        self,
+        name: str = "default",
+        make_resolver: Optional[Callable[[], AbstractResolver]] = None,
+        **connector_kwargs,
+    ) -> aiohttp.ClientSession:
+        """
+        The shared http session, must be used from the runtime loop. A named
+        session has its own connector, built on first use with the resolver
+        made by make_resolver and the connector_kwargs.
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            connector_kwargs.setdefault("limit", 100)
+            connector_kwargs.setdefault("ttl_dns_cache", 300)
+            if make_resolver is not None:
+                connector_kwargs["resolver"] = make_resolver()
+            connector = aiohttp.TCPConnector(**connector_kwargs)
+            session = self._sessions[name] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    def semaphore(self, name: str, value: int) -> asyncio.Semaphore:
+        """
+        A named semaphore shared by all coroutines on the runtime loop.
+        """
+        if name not in self._semaphores:
+            self._semaphores[name] = asyncio.Semaphore(value)
+        return self._semaphores[name]
+
+    def shutdown(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        for session in self._sessions.values():
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        logger.info("async runtime stopped")
+
+
+runtime = AsyncRuntime()
+
+
+def run(coro: Coroutine, timeout: Optional[float] = None) -> Any:
+    return runtime.run(coro, timeout)
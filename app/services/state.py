@@ -1,8 +1,29 @@
 import ast
+import json
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, List, Optional
+
+from loguru import logger
 
 from app.config import config
 from app.models import const
+from app.services import events
+
+TASK_STATES = (
+    const.TASK_STATE_FAILED,
+    const.TASK_STATE_CANCELLED,
+    const.TASK_STATE_COMPLETE,
+    const.TASK_STATE_PROCESSING,
+)
+FINISHED_STATES = (
+    const.TASK_STATE_COMPLETE,
+    const.TASK_STATE_FAILED,
+    const.TASK_STATE_CANCELLED,
+)
 
 
 # Base class for state management
@@ -16,21 +37,76 @@ class BaseState(ABC):
         pass
 
     @abstractmethod
-    def get_all_tasks(self, page: int, page_size: int):
+    def get_all_tasks(
+        self,
+        page: int,
+        page_size: int,
+        state: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ):
+        """
+        A page of the tasks in the order they were created, and their total,
+        optionally only the tasks in the state, or created between since and
+        until (timestamps).
+        """
         pass
 
 
 # Memory state management
 class MemoryState(BaseState):
-    def __init__(self):
-        self._tasks = {}
+    """
+    The tasks of a single node, kept in memory.
 
-    def get_all_tasks(self, page: int, page_size: int):
+    The finished tasks are evicted once nobody read them for ttl seconds, and
+    the least recently used first when there are more than max_tasks tasks.
+    Running tasks are never evicted. 0 disables each limit.
+    """
+
+    def __init__(self, max_tasks: int = 0, ttl: float = 0):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        # task id => task, in the order the tasks were created
+        self._tasks: Dict[str, dict] = {}
+        # task id => created at
+        self._created: Dict[str, float] = {}
+        # finished task id => last used at, least recently used first
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        # state => number of tasks
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get_all_tasks(
+        self,
+        page: int,
+        page_size: int,
+        state: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ):
         start = (page - 1) * page_size
-        end = start + page_size
-        tasks = list(self._tasks.values())
-        total = len(tasks)
-        return tasks[start:end], total
+        with self._lock:
+            self._evict(time.time())
+            if since is None and until is None:
+                total = len(self._tasks) if state is None else self._counts.get(state, 0)
+            else:
+                total = sum(1 for _ in self._matching(state, since, until))
+            # only the tasks up to the page are visited, and copied so the
+            # callers don't read or change them while they are updated
+            tasks = [
+                dict(task)
+                for task in islice(self._matching(state, since, until), start, start + page_size)
+            ]
+        return tasks, total
+
+    def _matching(self, state: Optional[int], since: Optional[float], until: Optional[float]):
+        for task_id, task in self._tasks.items():
+            if state is not None and task["state"] != state:
+                continue
+            created = self._created[task_id]
+            if (since is not None and created < since) or (until is not None and created > until):
+                continue
+            yield task
 
     def update_task(
         self,
@@ -43,48 +119,167 @@ class MemoryState(BaseState):
         if progress > 100:
             progress = 100
 
-        self._tasks[task_id] = {
-            "task_id": task_id,
-            "state": state,
-            "progress": progress,
-            **kwargs,
-        }
+        with self._lock:
+            now = time.time()
+            task = self._tasks.get(task_id)
+            if task is None:
+                task = self._tasks[task_id] = {"task_id": task_id}
+                self._created[task_id] = now
+            else:
+                self._counts[task["state"]] -= 1
+            # merged like the fields of the redis hash, the results of the
+            # previous stages are kept
+            task.update(state=state, progress=progress, **kwargs)
+            self._counts[state] = self._counts.get(state, 0) + 1
+            if state in FINISHED_STATES:
+                self._finished[task_id] = now
+                self._finished.move_to_end(task_id)
+            else:
+                self._finished.pop(task_id, None)
+            self._evict(now)
+            event = dict(task)
+        events.bus.publish(task_id, event)
 
     def get_task(self, task_id: str):
-        return self._tasks.get(task_id, None)
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            if task_id in self._finished:
+                self._finished[task_id] = now
+                self._finished.move_to_end(task_id)
+            task = self._tasks.get(task_id)
+            return dict(task) if task is not None else None
 
     def delete_task(self, task_id: str):
-        if task_id in self._tasks:
-            del self._tasks[task_id]
+        with self._lock:
+            deleted = self._remove(task_id)
+        if deleted:
+            events.bus.publish(task_id, {"task_id": task_id, "deleted": True})
+
+    def _remove(self, task_id: str) -> bool:
+        task = self._tasks.pop(task_id, None)
+        if task is None:
+            return False
+        self._counts[task["state"]] -= 1
+        self._created.pop(task_id, None)
+        self._finished.pop(task_id, None)
+        return True
+
+    def _evict(self, now: float):
+        if self.ttl > 0:
+            while self._finished:
+                task_id, last_used = next(iter(self._finished.items()))
+                if now - last_used < self.ttl:
+                    break
+                self._remove(task_id)
+        if self.max_tasks > 0:
+            while len(self._tasks) > self.max_tasks and self._finished:
+                self._remove(next(iter(self._finished)))
+
+
+# Adds the task to the index with its creation time, the first time only, and
+# moves it to the set of its state, in one step
+_INDEX_SCRIPT = """
+local created = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not created then
+    created = ARGV[2]
+    redis.call('ZADD', KEYS[1], created, ARGV[1])
+end
+for i = 3, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+redis.call('ZADD', KEYS[2], created, ARGV[1])
+return created
+"""
 
 
 # Redis state management
 class RedisState(BaseState):
-    def __init__(self, host="localhost", port=6379, db=0, password=None):
+    # task id => created at, for every task
+    INDEX_KEY = "task_index"
+    # set when the tasks saved before the index existed were indexed
+    INDEXED_KEY = "task_index:complete"
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, transaction=False):
         import redis
 
         self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        # wrap the writes of an update in MULTI/EXEC
+        self._transaction = transaction
+        self._index = self._redis.register_script(_INDEX_SCRIPT)
+        self._indexed = False
 
-    def get_all_tasks(self, page: int, page_size: int):
-        start = (page - 1) * page_size
-        end = start + page_size
+    @classmethod
+    def _state_key(cls, state: int) -> str:
+        # task id => created at, for the tasks in the state
+        return f"{cls.INDEX_KEY}:state:{state}"
+
+    def _index_keys(self, state: int) -> List[str]:
+        others = [self._state_key(s) for s in TASK_STATES if s != state]
+        return [self.INDEX_KEY, self._state_key(state), *others]
+
+    def reindex(self):
+        """
+        Index the tasks saved before the index existed, with the current time
+        as creation time. Scans the keyspace once, the first time the tasks
+        are listed.
+        """
+        if self._indexed or self._redis.exists(self.INDEXED_KEY):
+            self._indexed = True
+            return
+        now = time.time()
+        count = 0
+        pipe = self._redis.pipeline(transaction=False)
+        for key in self._redis.scan_iter(count=1000, _type="HASH"):
+            task_id, state = self._redis.hmget(key, "task_id", "state")
+            if task_id is None:
+                continue
+            state = self._convert_to_original_type(state) if state else const.TASK_STATE_PROCESSING
+            self._index(keys=self._index_keys(state), args=[key, now], client=pipe)
+            count += 1
+            if len(pipe) >= 1000:
+                pipe.execute()
+        pipe.set(self.INDEXED_KEY, 1)
+        pipe.execute()
+        self._indexed = True
+        logger.info(f"indexed {count} tasks")
+
+    def get_all_tasks(
+        self,
+        page: int,
+        page_size: int,
+        state: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ):
+        self.reindex()
+        key = self.INDEX_KEY if state is None else self._state_key(state)
+        min_score = "-inf" if since is None else since
+        max_score = "+inf" if until is None else until
+
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zcount(key, min_score, max_score)
+        pipe.zrangebyscore(
+            key, min_score, max_score, start=(page - 1) * page_size, num=page_size
+        )
+        total, task_ids = pipe.execute()
+        if not task_ids:
+            return [], total
+
+        pipe = self._redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(task_id)
         tasks = []
-        cursor = 0
-        total = 0
-        while True:
-            cursor, keys = self._redis.scan(cursor, count=page_size)
-            total += len(keys)
-            if total > start:
-                for key in keys[max(0, start - total):end - total]:
-                    task_data = self._redis.hgetall(key)
-                    task = {
-                        k.decode("utf-8"): self._convert_to_original_type(v) for k, v in task_data.items()
-                    }
-                    tasks.append(task)
-                    if len(tasks) >= page_size:
-                        break
-            if cursor == 0 or len(tasks) >= page_size:
-                break
+        for task_data in pipe.execute():
+            # deleted without the api, e.g. expired
+            if not task_data:
+                continue
+            tasks.append(
+                {
+                    k.decode("utf-8"): self._convert_to_original_type(v)
+                    for k, v in task_data.items()
+                }
+            )
         return tasks, total
 
     def update_task(
@@ -105,8 +300,12 @@ class RedisState(BaseState):
             **kwargs,
         }
 
-        for field, value in fields.items():
-            self._redis.hset(task_id, field, str(value))
+        # all the fields and the indexes in one round trip
+        pipe = self._redis.pipeline(transaction=self._transaction)
+        pipe.hset(task_id, mapping={k: self._encode(v) for k, v in fields.items()})
+        self._index(keys=self._index_keys(state), args=[task_id, time.time()], client=pipe)
+        pipe.execute()
+        events.bus.publish(task_id, fields)
 
     def get_task(self, task_id: str):
         task_data = self._redis.hgetall(task_id)
@@ -120,26 +319,83 @@ class RedisState(BaseState):
         return task
 
     def delete_task(self, task_id: str):
-        self._redis.delete(task_id)
+        pipe = self._redis.pipeline(transaction=self._transaction)
+        pipe.delete(task_id)
+        pipe.zrem(self.INDEX_KEY, task_id)
+        for state in TASK_STATES:
+            pipe.zrem(self._state_key(state), task_id)
+        pipe.execute()
+        events.bus.publish(task_id, {"task_id": task_id, "deleted": True})
+
+    @staticmethod
+    def _encode(value) -> str:
+        return json.dumps(value, default=str, ensure_ascii=False)
 
     @staticmethod
     def _convert_to_original_type(value):
         """
-        Convert the value from byte string to its original data type.
-        You can extend this method to handle other data types as needed.
+        Decode the json value of a field. Values saved with str() by older
+        versions, e.g. lists of paths or None, are parsed as python literals,
+        and returned as strings if they are not literals either.
         """
         value_str = value.decode("utf-8")
-
         try:
-            # try to convert byte string array to list
-            return ast.literal_eval(value_str)
-        except (ValueError, SyntaxError):
+            return json.loads(value_str)
+        except ValueError:
             pass
+        try:
+            return ast.literal_eval(value_str)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return value_str
+
+
+# Forwards the state updates of a worker process to the state of the parent process
+class QueueState(BaseState):
+    def __init__(self, queue):
+        self._queue = queue
+
+    def update_task(
+        self,
+        task_id: str,
+        state: int = const.TASK_STATE_PROCESSING,
+        progress: int = 0,
+        **kwargs,
+    ):
+        self._queue.put(
+            ("update_task", task_id, {"state": state, "progress": progress, **kwargs})
+        )
 
-        if value_str.isdigit():
-            return int(value_str)
-        # Add more conversions here if needed
-        return value_str
+    def delete_task(self, task_id: str):
+        self._queue.put(("delete_task", task_id, {}))
+
+    # the tasks are only queried by the parent process
+    def get_task(self, task_id: str):
+        return None
+
+    def get_all_tasks(
+        self,
+        page: int,
+        page_size: int,
+        state: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ):
+        return [], 0
+
+
+def apply_updates(queue, target: BaseState):
+    """
+    Apply the updates sent by QueueState to the target state, until None is received.
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        method, task_id, kwargs = item
+        try:
+            getattr(target, method)(task_id, **kwargs)
+        except Exception as e:
+            print(f"failed to apply state update of task {task_id}: {str(e)}")
 
 
 # Global state
@@ -151,8 +407,15 @@ _redis_password = config.app.get("redis_password", None)
 
 state = (
     RedisState(
-        host=_redis_host, port=_redis_port, db=_redis_db, password=_redis_password
+        host=_redis_host,
+        port=_redis_port,
+        db=_redis_db,
+        password=_redis_password,
+        transaction=config.app.get("redis_state_transactions", False),
     )
     if _enable_redis
-    else MemoryState()
+    else MemoryState(
+        max_tasks=config.app.get("memory_state_max_tasks", 10000),
+        ttl=config.app.get("memory_state_ttl", 86400),
+    )
 )
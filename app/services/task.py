@@ -1,6 +1,5 @@
 import math
 import random
-import asyncio
 import os.path
 import re
 from os import path
@@ -9,8 +8,11 @@ from loguru import logger
 
 from app.config import config
 from app.models import const
+from app.models import schema
 from app.models.schema import VideoConcatMode, VideoParams, MaterialInfo
-from app.services import llm, material, subtitle, video, voice
+from app.services import admission, cancellation, llm, material, pipeline, subtitle, video, voice, webhook
+from app.services.library import library
+from app.services.pipeline import STAGE_KIND_CPU, Checkpoint, Pipeline, Stage, StageFailed, update_progress
 from app.services import state as sm
 from app.utils import utils
 
@@ -91,6 +93,18 @@ def generate_audio(task_id, params, video_script):
     return audio_file, audio_duration, sub_maker
 
 
+def estimate_audio_duration(video_script: str, voice_rate: float = 1.0) -> int:
+    """
+    Estimate the duration of the speech from the script length, about 4.5
+    characters per second for CJK text and 2.7 words per second otherwise,
+    with a margin so the materials rarely have to be topped up.
+    """
+    cjk_chars = len(re.findall(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]", video_script))
+    other_words = len(re.findall(r"[^\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+", video_script))
+    seconds = cjk_chars / 4.5 + other_words / 2.7
+    return math.ceil(seconds / max(voice_rate or 1.0, 0.1) * 1.2)
+
+
 def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     if not params.subtitle_enabled:
         return ""
@@ -123,9 +137,13 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
 
 def get_video_materials(task_id, params, video_terms, audio_duration):
     if params.video_source == "local":
+        materials = params.video_materials
+        if not materials:
+            logger.info(f"\n\n## selecting materials from library: {video_terms}")
+            materials = library.select(terms=video_terms)
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
-            materials=params.video_materials, clip_duration=params.video_clip_duration
+            materials=materials, clip_duration=params.video_clip_duration
         )
         if not materials:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -136,7 +154,7 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
         return [material_info.url for material_info in materials]
     else:
         logger.info(f"\n\n## downloading videos from {params.video_source}")
-        downloaded_videos = asyncio.run(material.download_videos(
+        downloaded_videos = cancellation.run(material.download_videos(
             task_id=task_id,
             search_terms=video_terms,
             source=params.video_source,
@@ -183,7 +201,7 @@ def generate_final_videos(
         )
 
         _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+        update_progress(task_id, progress=_progress)
 
         final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
 
@@ -197,7 +215,7 @@ def generate_final_videos(
         )
 
         _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+        update_progress(task_id, progress=_progress)
 
         final_video_paths.append(final_video_path)
         combined_video_paths.append(combined_video_path)
@@ -205,124 +223,260 @@ def generate_final_videos(
     return final_video_paths, combined_video_paths
 
 
-def start(task_id, params: VideoParams, stop_at: str = "video"):
-    logger.info(f"start task: {task_id}, stop_at: {stop_at}")
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
+def build_pipeline() -> Pipeline:
+    """
+    The stages of a task and the data they pass to each other. The materials
+    are fetched for the estimated duration as soon as the terms are ready, in
+    parallel with the audio and the subtitle, and topped up once the real
+    audio duration is known.
+    """
 
-    if type(params.video_concat_mode) is str:
-        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
+    def _script(task_id, params):
+        video_script = generate_script(task_id, params)
+        if not video_script or "Error: " in video_script:
+            return None
+        return {"script": video_script}
 
-    # 1. Generate script
-    video_script = generate_script(task_id, params)
-    if not video_script or "Error: " in video_script:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+    def _terms(task_id, params, script):
+        video_terms = ""
+        # for local materials, the terms are used to select them from the library
+        if params.video_source != "local" or params.video_terms:
+            video_terms = generate_terms(task_id, params, script)
+            if not video_terms and params.video_source != "local":
+                return None
+        save_script_data(task_id, script, video_terms, params)
+        return {"terms": video_terms or ""}
+
+    def _audio(task_id, params, script):
+        audio_file, audio_duration, sub_maker = generate_audio(task_id, params, script)
+        if not audio_file:
+            return None
+        return {"audio_file": audio_file, "audio_duration": audio_duration, "sub_maker": sub_maker}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
+    def _subtitle(task_id, params, script, sub_maker, audio_file):
+        subtitle_path = generate_subtitle(task_id, params, script, sub_maker, audio_file)
+        return {"subtitle_path": subtitle_path}
 
-    if stop_at == "script":
-        sm.state.update_task(
-            task_id, state=const.TASK_STATE_COMPLETE, progress=100, script=video_script
+    def _prefetch_materials(task_id, params, script, terms):
+        estimated_duration = estimate_audio_duration(script, params.voice_rate)
+        logger.info(f"getting materials in parallel, estimated duration: {estimated_duration}s")
+        materials = get_video_materials(task_id, params, terms, estimated_duration)
+        if not materials:
+            return None
+        return {"prefetched_materials": materials, "estimated_duration": estimated_duration}
+
+    def _materials(task_id, params, terms, prefetched_materials, estimated_duration, audio_duration):
+        # top up the materials if the audio turned out longer than estimated,
+        # the videos downloaded already are taken from the cache
+        materials = prefetched_materials
+        if params.video_source != "local" and audio_duration > estimated_duration:
+            logger.info(
+                f"audio is longer than estimated: {audio_duration}s > {estimated_duration}s, topping up materials"
+            )
+            materials = get_video_materials(task_id, params, terms, audio_duration)
+        if not materials:
+            return None
+        return {"materials": materials}
+
+    def _llm_demand(params, **kwargs):
+        return {admission.RESOURCE_LLM: 1}
+
+    def _tts_demand(params, **kwargs):
+        return {admission.RESOURCE_TTS: 1}
+
+    def _subtitle_demand(params, **kwargs):
+        if not params.subtitle_enabled:
+            return {}
+        if config.app.get("subtitle_provider", "").strip().lower() != "whisper":
+            return {}
+        return {
+            admission.RESOURCE_WHISPER: 1,
+            # faster-whisper runs on 4 threads by default
+            admission.RESOURCE_CPU_THREADS: 4,
+            admission.RESOURCE_MEMORY_MB: int(config.app.get("whisper_memory_mb", 2000)),
+        }
+
+    def _materials_demand(params, **kwargs):
+        if params.video_source == "local":
+            return {admission.RESOURCE_CPU_THREADS: 1}
+        return {admission.RESOURCE_DOWNLOAD: 1}
+
+    def _render_demand(params, **kwargs):
+        return {
+            admission.RESOURCE_RENDER: 1,
+            admission.RESOURCE_CPU_THREADS: params.n_threads or 2,
+            admission.RESOURCE_MEMORY_MB: int(config.app.get("render_memory_mb", 1500)),
+        }
+
+    def _video(task_id, params, materials, audio_file, subtitle_path):
+        final_video_paths, combined_video_paths = generate_final_videos(
+            task_id, params, materials, audio_file, subtitle_path
         )
-        return {"script": video_script}
-
-    # 2. Generate terms
-    video_terms = ""
-    if params.video_source != "local":
-        video_terms = generate_terms(task_id, params, video_script)
-        if not video_terms:
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return
+        if not final_video_paths:
+            return None
+        return {"videos": final_video_paths, "combined_videos": combined_video_paths}
+
+    return Pipeline(
+        stages=[
+            Stage(
+                "script", _script, ["task_id", "params"], ["script"], progress=10, demand=_llm_demand
+            ),
+            Stage(
+                "terms",
+                _terms,
+                ["task_id", "params", "script"],
+                ["terms"],
+                progress=20,
+                demand=_llm_demand,
+            ),
+            Stage(
+                "audio",
+                _audio,
+                ["task_id", "params", "script"],
+                ["audio_file", "audio_duration", "sub_maker"],
+                progress=30,
+                demand=_tts_demand,
+            ),
+            Stage(
+                "subtitle",
+                _subtitle,
+                ["task_id", "params", "script", "sub_maker", "audio_file"],
+                ["subtitle_path"],
+                kind=STAGE_KIND_CPU,
+                progress=40,
+                demand=_subtitle_demand,
+            ),
+            Stage(
+                "prefetch_materials",
+                _prefetch_materials,
+                ["task_id", "params", "script", "terms"],
+                ["prefetched_materials", "estimated_duration"],
+                demand=_materials_demand,
+            ),
+            Stage(
+                "materials",
+                _materials,
+                ["task_id", "params", "terms", "prefetched_materials", "estimated_duration", "audio_duration"],
+                ["materials"],
+                progress=50,
+                demand=_materials_demand,
+            ),
+            Stage(
+                "video",
+                _video,
+                ["task_id", "params", "materials", "audio_file", "subtitle_path"],
+                ["videos", "combined_videos"],
+                kind=STAGE_KIND_CPU,
+                progress=100,
+                demand=_render_demand,
+            ),
+        ],
+        executors=pipeline.executors,
+    )
 
-    save_script_data(task_id, video_script, video_terms, params)
 
-    if stop_at == "terms":
-        sm.state.update_task(
-            task_id, state=const.TASK_STATE_COMPLETE, progress=100, terms=video_terms
-        )
-        return {"script": video_script, "terms": video_terms}
+# the outputs returned, and saved in the task state, for each stop_at
+STOP_AT_RESULTS = {
+    "script": ["script"],
+    "terms": ["script", "terms"],
+    "audio": ["audio_file", "audio_duration"],
+    "subtitle": ["subtitle_path"],
+    "materials": ["materials"],
+    "video": [
+        "videos",
+        "combined_videos",
+        "script",
+        "terms",
+        "audio_file",
+        "audio_duration",
+        "subtitle_path",
+        "materials",
+    ],
+}
+
+
+# values of the stages that are not stored as json as they are
+CHECKPOINT_CODECS = {
+    "sub_maker": (voice.sub_maker_to_dict, voice.sub_maker_from_dict),
+}
+
+
+def checkpoint_file(task_id):
+    return path.join(utils.task_dir(task_id), "checkpoint.json")
+
+
+def load_checkpoint(task_id):
+    """
+    The params and stop_at a task was started with, from its checkpoint, or
+    (None, None) if the task has no checkpoint.
+    """
+    file = checkpoint_file(task_id)
+    if not path.isfile(file):
+        return None, None
+    data = Checkpoint.load(file)
+    if "params" not in data:
+        return None, None
+    params_type = getattr(schema, data.get("params_type", ""), VideoParams)
+    return params_type(**data["params"]), data.get("stop_at", "video")
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
 
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(
-        task_id, params, video_script
-    )
-    if not audio_file:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+def start(task_id, params: VideoParams, stop_at: str = "video"):
+    logger.info(f"start task: {task_id}, stop_at: {stop_at}")
+    # this process may have seen the task cancelled before it was resumed
+    cancellation.forget(task_id)
+    if cancellation.is_cancelled(task_id):
+        # cancelled while queued
+        logger.info(f"task {task_id} cancelled before it started")
+        sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED)
         return
+    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
+    if type(params.video_concat_mode) is str:
+        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
 
-    if stop_at == "audio":
-        sm.state.update_task(
-            task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            audio_file=audio_file,
+    target = "video" if stop_at not in STOP_AT_RESULTS else stop_at
+    checkpoint = None
+    if config.app.get("task_checkpoint_enabled", True):
+        checkpoint = Checkpoint(checkpoint_file(task_id), codecs=CHECKPOINT_CODECS)
+        checkpoint.update(
+            params=params.model_dump(mode="json", warnings=False),
+            params_type=type(params).__name__,
+            stop_at=stop_at,
         )
-        return {"audio_file": audio_file, "audio_duration": audio_duration}
-
-    # 4. Generate subtitle
-    subtitle_path = generate_subtitle(
-        task_id, params, video_script, sub_maker, audio_file
-    )
-
-    if stop_at == "subtitle":
-        sm.state.update_task(
+    try:
+        context = build_pipeline().run(
             task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            subtitle_path=subtitle_path,
+            context={"task_id": task_id, "params": params},
+            target=target,
+            checkpoint=checkpoint,
         )
-        return {"subtitle_path": subtitle_path}
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
-
-    # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
-    if not downloaded_videos:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
-    if stop_at == "materials":
-        sm.state.update_task(
+    except StageFailed as e:
+        logger.error(f"task {task_id} failed: {str(e)}")
+        webhook.notify(
+            getattr(params, "callback_url", ""),
             task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            materials=downloaded_videos,
+            const.TASK_STATE_FAILED,
+            {"error": str(e)},
         )
-        return {"materials": downloaded_videos}
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
-
-    # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
-    )
-
-    if not final_video_paths:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return
+    except cancellation.TaskCancelled:
+        logger.warning(f"task {task_id} cancelled")
         return
 
-    logger.success(
-        f"task {task_id} finished, generated {len(final_video_paths)} videos."
-    )
-
-    kwargs = {
-        "videos": final_video_paths,
-        "combined_videos": combined_video_paths,
-        "script": video_script,
-        "terms": video_terms,
-        "audio_file": audio_file,
-        "audio_duration": audio_duration,
-        "subtitle_path": subtitle_path,
-        "materials": downloaded_videos,
-    }
+    kwargs = {key: context[key] for key in STOP_AT_RESULTS[target]}
+    if target == "video":
+        logger.success(
+            f"task {task_id} finished, generated {len(kwargs['videos'])} videos."
+        )
     sm.state.update_task(
-        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+        task_id,
+        state=const.TASK_STATE_COMPLETE,
+        progress=100,
+        stages=context["stages"],
+        **kwargs,
+    )
+    webhook.notify(
+        getattr(params, "callback_url", ""), task_id, const.TASK_STATE_COMPLETE, kwargs
     )
     return kwargs
 
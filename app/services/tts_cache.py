@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from typing import Dict, Optional
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+
+class TtsCache:
+    """
+    Content-addressed cache of synthesized speech.
+
+    Every entry is an mp3 file plus a json file with the word boundaries, both
+    named by a hash of the normalized text, the voice, the rate and the engine.
+    The least recently used entries are evicted when the cache grows beyond
+    max_size bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text: str, voice_name: str, voice_rate: str, engine: str) -> str:
+        text = re.sub(r"\s+", " ", text).strip()
+        raw = json.dumps([engine, voice_name, voice_rate, text], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str):
+        sub_dir = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(sub_dir, f"{key}.mp3"), os.path.join(sub_dir, f"{key}.json")
+
+    def get(self, key: str, voice_file: str) -> Optional[Dict]:
+        """
+        Copy the cached audio to voice_file and return the stored metadata,
+        or None on a miss.
+        """
+        audio_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            shutil.copyfile(audio_path, voice_file)
+            # the mtime is used as the last access time for eviction
+            os.utime(audio_path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logger.info(f"tts cache hit: {key}, {self.stats()}")
+        return meta
+
+    def put(self, key: str, voice_file: str, meta: Dict):
+        audio_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+        try:
+            # write to temporary files first, so readers never see partial entries
+            shutil.copyfile(voice_file, f"{audio_path}.tmp")
+            with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(f"{audio_path}.tmp", audio_path)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        except OSError as e:
+            logger.warning(f"failed to write tts cache: {key}, error: {str(e)}")
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(audio_path) + os.path.getsize(meta_path)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".mp3"):
+                    continue
+                audio_path = os.path.join(root, name)
+                meta_path = audio_path[: -len(".mp3")] + ".json"
+                try:
+                    stat = os.stat(audio_path)
+                    size = stat.st_size + os.path.getsize(meta_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, size, audio_path, meta_path))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(e[1] for e in self._entries())
+            if self._size <= self.max_size:
+                return
+
+            entries = sorted(self._entries())
+            self._size = sum(e[1] for e in entries)
+            # evict down to 90% of the limit, so eviction doesn't run on every put
+            target = self.max_size * 0.9
+            for _, size, audio_path, meta_path in entries:
+                if self._size <= target:
+                    break
+                for file in (meta_path, audio_path):
+                    try:
+                        os.remove(file)
+                    except OSError:
+                        pass
+                self._size -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+            "size": self._size,
+        }
+
+
+cache = TtsCache(
+    cache_dir=utils.storage_dir("cache_tts"),
+    max_size=int(config.app.get("tts_cache_max_size_mb", 1024)) * 1024 * 1024,
+)
@@ -0,0 +1,250 @@
+import re
+import subprocess
+from typing import List, Optional
+
+import ffmpeg
+import numpy as np
+
+# size of the frames used for analysis, small enough to decode and compare fast
+ANALYSIS_SIZE = 64
+HASH_SIZE = 32
+HASH_BITS = 8
+# frames per second sampled for scene detection
+SCENE_SAMPLE_FPS = 5
+# the sharpness is measured on larger frames, the blur is lost when downscaling to ANALYSIS_SIZE
+SHARPNESS_WIDTH = 320
+SHARPNESS_SAMPLE_FPS = 1
+# a single whitespace separates the header from the pixels
+_PGM_HEADER = re.compile(rb"P5\s+(\d+)\s+(\d+)\s+255\s")
+
+
+def read_frame(file_path: str, timestamp: float, size: int = ANALYSIS_SIZE) -> np.ndarray:
+    """
+    Read one grayscale frame at the timestamp, downscaled to size x size.
+    Returns an empty array if the frame can't be decoded.
+    """
+    process = (
+        ffmpeg.input(file_path, ss=max(0.0, timestamp))
+        .output("pipe:", vframes=1, vf=f"scale={size}:{size}", format="rawvideo", pix_fmt="gray")
+        .global_args("-v", "error")
+    )
+    result = subprocess.run(process.compile(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or len(result.stdout) < size * size:
+        return np.empty((0, 0), dtype=np.uint8)
+    return np.frombuffer(result.stdout[: size * size], dtype=np.uint8).reshape(size, size)
+
+
+def read_frames(file_path: str, fps: float = SCENE_SAMPLE_FPS, size: int = ANALYSIS_SIZE) -> np.ndarray:
+    """
+    Decode the whole video once at a low frame rate into a (n, size, size)
+    array of grayscale frames.
+    """
+    process = (
+        ffmpeg.input(file_path)
+        .output(
+            "pipe:",
+            vf=f"fps={fps},scale={size}:{size}",
+            format="rawvideo",
+            pix_fmt="gray",
+            an=None,
+        )
+        .global_args("-v", "error")
+    )
+    result = subprocess.run(process.compile(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frame_size = size * size
+    count = len(result.stdout) // frame_size
+    if result.returncode != 0 or count == 0:
+        return np.empty((0, size, size), dtype=np.uint8)
+    return np.frombuffer(result.stdout[: count * frame_size], dtype=np.uint8).reshape(count, size, size)
+
+
+def read_detail_frames(
+    file_path: str, fps: float = SHARPNESS_SAMPLE_FPS, width: int = SHARPNESS_WIDTH
+) -> np.ndarray:
+    """
+    Decode the video at a low frame rate into a (n, height, width) array of
+    grayscale frames, keeping the aspect ratio of the video.
+    """
+    process = (
+        # one decoding thread, the analysis is admitted for one cpu thread
+        ffmpeg.input(file_path, threads=1)
+        .output(
+            "pipe:",
+            vf=f"fps={fps},scale={width}:-2",
+            format="image2pipe",
+            vcodec="pgm",
+            an=None,
+        )
+        .global_args("-v", "error")
+    )
+    result = subprocess.run(process.compile(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frames = []
+    data = result.stdout
+    offset = 0
+    # every frame is a binary pgm image: "P5 <width> <height> 255" and the pixels,
+    # so the height after the rotation of the video is read from the headers
+    while result.returncode == 0 and data.startswith(b"P5", offset):
+        header = _PGM_HEADER.match(data, offset)
+        if not header:
+            break
+        frame_width, frame_height = int(header.group(1)), int(header.group(2))
+        start = header.end()
+        end = start + frame_width * frame_height
+        if end > len(data):
+            break
+        frames.append(np.frombuffer(data[start:end], dtype=np.uint8).reshape(frame_height, frame_width))
+        offset = end
+    if not frames:
+        return np.empty((0, 0, width), dtype=np.uint8)
+    return np.stack(frames)
+
+
+def detect_scene_cuts(
+    frames: np.ndarray,
+    fps: float = SCENE_SAMPLE_FPS,
+    threshold: float = 30.0,
+    min_scene_duration: float = 1.0,
+) -> List[float]:
+    """
+    Timestamps of the first frame of every new shot.
+
+    A cut is a sampled frame whose mean absolute difference to the previous
+    frame exceeds the threshold (0-255) and is also well above the typical
+    motion of the clip, so fast camera moves are not taken as cuts.
+    """
+    if len(frames) < 2:
+        return []
+    frames = frames.astype(np.int16)
+    diffs = np.abs(frames[1:] - frames[:-1]).mean(axis=(1, 2))
+    baseline = np.median(diffs)
+    candidates = np.flatnonzero((diffs > threshold) & (diffs > baseline * 3)) + 1
+
+    cuts = []
+    last = 0.0
+    for index in candidates:
+        t = round(float(index) / fps, 3)
+        if t - last >= min_scene_duration:
+            cuts.append(t)
+            last = t
+    return cuts
+
+
+def sharpness_score(frames: np.ndarray) -> float:
+    """
+    Median variance of the Laplacian of the frames, low for blurry footage.
+    """
+    if len(frames) == 0:
+        return 0.0
+    f = frames.astype(np.float32)
+    laplacian = (
+        f[:, :-2, 1:-1] + f[:, 2:, 1:-1] + f[:, 1:-1, :-2] + f[:, 1:-1, 2:]
+        - 4 * f[:, 1:-1, 1:-1]
+    )
+    return float(np.median(laplacian.var(axis=(1, 2))))
+
+
+def quality_scores(
+    frames: np.ndarray, dark_level: float = 16.0, detail_frames: Optional[np.ndarray] = None
+) -> dict:
+    """
+    Cheap quality metrics of a batch of grayscale frames, all computed at once:
+
+    - sharpness: median variance of the Laplacian of the detail_frames if
+      given (see read_detail_frames), otherwise of the frames, low for blurry footage
+    - brightness: median mean luminance (0-255), low for nearly black footage
+    - motion: median mean absolute difference between sampled frames, low for static footage
+    - letterbox: share of the frame covered by black bars on the sides
+    """
+    if len(frames) == 0:
+        return {"sharpness": 0.0, "brightness": 0.0, "motion": 0.0, "letterbox": 0.0}
+
+    f = frames.astype(np.float32)
+    sharpness = sharpness_score(frames if detail_frames is None else detail_frames)
+    brightness = float(np.median(f.mean(axis=(1, 2))))
+    motion = 0.0
+    if len(f) > 1:
+        motion = float(np.median(np.abs(f[1:] - f[:-1]).mean(axis=(1, 2))))
+
+    # rows and columns that stay dark in every sampled frame
+    height, width = f.shape[1:]
+    dark_rows = f.max(axis=(0, 2)) < dark_level
+    dark_cols = f.max(axis=(0, 1)) < dark_level
+
+    def _edge_run(mask: np.ndarray) -> int:
+        if mask.all():
+            return len(mask)
+        return int(np.argmin(mask)) + int(np.argmin(mask[::-1]))
+
+    bars = _edge_run(dark_rows) / height + _edge_run(dark_cols) / width
+    return {
+        "sharpness": round(sharpness, 2),
+        "brightness": round(brightness, 2),
+        "motion": round(motion, 2),
+        "letterbox": round(min(1.0, bars), 3),
+    }
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(HASH_SIZE)
+
+
+def frame_hash(frames: np.ndarray) -> np.ndarray:
+    """
+    DCT based perceptual hash of a batch of HASH_SIZE x HASH_SIZE frames.
+    Returns a (n, HASH_BITS * HASH_BITS) boolean array.
+    """
+    frames = frames.astype(np.float32)
+    coefficients = _DCT @ frames @ _DCT.T
+    low = coefficients[:, :HASH_BITS, :HASH_BITS].reshape(len(frames), -1)
+    # the DC term only carries the brightness, leave it out of the median
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return low > median
+
+
+def perceptual_hash(file_path: str, duration: float, samples: int = 4) -> str:
+    """
+    Hash a video by a few frames sampled evenly over its duration.
+    Renditions and re-encodes of the same footage get the same or a very close hash.
+    """
+    timestamps = [duration * (i + 1) / (samples + 1) for i in range(samples)]
+    frames = [read_frame(file_path, t, size=HASH_SIZE) for t in timestamps]
+    frames = [f for f in frames if f.size]
+    if len(frames) != samples:
+        return ""
+    bits = frame_hash(np.stack(frames)).reshape(-1)
+    return np.packbits(bits).tobytes().hex()
+
+
+def hash_distance(hash_a: str, hash_b: str) -> float:
+    """
+    Average number of differing bits per sampled frame, 0 means identical.
+    """
+    if not hash_a or not hash_b or len(hash_a) != len(hash_b):
+        return float(HASH_BITS * HASH_BITS)
+    a = np.unpackbits(np.frombuffer(bytes.fromhex(hash_a), dtype=np.uint8))
+    b = np.unpackbits(np.frombuffer(bytes.fromhex(hash_b), dtype=np.uint8))
+    frames = len(a) // (HASH_BITS * HASH_BITS)
+    return float(np.count_nonzero(a != b)) / max(1, frames)
+
+
+def unique_by_hash(hashes: List[str], max_distance: float) -> List[int]:
+    """
+    Indexes of the items to keep, an item is dropped when its hash is within
+    max_distance of an item kept before it. Items without hash are always kept.
+    """
+    kept = []
+    kept_hashes = []
+    for i, h in enumerate(hashes):
+        if h and any(hash_distance(h, k) <= max_distance for k in kept_hashes):
+            continue
+        kept.append(i)
+        if h:
+            kept_hashes.append(h)
+    return kept
@@ -1,7 +1,8 @@
 import glob
 import os
 import random
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 
 from loguru import logger
 from moviepy import (
@@ -26,7 +27,9 @@ from app.models.schema import (
     VideoParams,
     VideoTransitionMode,
 )
-from app.services.utils import video_effects
+from app.services import cancellation
+from app.services.library import library, low_quality_reason
+from app.services.utils import video_analysis, video_effects
 from app.utils import utils
 
 
@@ -46,6 +49,37 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
+def plan_segments(
+        clip_duration: float,
+        max_clip_duration: float,
+        scene_cuts: List[float] = None,
+        min_segment_duration: float = 1.0,
+) -> List[Tuple[float, float]]:
+    """
+    Split a clip into segments of at most max_clip_duration seconds that don't
+    cross the scene cuts stored in the material index, so every segment shows a
+    single shot. The end of a segment keeps a margin of one sampled frame
+    before the cut, and segments shorter than min_segment_duration are skipped.
+    """
+    margin = 1 / video_analysis.SCENE_SAMPLE_FPS
+    cuts = sorted(c for c in (scene_cuts or []) if 0 < c < clip_duration)
+    bounds = [0.0, *cuts, clip_duration]
+
+    segments = []
+    for index, (scene_start, scene_end) in enumerate(zip(bounds, bounds[1:])):
+        if index < len(cuts):
+            scene_end -= margin
+        start_time = scene_start
+        while scene_end - start_time >= min_segment_duration:
+            end_time = min(start_time + max_clip_duration, scene_end)
+            segments.append((start_time, end_time))
+            start_time = end_time
+
+    if not segments:
+        segments.append((0.0, min(clip_duration, max_clip_duration)))
+    return segments
+
+
 def combine_videos(
         combined_video_path: str,
         video_paths: List[str],
@@ -74,17 +108,16 @@ def combine_videos(
     raw_clips = []
     for video_path in video_paths:
         clip = VideoFileClip(video_path).without_audio()
-        clip_duration = clip.duration
-        start_time = 0
+        record = library.get(video_path)
+        scene_cuts = record.get("scene_cuts") if record else None
+        segments = plan_segments(clip.duration, max_clip_duration, scene_cuts)
+        if video_concat_mode.value == VideoConcatMode.sequential.value:
+            segments = segments[:1]
 
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)
+        for start_time, end_time in segments:
             split_clip = clip.subclipped(start_time, end_time)
             raw_clips.append(split_clip)
-            # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip_duration:.2f}, split_clip duration {split_clip.duration:.2f}")
-            start_time = end_time
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
+            # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip.duration:.2f}, split_clip duration {split_clip.duration:.2f}")
 
     # random video_paths order
     if video_concat_mode.value == VideoConcatMode.random.value:
@@ -171,7 +204,7 @@ def combine_videos(
     video_clip.write_videofile(
         filename=combined_video_path,
         threads=threads,
-        logger=None,
+        logger=cancellation.progress_logger(),
         temp_audiofile_path=output_dir,
         audio_codec="aac",
         fps=30,
@@ -181,9 +214,15 @@ def combine_videos(
     return combined_video_path
 
 
+@lru_cache(maxsize=32)
+def load_font(font: str, fontsize: int) -> ImageFont.FreeTypeFont:
+    # loaded once per process, wrap_text is called for every subtitle line of every task
+    return ImageFont.truetype(font, fontsize)
+
+
 def wrap_text(text, max_width, font="Arial", fontsize=60):
     # Create ImageFont
-    font = ImageFont.truetype(font, fontsize)
+    font = load_font(font, fontsize)
 
     def get_text_size(inner_text):
         inner_text = inner_text.strip()
@@ -353,7 +392,7 @@ def generate_video(
         audio_codec="aac",
         temp_audiofile_path=output_dir,
         threads=params.n_threads or 2,
-        logger=None,
+        logger=cancellation.progress_logger(),
         fps=30,
     )
     video_clip.close()
@@ -367,18 +406,37 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
             continue
 
         ext = utils.parse_extension(material.url)
-        try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
+        # indexed materials don't have to be opened again
+        record = library.get(material.url) or library.index_file(material.url)
+        if record:
+            width, height = record["width"], record["height"]
+        else:
+            try:
+                clip = VideoFileClip(material.url)
+            except Exception:
+                clip = ImageClip(material.url)
+            width, height = clip.size
+            clip.close()
 
-        width = clip.size[0]
-        height = clip.size[1]
         if width < 480 or height < 480:
             logger.warning(f"video is too small, width: {width}, height: {height}")
             continue
 
+        # the materials were chosen, the low quality ones are still used
+        reason = low_quality_reason(record)
+        if reason:
+            logger.warning(f"low quality material ({reason}): {material.url}")
+
         if ext in const.FILE_TYPE_IMAGES:
+            if (
+                record
+                and record["clip_duration"] == clip_duration
+                and os.path.exists(record["clip_path"])
+            ):
+                logger.info(f"using converted image: {record['clip_path']}")
+                material.url = record["clip_path"]
+                continue
+
             logger.info(f"processing image: {material.url}")
             # Create an image clip and set its duration to 3 seconds
             clip = (
@@ -401,9 +459,11 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
 
             # Output the video to a file.
             video_file = f"{material.url}.mp4"
-            final_clip.write_videofile(video_file, fps=30, logger=None)
+            final_clip.write_videofile(video_file, fps=30, logger=cancellation.progress_logger())
             final_clip.close()
             del final_clip
+            if record:
+                library.set_clip(material.url, video_file, clip_duration)
             material.url = video_file
             logger.success(f"completed: {video_file}")
     return materials
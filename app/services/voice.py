@@ -2,7 +2,7 @@ import asyncio
 import os
 import re
 from datetime import datetime
-from typing import Union
+from typing import Awaitable, Callable, List, Tuple, Union
 from xml.sax.saxutils import unescape
 
 import edge_tts
@@ -12,6 +12,8 @@ from loguru import logger
 from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.models import const
+from app.services import cancellation, tts_cache
 from app.utils import utils
 
 
@@ -1050,9 +1052,42 @@ def is_azure_v2_voice(voice_name: str):
 def tts(
     text: str, voice_name: str, voice_rate: float, voice_file: str
 ) -> Union[SubMaker, None]:
+    cache_enabled = config.app.get("tts_cache_enabled", True)
     if is_azure_v2_voice(voice_name):
-        return azure_tts_v2(text, voice_name, voice_file)
-    return azure_tts_v1(text, voice_name, voice_rate, voice_file)
+        # the speech sdk voices don't support the rate
+        cache_key = tts_cache.cache.key(text, parse_voice_name(voice_name), "", "azure_v2")
+    else:
+        cache_key = tts_cache.cache.key(
+            text, parse_voice_name(voice_name), convert_rate_to_percent(voice_rate), "edge"
+        )
+
+    if cache_enabled:
+        cached = tts_cache.cache.get(cache_key, voice_file)
+        if cached:
+            return sub_maker_from_dict(cached)
+
+    if is_azure_v2_voice(voice_name):
+        sub_maker = azure_tts_v2(text, voice_name, voice_file)
+    else:
+        sub_maker = azure_tts_v1(text, voice_name, voice_rate, voice_file)
+
+    if cache_enabled and sub_maker and sub_maker.subs:
+        tts_cache.cache.put(cache_key, voice_file, sub_maker_to_dict(sub_maker))
+    return sub_maker
+
+
+def sub_maker_to_dict(sub_maker: SubMaker) -> dict:
+    return {
+        "offset": [list(offset) for offset in sub_maker.offset],
+        "subs": list(sub_maker.subs),
+    }
+
+
+def sub_maker_from_dict(data: dict) -> SubMaker:
+    sub_maker = SubMaker()
+    sub_maker.offset = [tuple(offset) for offset in data.get("offset", [])]
+    sub_maker.subs = list(data.get("subs", []))
+    return sub_maker
 
 
 def convert_rate_to_percent(rate: float) -> str:
@@ -1071,6 +1106,12 @@ def azure_tts_v1(
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
     rate_str = convert_rate_to_percent(voice_rate)
+
+    chunk_lines = config.app.get("tts_chunk_lines", 10)
+    chunks = split_text_into_chunks(text, chunk_lines) if chunk_lines > 0 else [text]
+    if len(chunks) > 1:
+        return azure_tts_v1_chunked(chunks, voice_name, rate_str, voice_file)
+
     for i in range(3):
         try:
             logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
@@ -1088,7 +1129,7 @@ def azure_tts_v1(
                             )
                 return sub_maker
 
-            sub_maker = asyncio.run(_do())
+            sub_maker = cancellation.run(_do())
             if not sub_maker or not sub_maker.subs:
                 logger.warning("failed, sub_maker is None or sub_maker.subs is None")
                 continue
@@ -1100,6 +1141,137 @@ def azure_tts_v1(
     return None
 
 
+def split_text_into_chunks(text: str, max_lines: int) -> List[str]:
+    """
+    Split the text into chunks of at most max_lines lines, cutting only where
+    utils.split_string_by_punctuations cuts, so the lines of all chunks are
+    exactly the lines of the whole text and create_subtitle still matches.
+    The punctuation is kept in the chunks to keep the intonation.
+    """
+    chunks = []
+    txt = ""
+    for i, char in enumerate(text):
+        txt += char
+        if char == "." and 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit():
+            continue
+        if char == "\n" or char in const.PUNCTUATIONS:
+            if len(utils.split_string_by_punctuations(txt)) >= max_lines:
+                chunks.append(txt.strip())
+                txt = ""
+    if txt.strip():
+        chunks.append(txt.strip())
+    return [chunk for chunk in chunks if utils.split_string_by_punctuations(chunk)]
+
+
+async def edge_tts_synthesize(text: str, voice_name: str, rate: str) -> Tuple[bytes, list]:
+    """
+    Synthesize the text with edge_tts, returns the mp3 audio and the word
+    boundaries as (offset, duration, text) in 100 nanosecond units.
+    """
+    communicate = edge_tts.Communicate(text, voice_name, rate=rate)
+    audio = bytearray()
+    boundaries = []
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            audio.extend(chunk["data"])
+        elif chunk["type"] == "WordBoundary":
+            boundaries.append((chunk["offset"], chunk["duration"], chunk["text"]))
+    return bytes(audio), boundaries
+
+
+# samples per frame and sample rates of mpeg 1, 2 and 2.5 layer III
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+_MP3_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_MP3_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+
+
+def mp3_duration(data: bytes) -> float:
+    """
+    Duration of mp3 (layer III) audio in seconds, by counting its frames.
+    """
+    duration = 0.0
+    pos = 0
+    while pos + 4 <= len(data):
+        header = int.from_bytes(data[pos : pos + 4], "big")
+        version = (header >> 19) & 0x3
+        bitrate_index = (header >> 12) & 0xF
+        rate_index = (header >> 10) & 0x3
+        if (
+            header >> 21 != 0x7FF
+            or version == 1
+            or (header >> 17) & 0x3 != 1
+            or bitrate_index in (0, 15)
+            or rate_index == 3
+        ):
+            pos += 1
+            continue
+        sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+        padding = (header >> 9) & 0x1
+        if version == 3:
+            bitrate = _MP3_BITRATES_V1[bitrate_index] * 1000
+            samples = 1152
+        else:
+            bitrate = _MP3_BITRATES_V2[bitrate_index] * 1000
+            samples = 576
+        frame_length = samples // 8 * bitrate // sample_rate + padding
+        duration += samples / sample_rate
+        pos += frame_length
+    return duration
+
+
+def azure_tts_v1_chunked(
+    chunks: List[str],
+    voice_name: str,
+    rate_str: str,
+    voice_file: str,
+    engine: Callable[[str, str, str], Awaitable[Tuple[bytes, list]]] = edge_tts_synthesize,
+) -> Union[SubMaker, None]:
+    """
+    Synthesize the chunks concurrently, then concatenate the audio and shift
+    the word boundaries of every chunk by the duration of the audio before it.
+    A failed chunk is retried on its own. The engine can be replaced by any
+    coroutine with the signature of edge_tts_synthesize.
+    """
+    concurrency = config.app.get("tts_chunk_concurrency", 4)
+    logger.info(
+        f"start, voice name: {voice_name}, chunks: {len(chunks)}, concurrency: {concurrency}"
+    )
+
+    async def _do():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _synthesize(index: int, chunk: str):
+            async with semaphore:
+                for i in range(3):
+                    try:
+                        audio, boundaries = await engine(chunk, voice_name, rate_str)
+                        if audio and boundaries:
+                            return audio, boundaries
+                        logger.warning(f"chunk {index + 1} failed, no audio or word boundaries, try: {i + 1}")
+                    except Exception as e:
+                        logger.error(f"chunk {index + 1} failed, error: {str(e)}, try: {i + 1}")
+                return None
+
+        return await asyncio.gather(*[_synthesize(i, c) for i, c in enumerate(chunks)])
+
+    results = cancellation.run(_do())
+    if not all(results):
+        logger.error(f"failed, {results.count(None)} of {len(chunks)} chunks failed")
+        return None
+
+    sub_maker = SubMaker()
+    shift = 0
+    with open(voice_file, "wb") as file:
+        for audio, boundaries in results:
+            file.write(audio)
+            for offset, duration, word in boundaries:
+                sub_maker.create_sub((offset + shift, duration), word)
+            shift += int(mp3_duration(audio) * 10000000)
+
+    logger.info(f"completed, output file: {voice_file}")
+    return sub_maker
+
+
 def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker, None]:
     voice_name = is_azure_v2_voice(voice_name)
     if not voice_name:
@@ -0,0 +1,377 @@
+import asyncio
+import glob
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+from loguru import logger
+
+from app.config import config
+from app.models import const
+from app.services.runtime import runtime
+from app.utils import utils
+
+EVENTS = {
+    const.TASK_STATE_COMPLETE: "task.completed",
+    const.TASK_STATE_FAILED: "task.failed",
+}
+# seconds a dispatcher has to deliver a webhook before another one may retry it
+DELIVERY_LEASE = 120
+
+
+# Webhooks to deliver, stored as json files, for a single node
+class FileOutbox:
+    def __init__(self, outbox_dir: str):
+        self.outbox_dir = outbox_dir
+
+    def _path(self, webhook_id: str) -> str:
+        return os.path.join(self.outbox_dir, f"{webhook_id}.json")
+
+    def put(self, webhook: Dict):
+        path = self._path(webhook["id"])
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(webhook, f)
+        os.replace(f"{path}.tmp", path)
+
+    def claim(self, now: float, limit: int) -> List[Dict]:
+        """
+        The webhooks due now. A claimed file is renamed, so the dispatchers of
+        the other processes skip it, and renamed back if its dispatcher died.
+        """
+        for path in glob.glob(os.path.join(self.outbox_dir, "*.json.sending")):
+            try:
+                if now - os.path.getmtime(path) > DELIVERY_LEASE:
+                    os.replace(path, path[: -len(".sending")])
+            except OSError:
+                pass
+
+        claimed = []
+        for path in glob.glob(os.path.join(self.outbox_dir, "*.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    webhook = json.load(f)
+                if webhook["next_attempt_at"] > now:
+                    continue
+                os.replace(path, f"{path}.sending")
+                # the lease starts now
+                os.utime(f"{path}.sending")
+            except (OSError, ValueError):
+                continue
+            claimed.append(webhook)
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+    def retry(self, webhook: Dict):
+        self.put(webhook)
+        self.done(webhook)
+
+    def done(self, webhook: Dict):
+        try:
+            os.remove(f"{self._path(webhook['id'])}.sending")
+        except OSError:
+            pass
+
+
+# Takes the due webhooks and moves their next attempt after the lease, in one step
+_CLAIM_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], ARGV[1] + ARGV[3], id)
+    local webhook = redis.call('HGET', KEYS[2], id)
+    if webhook then
+        table.insert(result, webhook)
+    else
+        redis.call('ZREM', KEYS[1], id)
+    end
+end
+return result
+"""
+
+
+# Webhooks to deliver, stored in redis, delivered by the api processes and workers of all the nodes
+class RedisOutbox:
+    def __init__(self, host="localhost", port=6379, db=0, password=None):
+        import redis
+
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        # webhook id => next attempt at
+        self.schedule_key = "webhook_outbox"
+        # webhook id => webhook
+        self.items_key = "webhook_outbox:items"
+        self._claim = self._redis.register_script(_CLAIM_SCRIPT)
+
+    def put(self, webhook: Dict):
+        pipe = self._redis.pipeline()
+        pipe.hset(self.items_key, webhook["id"], json.dumps(webhook))
+        pipe.zadd(self.schedule_key, {webhook["id"]: webhook["next_attempt_at"]})
+        pipe.execute()
+
+    def claim(self, now: float, limit: int) -> List[Dict]:
+        items = self._claim(
+            keys=[self.schedule_key, self.items_key], args=[now, limit, DELIVERY_LEASE]
+        )
+        return [json.loads(item) for item in items]
+
+    def retry(self, webhook: Dict):
+        self.put(webhook)
+
+    def done(self, webhook: Dict):
+        pipe = self._redis.pipeline()
+        pipe.zrem(self.schedule_key, webhook["id"])
+        pipe.hdel(self.items_key, webhook["id"])
+        pipe.execute()
+
+
+if config.app.get("enable_redis", False):
+    outbox = RedisOutbox(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+else:
+    outbox = FileOutbox(utils.storage_dir("webhooks", create=True))
+
+
+class ForbiddenCallback(ValueError):
+    """
+    The callback url is not allowed to receive webhooks.
+    """
+
+
+def _allowed_hosts() -> List[str]:
+    return [host.lower() for host in config.app.get("webhook_allowed_hosts", [])]
+
+
+def check_host(hostname: str):
+    """
+    Raises ForbiddenCallback if the host is not in webhook_allowed_hosts, when
+    it is set.
+    """
+    allowed = _allowed_hosts()
+    if allowed and (hostname or "").lower() not in allowed:
+        raise ForbiddenCallback(f"host not allowed: {hostname}")
+
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _private_allowed() -> bool:
+    # the hosts allowed explicitly may be internal ones
+    return bool(_allowed_hosts()) or config.app.get("webhook_allow_private", False)
+
+
+def check_url(url: str):
+    """
+    Raises ForbiddenCallback if the webhooks can't be sent to the url, so the
+    api can't be used to reach the internal services: the url must be http(s)
+    and, unless its host is allowed explicitly, not a non public address. The
+    addresses a host name resolves to are checked by the PublicResolver.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ForbiddenCallback(f"invalid url: {url}")
+    check_host(parsed.hostname)
+    if _private_allowed():
+        return
+    try:
+        public = _is_public(parsed.hostname)
+    except ValueError:
+        # a host name
+        return
+    if not public:
+        raise ForbiddenCallback(f"non public address: {parsed.hostname}")
+
+
+class PublicResolver(AbstractResolver):
+    """
+    Resolves the hosts of the callback urls and refuses the non public
+    addresses, unless allowed. The check is done by the connector, so the
+    address checked is the one connected to, the host can't resolve again to
+    another one.
+    """
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        hosts = await self._resolver.resolve(host, port, family)
+        if not _private_allowed():
+            for resolved in hosts:
+                if not _is_public(resolved["host"]):
+                    raise ForbiddenCallback(
+                        f"{host} resolves to a non public address: {resolved['host']}"
+                    )
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+def files_to_urls(value):
+    """
+    The urls of the files of a task in the value, with the configured
+    endpoint, otherwise relative to the api server.
+    """
+    if isinstance(value, list):
+        return [files_to_urls(v) for v in value]
+    task_dir = utils.task_dir()
+    if not isinstance(value, str) or not value.startswith(task_dir):
+        return value
+    endpoint = config.app.get("endpoint", "").rstrip("/")
+    path = os.path.relpath(value, task_dir).replace("\\", "/")
+    return f"{endpoint}/tasks/{path}"
+
+
+def notify(callback_url: str, task_id: str, state: int, result: Optional[Dict] = None):
+    """
+    Queue the webhook telling the callback_url that the task finished, it is
+    delivered by the dispatcher of the api process, or of a worker.
+    """
+    if not callback_url or state not in EVENTS:
+        return
+    parsed = urlparse(callback_url)
+    try:
+        if parsed.scheme not in ("http", "https"):
+            raise ForbiddenCallback("invalid url")
+        check_host(parsed.hostname)
+    except ForbiddenCallback as e:
+        logger.warning(f"callback url of task {task_id} refused: {callback_url}, {str(e)}")
+        return
+
+    data = {"event": EVENTS[state], "task_id": task_id, "state": state}
+    for key, value in (result or {}).items():
+        data[key] = files_to_urls(value)
+    webhook = {
+        "id": uuid.uuid4().hex,
+        "url": callback_url,
+        "data": data,
+        "created_at": time.time(),
+        "attempts": 0,
+        "next_attempt_at": 0,
+    }
+    outbox.put(webhook)
+    logger.info(f"webhook queued: {EVENTS[state]}, task {task_id}, {callback_url}")
+
+
+def sign(body: bytes, timestamp: str) -> str:
+    secret = config.app.get("webhook_secret", "")
+    message = timestamp.encode("utf-8") + b"." + body
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def next_attempt_at(attempts: int, now: float) -> float:
+    """
+    Exponential backoff from webhook_backoff_seconds, capped to an hour, with
+    jitter so the retries of many webhooks to a recovering endpoint spread.
+    """
+    backoff = config.app.get("webhook_backoff_seconds", 5)
+    delay = min(3600, backoff * 2 ** (attempts - 1))
+    return now + delay * random.uniform(0.8, 1.2)
+
+
+class Dispatcher:
+    """
+    Delivers the webhooks of the outbox on the async runtime. A webhook is
+    removed from the outbox only once the callback url answered 2xx, so the
+    deliveries survive restarts, and the receivers may see one twice.
+    """
+
+    def __init__(self, poll_interval: float = 1, batch_size: int = 20):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._future = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._future is None or self._future.done():
+                self._future = runtime.submit(self._run())
+                logger.info("webhook dispatcher started")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                webhooks = await loop.run_in_executor(
+                    None, outbox.claim, time.time(), self.batch_size
+                )
+                await asyncio.gather(*[self.deliver(w) for w in webhooks])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"webhook dispatcher failed: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def deliver(self, webhook: Dict):
+        body = json.dumps(webhook["data"], ensure_ascii=False).encode("utf-8")
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "MoneyPrinterTurbo-Webhook",
+            "X-Webhook-Id": webhook["id"],
+            "X-Webhook-Event": webhook["data"]["event"],
+            "X-Webhook-Timestamp": timestamp,
+        }
+        if config.app.get("webhook_secret", ""):
+            headers["X-Webhook-Signature"] = f"sha256={sign(body, timestamp)}"
+
+        loop = asyncio.get_running_loop()
+        error = ""
+        try:
+            check_url(webhook["url"])
+            # not cached, the address of the host is checked on every attempt
+            session = await runtime.http_session(
+                "webhook", make_resolver=PublicResolver, use_dns_cache=False
+            )
+            timeout = aiohttp.ClientTimeout(total=config.app.get("webhook_timeout", 10))
+            # a redirect could point to a refused address
+            async with session.post(
+                webhook["url"], data=body, headers=headers, timeout=timeout, allow_redirects=False
+            ) as response:
+                if 200 <= response.status < 300:
+                    await loop.run_in_executor(None, outbox.done, webhook)
+                    logger.info(f"webhook delivered: {webhook['id']}, {webhook['url']}")
+                    return
+                error = f"status {response.status}"
+        except ForbiddenCallback as e:
+            logger.error(f"webhook dropped: {webhook['id']}, {webhook['url']}, {str(e)}")
+            await loop.run_in_executor(None, outbox.done, webhook)
+            return
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+        webhook["attempts"] += 1
+        max_attempts = config.app.get("webhook_max_attempts", 8)
+        if webhook["attempts"] >= max_attempts:
+            logger.error(
+                f"webhook dropped after {webhook['attempts']} attempts: {webhook['id']}, {webhook['url']}, {error}"
+            )
+            await loop.run_in_executor(None, outbox.done, webhook)
+            return
+        webhook["next_attempt_at"] = next_attempt_at(webhook["attempts"], time.time())
+        logger.warning(
+            f"webhook delivery failed, attempt {webhook['attempts']}: {webhook['id']}, {webhook['url']}, {error}"
+        )
+        await loop.run_in_executor(None, outbox.retry, webhook)
+
+
+dispatcher = Dispatcher()
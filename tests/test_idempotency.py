@@ -0,0 +1,81 @@
+import threading
+
+import fakeredis
+import pytest
+import redis
+
+from app.models import const
+from app.models.schema import VideoParams
+from app.services import idempotency
+from app.services import state as sm
+
+
+@pytest.fixture(params=["memory", "redis"])
+def keys(request, monkeypatch):
+    if request.param == "memory":
+        keys = idempotency.MemoryKeys()
+    else:
+        monkeypatch.setattr(redis, "StrictRedis", fakeredis.FakeStrictRedis)
+        keys = idempotency.RedisKeys()
+    monkeypatch.setattr(idempotency, "keys", keys)
+    monkeypatch.setattr(sm, "state", sm.MemoryState())
+    return keys
+
+
+def submit(task_id, subject="spring", key="key-1"):
+    # like create_task, the state exists before the key is claimed
+    sm.state.update_task(task_id)
+    return idempotency.claim(task_id, VideoParams(video_subject=subject), "video", "tenant", key)
+
+
+def test_repeated_submission_gets_the_first_task(keys):
+    assert submit("first") == ("first", False)
+    # the first task hasn't started yet, it only has its initial state
+    assert submit("second") == ("first", True)
+
+
+def test_other_parameters_conflict(keys):
+    submit("first")
+    with pytest.raises(idempotency.IdempotencyConflict):
+        submit("second", subject="autumn")
+
+
+def test_failed_task_is_taken_over(keys):
+    submit("first")
+    sm.state.update_task("first", state=const.TASK_STATE_FAILED)
+    assert submit("second") == ("second", False)
+    assert submit("third") == ("second", True)
+
+
+def test_deleted_task_is_taken_over(keys):
+    submit("first")
+    sm.state.delete_task("first")
+    assert submit("second") == ("second", False)
+
+
+def test_concurrent_retries_take_over_once(keys):
+    submit("first")
+    sm.state.update_task("first", state=const.TASK_STATE_FAILED)
+    results = []
+    barrier = threading.Barrier(8)
+
+    def retry(i):
+        barrier.wait()
+        results.append(submit(f"retry-{i}"))
+
+    threads = [threading.Thread(target=retry, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    started = [task_id for task_id, existing in results if not existing]
+    assert len(started) == 1
+    assert {task_id for task_id, _ in results} == set(started)
+
+
+def test_replace_only_from_the_old_value(keys):
+    assert keys.set("k", "a", 60)
+    assert not keys.set("k", "b", 60)
+    assert not keys.replace("k", "b", "c", 60)
+    assert keys.replace("k", "a", "c", 60)
+    assert keys.get("k") == "c"
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.models import const
+from app.services import cancellation, pipeline
+from app.services import state as sm
+from app.services.pipeline import Pipeline, Stage, StageFailed
+
+
+@pytest.fixture
+def executors(monkeypatch, tmp_path):
+    monkeypatch.setattr(sm, "state", sm.MemoryState())
+    monkeypatch.setattr(cancellation, "flags", cancellation.FileFlags(str(tmp_path)))
+    monkeypatch.setattr(cancellation, "_checks", {})
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield {pipeline.STAGE_KIND_IO: executor, pipeline.STAGE_KIND_CPU: executor}
+    executor.shutdown()
+
+
+def cancel(task_id):
+    # like POST /tasks/{task_id}/cancel
+    cancellation.cancel(task_id)
+    sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED)
+
+
+def test_stages_run_in_dependency_order(executors):
+    stages = [
+        Stage("b", lambda a: {"b": a + 1}, inputs=["a"], outputs=["b"], progress=50),
+        Stage("a", lambda x: {"a": x * 2}, inputs=["x"], outputs=["a"], progress=20),
+    ]
+    context = Pipeline(stages, executors).run("t1", {"x": 1}, target="b")
+    assert context["b"] == 3
+    assert sm.state.get_task("t1")["progress"] == 50
+
+
+def test_stage_completed_after_cancel_keeps_the_task_cancelled(executors):
+    updates = []
+    original = sm.state.update_task
+
+    def record(task_id, **kwargs):
+        updates.append(kwargs.get("state"))
+        original(task_id, **kwargs)
+
+    sm.state.update_task = record
+
+    def slow(x):
+        # the cancellation arrives while the stage runs, it ignores it
+        cancel("t2")
+        return {"a": x}
+
+    stages = [
+        Stage("a", slow, inputs=["x"], outputs=["a"]),
+        Stage("b", lambda a: {"b": a}, inputs=["a"], outputs=["b"]),
+    ]
+    with pytest.raises(cancellation.TaskCancelled):
+        Pipeline(stages, executors).run("t2", {"x": 1}, target="b")
+    assert sm.state.get_task("t2")["state"] == const.TASK_STATE_CANCELLED
+    # nothing marked it running again after the cancellation
+    first_cancel = updates.index(const.TASK_STATE_CANCELLED)
+    assert const.TASK_STATE_PROCESSING not in updates[first_cancel:]
+
+
+def test_stage_failing_after_cancel_ends_cancelled(executors):
+    def failing(x):
+        cancel("t3")
+        raise RuntimeError("interrupted")
+
+    stages = [Stage("a", failing, inputs=["x"], outputs=["a"])]
+    with pytest.raises(cancellation.TaskCancelled):
+        Pipeline(stages, executors).run("t3", {"x": 1}, target="a")
+    assert sm.state.get_task("t3")["state"] == const.TASK_STATE_CANCELLED
+
+
+def test_stage_failure(executors):
+    stages = [Stage("a", lambda x: None, inputs=["x"], outputs=["a"])]
+    with pytest.raises(StageFailed):
+        Pipeline(stages, executors).run("t4", {"x": 1}, target="a")
+    assert sm.state.get_task("t4")["state"] == const.TASK_STATE_FAILED
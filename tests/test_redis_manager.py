@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+
+import fakeredis
+import pytest
+import redis
+
+from app.controllers.manager import redis_manager
+from app.controllers.manager.redis_manager import RedisTaskManager
+from app.models import const, schema
+from app.services import state as sm
+
+# the task ids the fake tasks were run with, in order
+ran = []
+# the fake tasks run until it is set
+release = threading.Event()
+release.set()
+
+
+def fake_task(task_id: str, params=None):
+    ran.append(task_id)
+    release.wait(5)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, "from_url", staticmethod(lambda url: fakeredis.FakeRedis(server=server))
+    )
+    monkeypatch.setitem(redis_manager.FUNC_MAP, "fake_task", fake_task)
+    ran.clear()
+    return server
+
+
+def make_manager(max_concurrent_tasks=2, **kwargs) -> RedisTaskManager:
+    kwargs.setdefault("standalone_workers", True)
+    return RedisTaskManager(max_concurrent_tasks, "redis://test", **kwargs)
+
+
+def pop(manager):
+    return manager.pop()
+
+
+def pop_all(manager):
+    task_ids = []
+    while True:
+        raw = manager.pop()
+        if not raw:
+            return task_ids
+        task_ids.append(json.loads(raw)["kwargs"]["task_id"])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_standalone_api_only_enqueues(server):
+    api = make_manager()
+    api.add_task(fake_task, task_id="t1")
+    assert api.current_tasks == 0
+    assert not api.is_queue_empty()
+    assert ran == []
+
+
+def test_queued_params_keep_their_type(server):
+    api = make_manager()
+    api.add_task(fake_task, task_id="t1", params=schema.AudioRequest(video_script="hello"))
+    task = api.dequeue()
+    assert isinstance(task["kwargs"]["params"], schema.AudioRequest)
+    assert task["kwargs"]["params"].video_script == "hello"
+
+
+def test_worker_runs_the_queue_in_order(server):
+    api = make_manager()
+    for i in range(3):
+        api.add_task(fake_task, task_id=f"t{i}")
+    worker = make_manager(max_concurrent_tasks=1, standalone_workers=False)
+    threading.Thread(target=worker.serve, kwargs={"poll_timeout": 1}, daemon=True).start()
+    assert wait_for(lambda: len(ran) == 3)
+    assert ran == ["t0", "t1", "t2"]
+
+
+def test_worker_skips_invalid_tasks(server):
+    api = make_manager()
+    api.redis_client.rpush(api.queue, json.dumps({"func": "unknown", "kwargs": {}}))
+    api.add_task(fake_task, task_id="t1")
+    worker = make_manager(standalone_workers=False)
+    threading.Thread(target=worker.serve, kwargs={"poll_timeout": 1}, daemon=True).start()
+    assert wait_for(lambda: ran == ["t1"])
+
+
+def test_pop_by_priority_then_fifo(server):
+    api = make_manager()
+    api.add_task(fake_task, task_id="normal-1")
+    api.add_task(fake_task, task_id="low-1", priority=const.TASK_PRIORITY_LOW)
+    api.add_task(fake_task, task_id="normal-2")
+    api.add_task(fake_task, task_id="high-1", priority=const.TASK_PRIORITY_HIGH)
+    assert pop_all(api) == ["high-1", "normal-1", "normal-2", "low-1"]
+
+
+def test_tenants_take_turns(server):
+    api = make_manager(tenant_weights={"b": 2})
+    for i in range(3):
+        api.add_task(fake_task, task_id=f"a-{i}", tenant="a")
+    for i in range(3):
+        api.add_task(fake_task, task_id=f"b-{i}", tenant="b")
+    assert pop_all(api) == ["a-0", "b-0", "b-1", "a-1", "b-2", "a-2"]
+
+
+def test_tasks_of_the_plain_queue_come_last(server):
+    api = make_manager()
+    api.redis_client.rpush(
+        api.queue, json.dumps({"func": "fake_task", "kwargs": {"task_id": "old"}})
+    )
+    api.add_task(fake_task, task_id="new", priority=const.TASK_PRIORITY_LOW)
+    assert pop_all(api) == ["new", "old"]
+
+
+def test_finished_tasks_are_acknowledged(server):
+    api = make_manager()
+    api.add_task(fake_task, task_id="t1")
+    api.add_task(fake_task, task_id="t2")
+    worker = make_manager(standalone_workers=False)
+    threading.Thread(target=worker.serve, kwargs={"poll_timeout": 1}, daemon=True).start()
+    assert wait_for(lambda: worker.metrics().get("completed") == 2)
+    assert worker.metrics()["in_flight"] == 0
+
+
+def test_expired_task_is_redelivered_first_then_dead_lettered(server):
+    manager = make_manager(max_attempts=2, visibility_timeout=300)
+    manager.add_task(fake_task, task_id="crashed")
+    manager.add_task(fake_task, task_id="next")
+    raw = pop(manager)
+    item_id = json.loads(raw)["id"]
+    # the worker running it stopped sending heartbeats
+    manager.redis_client.hset(manager.heartbeats_key, item_id, time.time() - 1000)
+
+    manager.requeue_expired()
+    assert manager.metrics()["in_flight"] == 0
+    task = json.loads(pop(manager))
+    assert task["kwargs"]["task_id"] == "crashed"
+    assert task["attempts"] == 1
+
+    manager.redis_client.hset(manager.heartbeats_key, item_id, time.time() - 1000)
+    manager.requeue_expired()
+    metrics = manager.metrics()
+    assert metrics["in_flight"] == 0
+    assert metrics["redelivered"] == 1
+    assert metrics["dead_lettered"] == 1
+    dead = manager.redis_client.lrange(manager.dead_key, 0, -1)
+    assert [json.loads(d)["kwargs"]["task_id"] for d in dead] == ["crashed"]
+    assert sm.state.get_task("crashed")["state"] == const.TASK_STATE_FAILED
+    assert json.loads(pop(manager))["kwargs"]["task_id"] == "next"
+
+
+def test_live_task_is_not_redelivered(server):
+    manager = make_manager(visibility_timeout=300)
+    manager.add_task(fake_task, task_id="running")
+    raw = pop(manager)
+    manager.redis_client.hset(manager.heartbeats_key, json.loads(raw)["id"], time.time())
+    manager.requeue_expired()
+    assert manager.metrics()["in_flight"] == 1
+    assert manager.is_queue_empty()
+
+
+def test_start_runs_the_tasks_queued_before(server):
+    producer = make_manager()
+    for i in range(3):
+        producer.add_task(fake_task, task_id=f"t{i}")
+    consumer = make_manager(standalone_workers=False)
+    release.clear()
+    try:
+        consumer.start()
+        # as many as the free slots
+        assert consumer.current_tasks == 2
+        assert consumer.queued() == 1
+    finally:
+        release.set()
+    assert wait_for(lambda: consumer.metrics().get("completed") == 3)
+    assert consumer.queued() == 0
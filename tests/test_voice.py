@@ -0,0 +1,88 @@
+import asyncio
+
+from app.services import voice
+from app.utils import utils
+
+# one frame of mpeg 1 layer III at 128 kbps and 44100 Hz: 417 bytes, 1152 samples
+MP3_FRAME = bytes.fromhex("fffb9000") + bytes(413)
+FRAME_DURATION = 1152 / 44100
+
+
+class FakeEngine:
+    """
+    Stands in for edge_tts: one mp3 frame per word, and a word boundary at
+    the start of every frame. Fails the first attempt of the chunks in fail_once.
+    """
+
+    def __init__(self, fail_once=()):
+        self.fail_once = set(fail_once)
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, text, voice_name, rate):
+        self.calls.append(text)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if text in self.fail_once:
+                self.fail_once.discard(text)
+                raise ConnectionError("connection closed")
+            words = text.split()
+            boundaries = [
+                (int(i * FRAME_DURATION * 10000000), 1000, word) for i, word in enumerate(words)
+            ]
+            return MP3_FRAME * len(words), boundaries
+        finally:
+            self.running -= 1
+
+
+def test_mp3_duration_counts_frames():
+    assert abs(voice.mp3_duration(MP3_FRAME * 10) - 10 * FRAME_DURATION) < 1e-9
+    # garbage before the first frame is skipped
+    assert abs(voice.mp3_duration(b"ID3" + MP3_FRAME) - FRAME_DURATION) < 1e-9
+
+
+def test_split_text_into_chunks_keeps_the_lines():
+    text = "One two. Three four, five. Six seven! Eight? Nine ten. Eleven 3.5 twelve."
+    chunks = voice.split_text_into_chunks(text, 2)
+    assert len(chunks) > 1
+    lines = [line for chunk in chunks for line in utils.split_string_by_punctuations(chunk)]
+    assert lines == utils.split_string_by_punctuations(text)
+
+
+def test_chunked_synthesis_shifts_the_boundaries(tmp_path):
+    chunks = ["a b c", "d e", "f g h i"]
+    engine = FakeEngine(fail_once={"d e"})
+    voice_file = str(tmp_path / "voice.mp3")
+
+    sub_maker = voice.azure_tts_v1_chunked(chunks, "voice", "+0%", voice_file, engine=engine)
+
+    assert sub_maker.subs == list("abcdefghi")
+    # every word starts one frame after the previous one, across the chunks
+    starts = [start for start, _ in sub_maker.offset]
+    for i, start in enumerate(starts):
+        assert abs(start - i * FRAME_DURATION * 10000000) < 5
+    with open(voice_file, "rb") as f:
+        assert f.read() == MP3_FRAME * 9
+    # the failed chunk was retried on its own
+    assert engine.calls.count("d e") == 2
+    assert engine.calls.count("a b c") == 1
+
+
+def test_chunked_synthesis_limits_the_concurrency(tmp_path, monkeypatch):
+    monkeypatch.setitem(voice.config.app, "tts_chunk_concurrency", 2)
+    engine = FakeEngine()
+    chunks = [f"chunk {i}" for i in range(6)]
+    voice.azure_tts_v1_chunked(chunks, "voice", "+0%", str(tmp_path / "voice.mp3"), engine=engine)
+    assert engine.max_running == 2
+
+
+def test_chunked_synthesis_fails_if_a_chunk_keeps_failing(tmp_path):
+    async def engine(text, voice_name, rate):
+        if text == "bad":
+            raise ConnectionError("connection closed")
+        return MP3_FRAME, [(0, 1000, text)]
+
+    assert voice.azure_tts_v1_chunked(["good", "bad"], "voice", "+0%", str(tmp_path / "v.mp3"), engine=engine) is None
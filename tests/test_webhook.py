@@ -0,0 +1,145 @@
+import hashlib
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.models import const
+from app.services import webhook
+from app.services.runtime import runtime
+
+
+class Receiver:
+    """
+    A local http server standing in for the callback url, it answers the
+    requests with the given statuses in turn and records them.
+    """
+
+    def __init__(self, statuses=(200,)):
+        self.statuses = list(statuses)
+        self.requests = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.requests.append((self.path, dict(self.headers), body))
+                status = receiver.statuses.pop(0) if len(receiver.statuses) > 1 else receiver.statuses[0]
+                self.send_response(status)
+                if status in (301, 302, 307, 308):
+                    self.send_header("Location", "/redirected")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    outbox = webhook.FileOutbox(str(tmp_path))
+    monkeypatch.setattr(webhook, "outbox", outbox)
+    return outbox
+
+
+@pytest.fixture
+def receiver():
+    receiver = Receiver()
+    yield receiver
+    receiver.close()
+
+
+@pytest.fixture
+def allow_local(monkeypatch):
+    monkeypatch.setitem(webhook.config.app, "webhook_allow_private", True)
+
+
+def deliver_due(outbox):
+    webhooks = outbox.claim(float("inf"), 10)
+    for w in webhooks:
+        runtime.run(webhook.dispatcher.deliver(w), timeout=10)
+    return webhooks
+
+
+def test_webhook_is_delivered_signed(outbox, receiver, allow_local, monkeypatch):
+    monkeypatch.setitem(webhook.config.app, "webhook_secret", "secret")
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_COMPLETE, {"videos": ["a.mp4"]})
+    assert len(deliver_due(outbox)) == 1
+
+    (path, headers, body), = receiver.requests
+    assert path == "/hook"
+    data = json.loads(body)
+    assert data["event"] == "task.completed"
+    assert data["task_id"] == "task-1"
+    message = headers["X-Webhook-Timestamp"].encode("utf-8") + b"." + body
+    expected = hmac.new(b"secret", message, hashlib.sha256).hexdigest()
+    assert headers["X-Webhook-Signature"] == f"sha256={expected}"
+    # delivered webhooks leave the outbox
+    assert deliver_due(outbox) == []
+
+
+def test_failed_delivery_is_retried_later(outbox, receiver, allow_local):
+    receiver.statuses = [500, 200]
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_FAILED)
+    deliver_due(outbox)
+    # not due yet, the next attempt is backed off
+    assert outbox.claim(0, 10) == []
+    retried = deliver_due(outbox)
+    assert retried[0]["attempts"] == 1
+    assert len(receiver.requests) == 2
+    assert deliver_due(outbox) == []
+
+
+def test_webhook_is_dropped_after_max_attempts(outbox, receiver, allow_local, monkeypatch):
+    monkeypatch.setitem(webhook.config.app, "webhook_max_attempts", 2)
+    receiver.statuses = [503]
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_FAILED)
+    deliver_due(outbox)
+    deliver_due(outbox)
+    assert len(receiver.requests) == 2
+    assert deliver_due(outbox) == []
+
+
+def test_internal_address_is_refused(outbox, receiver):
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_COMPLETE)
+    deliver_due(outbox)
+    assert receiver.requests == []
+    # dropped, not retried
+    assert deliver_due(outbox) == []
+
+
+def test_host_resolving_to_internal_address_is_refused(outbox, receiver):
+    # the address is checked by the connector, where the host is resolved
+    url = receiver.url.replace("127.0.0.1", "localhost")
+    webhook.notify(url, "task-1", const.TASK_STATE_COMPLETE)
+    deliver_due(outbox)
+    assert receiver.requests == []
+    assert deliver_due(outbox) == []
+
+
+def test_allowed_hosts(outbox, receiver, monkeypatch):
+    monkeypatch.setitem(webhook.config.app, "webhook_allowed_hosts", ["127.0.0.1"])
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_COMPLETE)
+    deliver_due(outbox)
+    assert len(receiver.requests) == 1
+
+    # a host not in the list is refused when the task finishes
+    webhook.notify("http://example.com/hook", "task-2", const.TASK_STATE_COMPLETE)
+    assert deliver_due(outbox) == []
+
+
+def test_redirects_are_not_followed(outbox, receiver, allow_local):
+    receiver.statuses = [302]
+    webhook.notify(receiver.url, "task-1", const.TASK_STATE_COMPLETE)
+    deliver_due(outbox)
+    assert [path for path, _, _ in receiver.requests] == ["/hook"]
@@ -0,0 +1,22 @@
+import sys
+
+from loguru import logger
+
+from app.config import config
+
+if __name__ == "__main__":
+    if not config.app.get("enable_redis", False):
+        logger.error("the worker takes the tasks from redis, please set enable_redis = true")
+        sys.exit(1)
+
+    from app.controllers.v1.video import task_manager
+    from app.services import webhook
+
+    # the webhooks of the tasks run here are delivered from here too
+    webhook.dispatcher.start()
+    try:
+        task_manager.serve()
+    except KeyboardInterrupt:
+        logger.info("worker stopped")
+    finally:
+        task_manager.shutdown()